@@ -1,17 +1,36 @@
+import io
 import os
 import json
+import time
 import discord
 import asyncio
 import logging
-from discord.ext import commands, tasks
-from helpers.db_helper import DBHelper
+import tempfile
+from typing import Union
+from discord.ext import commands
+from helpers.guild_manager import GuildManager
 from helpers.gdrive_helper import GDriveHelper
+from helpers.asset_cache import AssetCache
+from helpers.scheduler import Scheduler, Job
+from helpers.backup_helper import BackupHelper
+from helpers.ingest_server import IngestServer
+from helpers.bulk_ops import parse_grants, apply_grants, export_csv
+from helpers.render_cache import RenderCache, render_leaderboard_card
+from helpers.log_helper import log_sampled
+from helpers.spam_scorer import SpamScorer
+from helpers.worker_pool import WorkerPool, JobPending, WorkersStopped, resolve_job
 from datetime import datetime
 from discord.errors import NotFound
 from games import blackjack
 from games import gamba
 from games import gacha
 
+# Commands whose work can run in the worker processes, see Melbot.run_job.
+JOBS = {
+    "gacha": "games.gacha:pull_job",
+    "gamble": "games.gamba:gamble_job",
+}
+
 class NotBotAdmin(commands.CheckFailure):
     pass
 
@@ -37,23 +56,66 @@ class SafeMember(commands.Converter):
 
 
 class Melbot():
-    def __init__(self, command_prefix:str='!'):
+    def __init__(self, command_prefix:str='!', startup_time: float = None):
         logging.info("Melbot init")
+        self.startup_time = startup_time
         self.config = json.load(open('bot.json'))
-        self.db = DBHelper(self.config['db_name'])
+        self.guilds = GuildManager(self.config)
         self.gdrive = GDriveHelper()
+        self.assets = AssetCache(
+            self.gdrive,
+            os.getenv("DOWNLOAD_FOLDER", "downloads"),
+            max_bytes=self.config.get("asset_cache_max_bytes", 1024 ** 3),
+            revalidate_after=self.config.get("asset_revalidate_after", 3600)
+        )
         self.discord_token = os.environ['DISCORD_TOKEN']
         self.intents = discord.Intents.default()
         self.intents.message_content = True
         self.intents.members = True
-        self.bot = commands.Bot(command_prefix=command_prefix, intents=self.intents)
+        if self.config.get('sharded', False):
+            # shard_ids lets several processes split the shards of one bot between them.
+            shard_options = {key: self.config[key] for key in ('shard_count', 'shard_ids') if key in self.config}
+            self.bot = commands.AutoShardedBot(command_prefix=command_prefix, intents=self.intents, **shard_options)
+        else:
+            self.bot = commands.Bot(command_prefix=command_prefix, intents=self.intents)
         self.cooldowns = {"message": {}}
         self.playing_blackjack = {}
+        anti_spam = dict(self.config.get('anti_spam', {}))
+        self.spam_scorer = None
+        if anti_spam.pop('enabled', True):
+            self.spam_scorer = SpamScorer(**anti_spam)
+        self.ready_once = False
+        self.warm_up_task = None
+        scheduler_config = self.config.get('scheduler', {})
+        self.scheduler = Scheduler(
+            scheduler_config.get('db_name', 'scheduler.db'),
+            peak_hours=scheduler_config.get('peak_hours'),
+            max_heavy_jobs=scheduler_config.get('max_heavy_jobs', 1),
+            # Processes serving different shards each sync their own guilds' members.
+            shard=",".join(str(shard_id) for shard_id in self.config['shard_ids']) if self.config.get('sharded', False) and 'shard_ids' in self.config else None
+        )
+        self.backups = BackupHelper(**self.config.get('backup', {}))
+        self.render_cache = RenderCache()
+        self.ingest = None
+        if 'ingest' in self.config:
+            self.ingest = IngestServer(self.guilds, os.environ['INGEST_TOKEN'], **self.config['ingest'])
+        self.workers = None
+        if 'workers' in self.config:
+            if any(guild_config.get('db_backend') == 'memory' for guild_config in self.guilds.guild_configs.values()):
+                raise ValueError("Worker processes cannot share the in-memory ledger, use the sqlite or postgres db_backend.")
+            self.workers = WorkerPool(self.config, JOBS, **self.config['workers'])
+        self.add_scheduled_jobs()
         logging.info("Melbot init done")
 
     async def initialize(self):
-        await self.db.initialize()
-        await self.db.create_db()
+        # Guild databases are opened lazily on first use.
+        logging.info(f"Serving guilds: {self.guilds.guild_ids()}")
+        if not self.config.get("fast_start", True):
+            await asyncio.to_thread(self.gdrive.warm_up)
+        if self.ingest:
+            await self.ingest.start()
+        if self.workers:
+            self.workers.start()
         #await self.bot.load_extension(self.db, name="cogs.events")
 
     async def run(self):
@@ -63,9 +125,7 @@ class Melbot():
             await self.add_bot_events()
             logging.info("Bot is running...")
             await self.bot.start(self.discord_token)
-            #await self.aggregate_points_task.cancel()
-            await self.timeout_blackjack_task.cancel()
-            await self.update_users_table.cancel()
+            await self.scheduler.stop()
         except asyncio.CancelledError:
             logging.info("Bot cancelled.")
         except Exception as e:
@@ -75,78 +135,175 @@ class Melbot():
     async def shutdown(self):
         logging.info("Shutting down bot...")
         await self.bot.close()
+        # Points only change when a table settles, so unsettled tables are cancelled and settling ones finish their write.
+        tables = {entry["game"] for entry in self.playing_blackjack.values() if entry["game"].task is not None}
+        for table in tables:
+            if not table.settling:
+                table.task.cancel()
+        await asyncio.gather(*(table.task for table in tables), return_exceptions=True)
+        # A table cancelled before its task first ran never reaches its own cleanup.
+        self.playing_blackjack.clear()
+        await self.scheduler.stop()
+        if self.ingest:
+            await self.ingest.stop()
+        if self.workers:
+            await self.workers.stop()
+        await self.guilds.close()
 
     def is_bot_admin(self):
         async def predicate(ctx):
-            if ctx.author.id not in self.config['bot_admins']:
+            if ctx.author.id not in self.guilds.get_config(ctx.guild)['bot_admins']:
                 raise NotBotAdmin()
             return True
         return commands.check(predicate)
     
-    @tasks.loop(minutes=10)
-    async def timeout_blackjack_task(self):
-        logging.info("Checking for blackjack timeouts...")
-        current_time = datetime.now().timestamp()
-        timed_out_players = []
-        for user_id, game in self.playing_blackjack.items():
-            if current_time - game["start_time"] >= 60 * 10:
-                timed_out_players.append(user_id)
-        for user_id in timed_out_players:
-            game = self.playing_blackjack[user_id]
-            await self.db.add_event(user_id, game["bet"] * -1, 'blackjack')
-            self.playing_blackjack.pop(user_id)
-            await game["ctx"].send(f"{game["ctx"].author.name} - your blackjack game has timed out.")
-            logging.info(f"Blackjack game for {game["ctx"].author.name} has timed out.")
-        logging.info("Checked for blackjack timeouts.")
-
-    @tasks.loop(hours=24)
-    async def aggregate_points_task(self):
+    async def run_job(self, user_id: int, job: str, **kwargs):
+        # Runs in a worker process when they are configured, otherwise right here with the bot as the job context.
+        if self.workers is None:
+            return await resolve_job(JOBS[job])(self, **kwargs)
+        try:
+            result = await self.workers.run(user_id, job, **kwargs)
+        except WorkersStopped:
+            return {"error": "Commands are paused while the database is restored, try again in a moment."}
+        except JobPending as e:
+            e.future.add_done_callback(lambda future: self.job_finished_late(job, kwargs['guild_id'], future))
+            return {"error": "This is taking longer than usual. Check your melpoints in a moment to see whether it went through."}
+        # The worker wrote to the database, which the data versions in this process do not see.
+        self.render_cache.invalidate(kwargs['guild_id'])
+        return result
+
+    def job_finished_late(self, job: str, guild_id: int, future: asyncio.Future):
+        self.render_cache.invalidate(guild_id)
+        if future.cancelled():
+            logging.warning(f"Job {job} for guild {guild_id} was cancelled after its timeout.")
+        elif future.exception() is not None:
+            logging.error(f"Job {job} for guild {guild_id} failed after its timeout: {future.exception()}")
+        else:
+            logging.info(f"Job {job} for guild {guild_id} finished after its timeout.")
+
+    def warm_up_finished(self, task: asyncio.Task):
+        # The client is built again on first use, so a failed warm-up only costs that request some time.
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Warming up the Google Drive client failed: {task.exception()}")
+
+    async def get_attachment(self, drive_file: dict):
+        max_bytes = self.config.get("attachment_max_bytes", 8 * 1024 * 1024)
+        # Opened by the cache, so the file stays readable even if it is evicted before it is sent.
+        file = await self.assets.open_attachment(drive_file, max_bytes)
+        if file is None:
+            return None
+        return discord.File(file, filename=drive_file['name'])
+
+    @staticmethod
+    def render_shop(items: list):
+        if len(items) == 0:
+            return None
+        embed = discord.Embed(title="Madame Melanie's Shop", color=discord.Color.blue())
+        for item in items:
+            item_details = f"> **Price**: {item[2]} melpoints\n> **Description**: {item[3]}"
+            embed.add_field(name=f"**{item[1]}**", value=item_details, inline=False)
+        return embed
+
+    @staticmethod
+    def render_leaderboard(rows: list, with_image: bool) -> tuple:
+        leaderboard_str = "Leaderboard:\n" + "".join(f"{idx + 1}. {username}: {points}\n" for idx, (username, points) in enumerate(rows))
+        card = render_leaderboard_card("Leaderboard", rows) if with_image else None
+        return leaderboard_str, card
+
+    def add_scheduled_jobs(self):
+        # Every job can be overridden (schedule, jitter, priority, enabled) under scheduler.jobs in bot.json.
+        default_jobs = {
+            'close_idle_databases': {'func': self.close_idle_databases, 'schedule': '*/5 * * * *'},
+            'users_sync': {'func': self.update_users_table, 'schedule': '0 6 * * *', 'jitter': 300, 'heavy': True, 'run_at_start': True, 'per_shard': True},
+            'aggregate_points': {'func': self.aggregate_points, 'schedule': '30 6 * * *', 'jitter': 300, 'heavy': True, 'enabled': False},
+            'backup': {'func': self.backup_databases, 'schedule': '0 4 * * *', 'jitter': 300, 'heavy': True},
+        }
+        job_config = self.config.get('scheduler', {}).get('jobs', {})
+        for name, options in default_jobs.items():
+            options = {**options, **job_config.get(name, {})}
+            if not options.pop('enabled', True):
+                continue
+            self.scheduler.add_job(Job(name, **options))
+
+    async def aggregate_points(self):
         cutoff_timestamp = datetime.now().timestamp() - 24 * 60 * 60
         logging.info(f"Aggregating points with timestamp {cutoff_timestamp}...")
-        await self.db.aggregate_points_async(cutoff_timestamp)
+        for guild_id in self.guilds.guild_ids():
+            db = await self.guilds.get_db(guild_id)
+            await db.aggregate_points_async(cutoff_timestamp)
         logging.info("Aggregated points successfully.")
 
-    @tasks.loop(hours=24)
     async def update_users_table(self):
-        guild = self.bot.get_guild(self.config.get("bot_guild"))
-        member_list = [member for member in guild.members]
-        await self.db.replace_users(member_list)
-
-
-    @aggregate_points_task.before_loop
-    async def before_aggregate_points_task(self):
-        await self.bot.wait_until_ready()
+        # Each shard process only sees its own guilds.
+        for guild in self.bot.guilds:
+            if not self.guilds.is_configured(guild):
+                continue
+            db = await self.guilds.get_db(guild)
+            member_list = [member for member in guild.members]
+            await db.replace_users(member_list)
+
+    async def close_idle_databases(self):
+        await self.guilds.close_idle()
+
+    async def backup_databases(self):
+        for guild_id in self.guilds.guild_ids():
+            db_path = self.guilds.get_db_path(guild_id)
+            if self.guilds.uses_sqlite(guild_id) and os.path.exists(db_path):
+                await self.backups.backup(db_path)
 
     async def add_bot_events(self):
         # --- bot events ---
         @self.bot.event
         async def on_ready():
-            #self.aggregate_points_task.start()
-            self.timeout_blackjack_task.start()
-            self.update_users_table.start()
+            # on_ready fires again after every reconnect.
+            if self.ready_once:
+                return
+            self.ready_once = True
+            if self.startup_time is not None:
+                logging.info(f"Cold start to on_ready took {time.perf_counter() - self.startup_time:.2f}s.")
+            await self.scheduler.start()
+            if self.config.get("fast_start", True):
+                # Kept on self, the loop only holds a weak reference to the task.
+                self.warm_up_task = asyncio.create_task(asyncio.to_thread(self.gdrive.warm_up))
+                self.warm_up_task.add_done_callback(self.warm_up_finished)
 
         @self.bot.event
         async def on_message(message):
             if (message.author == self.bot.user) or message.author.bot:
                 return
-            if not message.content.startswith(self.bot.command_prefix) and len(message.content) > self.config['min_message_length']:
+            if not self.guilds.is_configured(message.guild):
+                return
+            guild_config = self.guilds.get_config(message.guild)
+            if not message.content.startswith(self.bot.command_prefix) and len(message.content) > guild_config['min_message_length']:
                 current_time = datetime.now().timestamp()
-                if message.author.id in self.cooldowns["message"]:
-                    if current_time - self.cooldowns["message"][message.author.id] < self.config['message_points_cooldown']:
+                cooldown_key = (self.guilds.resolve_guild_id(message.guild), message.author.id)
+                if cooldown_key in self.cooldowns["message"]:
+                    if current_time - self.cooldowns["message"][cooldown_key] < guild_config['message_points_cooldown']:
                         return
-                self.cooldowns["message"].update({message.author.id: current_time})
-                await self.db.add_event(message.author.id, self.config["points_per_message"], 'message')
-            if message.channel.id in self.config["bot_commands_channel_id"] or message.author.id in self.config["bot_admins"]:
+                self.cooldowns["message"].update({cooldown_key: current_time})
+                points = guild_config["points_per_message"]
+                if self.spam_scorer is not None:
+                    points = int(points * self.spam_scorer.score(cooldown_key, message.content))
+                if points > 0:
+                    db = await self.guilds.get_db(message.guild)
+                    await db.add_event(message.author.id, points, 'message')
+                    log_sampled("message_points", logging.INFO, "Message points for %s in guild %s.", message.author.id, cooldown_key[0])
+                else:
+                    log_sampled("message_spam", logging.INFO, "Refused message points for %s in guild %s.", message.author.id, cooldown_key[0])
+            if message.channel.id in guild_config["bot_commands_channel_id"] or message.author.id in guild_config["bot_admins"]:
                 await self.bot.process_commands(message)
 
         @self.bot.event
         async def on_raw_member_remove(_payload):
-            await self.db.delete_user(str(_payload.user.id))
+            if not self.guilds.is_configured(_payload.guild_id):
+                return
+            db = await self.guilds.get_db(_payload.guild_id)
+            await db.delete_user(str(_payload.user.id))
 
         # --- bot commands ---
-        blackjack.add_bot_commands(self.bot, self.playing_blackjack, self.db)
-        gamba.add_bot_commands(self.bot, self.db)
-        gacha.add_bot_commands(self.bot, self.db)
+        blackjack.add_bot_commands(self.bot, self.playing_blackjack, self.guilds)
+        gamba.add_bot_commands(self.bot, self.guilds, self.run_job)
+        gacha.add_bot_commands(self.bot, self.guilds, self.get_attachment, self.run_job)
 
         self.bot.remove_command('help')
         @self.bot.command(help="Display the help message.")
@@ -168,7 +325,8 @@ class Melbot():
             if user is None:
                 user = ctx.author
             user_id = str(user.id)
-            total_currency = await self.db.get_total_currency(user_id)
+            db = await self.guilds.get_db(ctx.guild)
+            total_currency = await db.get_total_currency(user_id)
             await ctx.send(f'{user.name} has {total_currency} points')
 
         @self.bot.command(help="Buy an item from the shop. You can use !buy item_name to buy an item.")
@@ -182,66 +340,118 @@ class Melbot():
                 return
 
             user_id = str(ctx.author.id)
-            item_price, item_file = await self.db.buy_items_by_name(item_id)              
+            db = await self.guilds.get_db(ctx.guild)
+            item_price, item_file = await db.buy_items_by_name(item_id)              
 
             if item_price is None:
                 await ctx.send("The item does not exist.")
                 return
 
             if item_file == '':
+                drive_file = None
                 link_message = ''
             else:
-                if not self.gdrive.file_in_drive(item_file):
+                drive_file = await asyncio.to_thread(self.gdrive.find_file, item_file)
+                if drive_file is None:
                     await ctx.send(f"Item {item_id} doesn't have a valid file. Please contact an admin.")
                     return
-                file_list = self.gdrive.get_files()
-                for file in file_list:
-                    if file['name'] == item_file:
-                        file_link = file['webViewLink']
-                        break             
-                link_message = f"\nYou can download the file [here]({file_link})."    
-
-            user_points = await self.db.get_total_currency(user_id)
+                link_message = f"\nYou can download the file [here]({drive_file['webViewLink']})."    
+
+            user_points = await db.get_total_currency(user_id)
             
             if user_points < item_price:
                 await ctx.send(f"You do not have enough melpoints to buy this item. You have {user_points} melpoints but need {item_price}.")
                 return
 
-            await self.db.add_event(user_id, item_price * -1, f"bought item {item_id}")
+            await db.add_event(user_id, item_price * -1, f"bought item {item_id}")
             await ctx.send(f"You have successfully bought the item {item_id} for {item_price} melpoints.")
-            shop_channel = await self.bot.fetch_channel(self.config['shop_channel_id'])
+            shop_channel = await self.bot.fetch_channel(self.guilds.get_config(ctx.guild)['shop_channel_id'])
             await shop_channel.send(f"{ctx.author.mention} has bought the item {item_id} for {item_price} melpoints.")
-            await ctx.author.send(f"You have successfully bought the item {item_id} for {item_price} melpoints."+link_message)
+            attachment = await self.get_attachment(drive_file)
+            if attachment is not None:
+                await ctx.author.send(f"You have successfully bought the item {item_id} for {item_price} melpoints.", file=attachment)
+            else:
+                await ctx.author.send(f"You have successfully bought the item {item_id} for {item_price} melpoints."+link_message)
 
         @self.bot.command(help="Display the shop items.")
         async def shop(ctx):
-            items = await self.db.get_shop_items()
-            if len(items) == 0:
+            db = await self.guilds.get_db(ctx.guild)
+
+            async def render():
+                items = await db.get_shop_items()
+                return await asyncio.to_thread(self.render_shop, items)
+
+            # The embed is rebuilt only when the catalog changed.
+            embed = await self.render_cache.get((self.guilds.resolve_guild_id(ctx.guild), "shop"), db.data_version("shop"), render)
+            if embed is None:
                 await ctx.send("The shop is empty.")
                 return
-            embed = discord.Embed(title="Madame Melanie's Shop", color=discord.Color.blue())
-            for item in items:
-                item_details = f"> **Price**: {item[2]} melpoints\n> **Description**: {item[3]}"
-                embed.add_field(name=f"**{item[1]}**", value=item_details, inline=False)
             await ctx.send(embed=embed)
 
         @self.bot.command(help="Display the leaderboard.")
         async def leaderboard(ctx):
-            leaderboard = await self.db.get_leaderboard()
-            if len(leaderboard) == 0:
+            db = await self.guilds.get_db(ctx.guild)
+            guild_config = self.guilds.get_config(ctx.guild)
+
+            async def render():
+                rows = []
+                for user_id, points in await db.get_leaderboard():
+                    member = ctx.guild.get_member(int(user_id))
+                    if member is None:
+                        try:
+                            member = await ctx.guild.fetch_member(int(user_id))
+                        except NotFound:
+                            member = None
+                    rows.append((member.display_name if member else "User not found", points))
+                if len(rows) == 0:
+                    return None, None
+                return await asyncio.to_thread(self.render_leaderboard, rows, guild_config.get("leaderboard_image", False))
+
+            # Points change with every message, so a render is reused for leaderboard_max_stale seconds after the data changed.
+            leaderboard_str, card = await self.render_cache.get(
+                (self.guilds.resolve_guild_id(ctx.guild), "leaderboard"),
+                db.data_version("leaderboard"),
+                render,
+                max_stale=guild_config.get("leaderboard_max_stale", 30)
+            )
+            if leaderboard_str is None:
                 await ctx.send("The leaderboard is empty.")
                 return
-            leaderboard_str = "Leaderboard:\n"
-            for idx, user in enumerate(leaderboard):
-                user_id = user[0]
-                points = user[1]
-                try:
-                    member = await ctx.guild.fetch_member(int(user_id))
-                    username = member.display_name
-                except NotFound:
-                    username = "User not found"
-                leaderboard_str += f"{idx + 1}. {username}: {points}\n"
-            await ctx.send(leaderboard_str)
+            if card is not None:
+                await ctx.send(leaderboard_str, file=discord.File(io.BytesIO(card), filename="leaderboard.png"))
+            else:
+                await ctx.send(leaderboard_str)
+
+        @self.bot.command(help="Display the seasons, or the final leaderboard of a past season. You can use !season or !season <number>.")
+        async def season(ctx, season_id: int = None):
+            db = await self.guilds.get_db(ctx.guild)
+            seasons = {row[0]: row for row in await db.get_seasons()}
+            if season_id is None:
+                lines = []
+                for _, (season_id, name, started_at, ended_at) in sorted(seasons.items()):
+                    end = datetime.fromtimestamp(ended_at).strftime('%Y-%m-%d') if ended_at else "now"
+                    lines.append(f"{season_id}. {name}: {datetime.fromtimestamp(started_at).strftime('%Y-%m-%d')} to {end}")
+                await ctx.send("Seasons:\n" + "\n".join(lines))
+                return
+            if season_id not in seasons:
+                await ctx.send(f"Season {season_id} does not exist. Use !season to see the seasons.")
+                return
+            rows = []
+            for user_id, points in await db.get_season_leaderboard(season_id):
+                member = ctx.guild.get_member(int(user_id)) if ctx.guild else None
+                rows.append((member.display_name if member else "User not found", points))
+            if len(rows) == 0:
+                await ctx.send(f"The leaderboard of {seasons[season_id][1]} is empty.")
+                return
+            await ctx.send(f"{seasons[season_id][1]} leaderboard:\n" + "".join(f"{idx + 1}. {username}: {points}\n" for idx, (username, points) in enumerate(rows)))
+
+        @self.bot.command(help="End the current season and start a new one where everyone starts from 0 melpoints. You can use !new_season <name>.")
+        @self.is_bot_admin()
+        async def new_season(ctx, *, name: str):
+            db = await self.guilds.get_db(ctx.guild)
+            season_id = await db.start_season(name)
+            self.render_cache.invalidate(self.guilds.resolve_guild_id(ctx.guild))
+            await ctx.send(f"{name} has started. Use !season {season_id - 1} to see the final leaderboard of the last season.")
 
         @self.bot.command(help="Display information about this bot.")
         async def about(ctx):
@@ -278,19 +488,21 @@ class Melbot():
                 await ctx.send("Wrong syntax, it should be like this ""!add_item gen 500 \"nice gen\" mel.png")
                 return
             if item_file is not None:
-                if not self.gdrive.file_in_drive(item_file):
+                if not await asyncio.to_thread(self.gdrive.file_in_drive, item_file):
                     await ctx.send(f"File {item_file} not found in Google Drive.")
                     return
             else:
                 item_file = ''
-            await self.db.add_item(item_name, item_price, item_description, item_file)
+            db = await self.guilds.get_db(ctx.guild)
+            await db.add_item(item_name, item_price, item_description, item_file)
             await ctx.send(f"Item {item_name} added to the shop with price {item_price} points.")
 
         @self.bot.command(help="Add melpoints to a user's account. You can use !add @user <number> to add melpoints to a user's account.")
         @self.is_bot_admin()
         async def add(ctx, user: SafeMember, points: int):
             user_id = str(user.id)
-            await self.db.add_event(user_id, points, 'admin added')
+            db = await self.guilds.get_db(ctx.guild)
+            await db.add_event(user_id, points, 'admin added')
             await ctx.send(f"{points} points added to {user.name}'s account.")
 
         @self.bot.command(help="Remove an item from the shop. You can use !remove_item <item_id> to remove an item by its ID, or !remove_item <item_name> to remove an item by its name.")
@@ -303,10 +515,11 @@ class Melbot():
                 item_id = int(item_id)
             except ValueError:
                 logging.debug(f"Failed to convert {item_id} to int. {item_id} is of type {type(item_id)}")
+            db = await self.guilds.get_db(ctx.guild)
             if type(item_id) == int:
-                rows_deleted = await self.db.remove_item_by_id(item_id)
+                rows_deleted = await db.remove_item_by_id(item_id)
             elif type(item_id) == str:
-                rows_deleted = await self.db.remove_item_by_name(item_id)
+                rows_deleted = await db.remove_item_by_name(item_id)
             else:
                 await ctx.send("Wrong syntax, it should be like this '!remove_item 1' or '!remove_item gen'")
                 return
@@ -320,7 +533,152 @@ class Melbot():
         @self.is_bot_admin()
         async def remove(ctx, user: SafeMember, points: int):
             user_id = str(user.id)
-            await self.db.add_event(user_id, points * -1, 'admin removed')
+            db = await self.guilds.get_db(ctx.guild)
+            await db.add_event(user_id, points * -1, 'admin removed')
             await ctx.send(f"{points} points removed from {user.name}'s account.")
 
+        async def bulk_change(ctx, points: int, targets: tuple, reason: str, sign: int):
+            # Roles expand to their members; a CSV attachment adds userid,points rows.
+            grants = {}
+            if targets and points is None:
+                await ctx.send("Please provide a number of points for the roles and users.")
+                return
+            for target in targets:
+                members = target.members if isinstance(target, discord.Role) else [target]
+                for member in members:
+                    grants[str(member.id)] = points
+            for attachment in ctx.message.attachments:
+                try:
+                    grants.update(parse_grants((await attachment.read()).decode('utf-8-sig'), points))
+                except ValueError as e:
+                    await ctx.send(f"Could not read {attachment.filename}: {e}")
+                    return
+            if not grants:
+                await ctx.send("Please mention roles or users, or attach a CSV file of userid,points rows.")
+                return
+            db = await self.guilds.get_db(ctx.guild)
+            count = await apply_grants(db, list(grants.items()), reason, sign)
+            await ctx.send(f"{'Added' if sign > 0 else 'Removed'} melpoints for {count} users.")
+
+        @self.bot.command(help="Add melpoints to many users at once. You can use !grant <number> @role @user ..., or attach a CSV file of userid,points rows.")
+        @self.is_bot_admin()
+        async def grant(ctx, points: int = None, *targets: Union[discord.Role, discord.Member]):
+            await bulk_change(ctx, points, targets, 'admin added', 1)
+
+        @self.bot.command(help="Remove melpoints from many users at once. You can use !revoke <number> @role @user ..., or attach a CSV file of userid,points rows.")
+        @self.is_bot_admin()
+        async def revoke(ctx, points: int = None, *targets: Union[discord.Role, discord.Member]):
+            await bulk_change(ctx, points, targets, 'admin removed', -1)
+
+        @self.bot.command(help="Export this server's balances as a CSV file. You can use !export balances or !export leaderboard.")
+        @self.is_bot_admin()
+        async def export(ctx, what: str = "balances"):
+            if what not in ("balances", "leaderboard"):
+                await ctx.send("Wrong syntax, it should be like this '!export balances' or '!export leaderboard'")
+                return
+            # Rows are streamed to a temporary file, so the export never sits in memory.
+            file = tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False)
+            try:
+                # Leased, a long export must not have its database evicted halfway.
+                async with self.guilds.lease(ctx.guild) as db:
+                    rows = db.iter_balances() if what == "balances" else db.iter_leaderboard()
+                    with file:
+                        count = await export_csv(rows, file)
+                await ctx.send(f"Exported {count} rows.", file=discord.File(file.name, filename=f"{what}.csv"))
+            finally:
+                os.remove(file.name)
+
+        @self.bot.command(help="Show where melpoints were earned and spent. You can use !economy <days>, or !economy <days> <reason> for the top users of a reason.")
+        @self.is_bot_admin()
+        async def economy(ctx, days: int = 7, *, reason: str = None):
+            if days < 1:
+                await ctx.send("Please give a number of days of at least 1.")
+                return
+            db = await self.guilds.get_db(ctx.guild)
+            # Day 1 is today, so the report covers whole UTC days.
+            since = (db.rollup_day(time.time()) - days + 1) * 86400
+            if reason is None:
+                rows = await db.get_economy(since)
+                title = f"Economy over the last {days} days"
+            else:
+                rows = []
+                for userid, earned, spent, count in await db.get_economy_users(reason, since):
+                    member = ctx.guild.get_member(int(userid)) if ctx.guild and userid.isdigit() else None
+                    rows.append((member.name if member else userid, earned, spent, count))
+                title = f"Top users for {reason} over the last {days} days"
+            if not rows:
+                await ctx.send("There are no events for that period.")
+                return
+            embed = discord.Embed(title=title, color=discord.Color.blue())
+            for name, earned, spent, count in rows[:25]:
+                embed.add_field(name=name or "(no reason)", value=f"+{earned} / -{spent} (net {earned - spent:+}), {count} events", inline=False)
+            await ctx.send(embed=embed)
+
+        @self.bot.command(help="Show the melpoint changes that failed to save and are waiting to be retried.")
+        @self.is_bot_admin()
+        async def outbox(ctx):
+            db = await self.guilds.get_db(ctx.guild)
+            if getattr(db, 'outbox', None) is None:
+                await ctx.send("This server's database has no outbox.")
+                return
+            metrics = db.outbox.metrics()
+            await ctx.send(
+                f"Waiting: {metrics['pending']} writes ({metrics['pending_events']} events). "
+                f"Saved on a retry: {metrics['applied']}, already saved: {metrics['duplicates']}, "
+                f"failed retries: {metrics['failed_retries']}, dropped: {metrics['dropped']}."
+            )
+
+        @self.bot.command(help="Back up this server's database now. You can use !backup, or !backup list to see the available backups.")
+        @self.is_bot_admin()
+        async def backup(ctx, action: str = None):
+            if not self.guilds.uses_sqlite(ctx.guild):
+                await ctx.send("Backups are only available for SQLite databases.")
+                return
+            db_path = self.guilds.get_db_path(ctx.guild)
+            if action == 'list':
+                # Backups are named after the file only, whatever directory db_name is in.
+                backups = self.backups.list_backups(os.path.splitext(os.path.basename(db_path))[0])
+                if len(backups) == 0:
+                    await ctx.send("There are no backups.")
+                else:
+                    await ctx.send("Backups:\n" + "\n".join(backups))
+                return
+            await self.guilds.get_db(ctx.guild)
+            try:
+                stats = await self.backups.backup(db_path)
+            except Exception as e:
+                logging.error(f"Backup of {db_path} failed: {e}")
+                await ctx.send(f"The backup failed: {e}")
+                return
+            await ctx.send(f"Backed up to {os.path.basename(stats['path'])} ({stats['bytes']} bytes in {stats['seconds']:.2f}s).")
+
+        @self.bot.command(help="Restore this server's database from a backup. You can use !restore_backup <backup_name>.")
+        @self.is_bot_admin()
+        async def restore_backup(ctx, backup_name: str):
+            if not self.guilds.uses_sqlite(ctx.guild):
+                await ctx.send("Backups are only available for SQLite databases.")
+                return
+            db_path = self.guilds.get_db_path(ctx.guild)
+            if backup_name not in self.backups.list_backups(os.path.splitext(os.path.basename(db_path))[0]):
+                await ctx.send(f"Backup {backup_name} does not exist. Use !backup list to see the available backups.")
+                return
+            await ctx.send(f"Restoring from {backup_name}, waiting for the database to be idle...")
+            # Nothing may have the file open while it is replaced: the workers have connections of their
+            # own and are stopped, and the gateway's backend (with its cached ids and outbox) is closed.
+            if self.workers:
+                await self.workers.stop()
+            try:
+                async with self.guilds.offline(ctx.guild):
+                    await self.backups.restore(backup_name, db_path)
+            except TimeoutError:
+                await ctx.send("The database is still in use, try again in a moment.")
+                return
+            finally:
+                if self.workers:
+                    self.workers.start()
+            # Opening it runs create_db, which migrates a backup from an older version of the schema.
+            await self.guilds.get_db(ctx.guild)
+            self.render_cache.invalidate(self.guilds.resolve_guild_id(ctx.guild))
+            await ctx.send(f"Restored the database from {backup_name}.")
+
 
@@ -1,10 +1,19 @@
 import json
 import random
 import asyncio
+import logging
 from discord.ext.commands import Bot
-from helpers.db_helper import DBHelper
+from helpers.guild_manager import GuildManager
 from datetime import datetime
 
+_config = None
+
+def get_config() -> dict:
+    global _config
+    if _config is None:
+        _config = json.load(open('games/blackjack.json'))
+    return _config
+
 class Card:
     def __init__(self, suit, rank):
         self.suit = suit
@@ -23,35 +32,71 @@ class Card:
             return f"{self.rank} of {self.suit}"
     
 class Deck:
-    def __init__(self):
+    def __init__(self, decks: int = 1):
+        self.decks = decks
         self.cards = []
         self.build()
 
     def build(self):
         suits = ['hearts', 'diamonds', 'clubs', 'spades']
         ranks = range(1, 14)
-        for suit in suits:
-            for rank in ranks:
-                self.cards.append(Card(suit, rank))
+        self.cards = []
+        for _ in range(self.decks):
+            for suit in suits:
+                for rank in ranks:
+                    self.cards.append(Card(suit, rank))
     
     def shuffle(self):
         random.shuffle(self.cards)
     
     def draw(self):
+        if not self.cards:
+            self.build()
+            self.shuffle()
         return self.cards.pop()
     
 class Player:
-    def __init__(self) -> None:
+    def __init__(self, name: str = "", bet: int = 0) -> None:
+        self.name = name
+        self.bet = bet
         self.hand = []
+        self.done = False
+        self.forfeited = False
 
 class Blackjack:
-    def __init__(self, initial_player_id: int) -> None:
-        self.config = json.load(open('games/blackjack.json'))
-        self.deck = Deck()
-        self.deck.shuffle()
+    """One table: every player plays against the same dealer hand, drawing from a shoe
+    that is shared by all tables of a channel."""
+    def __init__(self, shoe: Deck = None, guild_id: int = None) -> None:
+        self.config = get_config()
+        if shoe is None:
+            shoe = Deck()
+            shoe.shuffle()
+        self.deck = shoe
+        self.guild_id = guild_id
         self.players = {}
         self.players.update({"dealer": Player()}) 
-        self.players.update({initial_player_id: Player()}) 
+        self.started = False
+        self.changed = asyncio.Event()
+        # The task running the table; shutdown cancels it unless the table is already settling.
+        self.task = None
+        self.settling = False
+
+    def add_player(self, player_id: int, name: str, bet: int) -> bool:
+        """Seats the player, or returns False when the table is full or already dealt."""
+        if self.started or self.is_full():
+            return False
+        self.players.update({player_id: Player(name, bet)})
+        self.changed.set()
+        return True
+
+    def seated_players(self) -> list:
+        return [player_id for player_id in self.players if player_id != "dealer"]
+
+    def is_full(self) -> bool:
+        return len(self.seated_players()) >= self.config['max_players']
+
+    def is_finished(self) -> bool:
+        return all(self.players[player_id].done for player_id in self.seated_players())
 
     def calculate_score(self, player_id: int):
         score = 0
@@ -68,6 +113,7 @@ class Blackjack:
         return score
 
     def deal(self):
+        self.started = True
         for player in self.players:
             self.players[player].hand.append(self.deck.draw())
             self.players[player].hand.append(self.deck.draw())
@@ -75,12 +121,116 @@ class Blackjack:
     def hit(self, player_id: int):
         self.players[player_id].hand.append(self.deck.draw())
 
+    def stand(self, player_id: int):
+        self.players[player_id].done = True
+        self.changed.set()
+
+    def play_dealer(self) -> list:
+        # The dealer only draws if someone is still in the game.
+        drawn = []
+        if any(not self.players[player_id].forfeited and self.calculate_score(player_id) <= 21 for player_id in self.seated_players()):
+            while self.calculate_score("dealer") < 17:
+                self.hit("dealer")
+                drawn.append(self.players["dealer"].hand[-1])
+        return drawn
+
+    def settle(self) -> list:
+        """Returns (player_id, currency_change, message) for every player."""
+        results = []
+        dealer_score = self.calculate_score("dealer")
+        # Melpoints are whole numbers, a fractional payout is rounded down.
+        win = self.config["payout"] - 1
+        for player_id in self.seated_players():
+            player = self.players[player_id]
+            score = self.calculate_score(player_id)
+            if player.forfeited:
+                results.append((player_id, player.bet * -1, f"{player.name} - you did not act in time and forfeit your bet."))
+            elif score > 21:
+                results.append((player_id, player.bet * -1, f"{player.name} - you busted with {score} points."))
+            elif dealer_score > 21:
+                results.append((player_id, int(player.bet * win), f"{player.name} - you have {score} points. The dealer busted. You win!"))
+            elif score > dealer_score:
+                results.append((player_id, int(player.bet * win), f"{player.name} - you have {score} points. You win!"))
+            elif score < dealer_score:
+                results.append((player_id, player.bet * -1, f"{player.name} - you have {score} points. You lose!"))
+            else:
+                results.append((player_id, player.bet * -1, f"{player.name} - you have {score} points. It's a tie! But the house always wins."))
+        return results
+
+
+def add_bot_commands(bot: Bot, playing_blackjack: dict, guilds: GuildManager):
+    # Open tables wait for players to join until they are dealt; shoes outlive tables.
+    tables = {}
+    shoes = {}
 
-def add_bot_commands(bot: Bot, playing_blackjack: dict, db: DBHelper):
-    @bot.command(help="Play a game of blackjack for melpoints. Syntax: !blackjack <melpoints>")
+    def get_shoe(channel_id: int, config: dict) -> Deck:
+        shoe = shoes.get(channel_id)
+        if shoe is None or len(shoe.cards) < config['shoe_decks'] * 52 * config['reshuffle_at']:
+            shoe = Deck(config['shoe_decks'])
+            shoe.shuffle()
+            shoes[channel_id] = shoe
+        return shoe
+
+    async def run_table(channel_id: int, table: Blackjack, ctx):
+        config = table.config
+        try:
+            # Wait for the join window to close or the table to fill up.
+            deadline = asyncio.get_running_loop().time() + config['join_window']
+            while not table.is_full():
+                table.changed.clear()
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(table.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if tables.get(channel_id) is table:
+                tables.pop(channel_id)
+            table.deal()
+            lines = []
+            for player_id in table.seated_players():
+                player = table.players[player_id]
+                lines.append(f"{player.name} - you drew: {player.hand[0]} and {player.hand[1]} ({table.calculate_score(player_id)} points)")
+            await ctx.send("\n".join(lines) + f"""\nI drew: {table.players["dealer"].hand[0]} and something else.\n\nDo you want to !hit or !stand?""")
+
+            # Every action restarts the turn timer; whoever is left when it runs out forfeits the bet,
+            # as with the old blackjack timeout job.
+            while not table.is_finished():
+                table.changed.clear()
+                try:
+                    await asyncio.wait_for(table.changed.wait(), config['turn_timeout'])
+                except asyncio.TimeoutError:
+                    break
+            for player_id in table.seated_players():
+                player = table.players[player_id]
+                if not player.done:
+                    player.done = True
+                    player.forfeited = True
+
+            table.settling = True
+            drawn = table.play_dealer()
+            results = table.settle()
+            # Written before the results are sent, so a failed send (or a shutdown) does not lose them.
+            async with guilds.lease(table.guild_id) as db:
+                await db.add_events([(str(player_id), currency_change, 'blackjack') for player_id, currency_change, _ in results])
+            lines = [f"The dealer drew: {card}" for card in drawn]
+            lines.append(f"The dealer has {table.calculate_score('dealer')} points.")
+            lines.extend(message for _, _, message in results)
+            await ctx.send("\n".join(lines))
+        except Exception as e:
+            logging.error(f"Blackjack table in channel {channel_id} failed: {e}")
+        finally:
+            if tables.get(channel_id) is table:
+                tables.pop(channel_id)
+            for player_id in table.seated_players():
+                playing_blackjack.pop(player_id, None)
+
+    @bot.command(help="Play a game of blackjack for melpoints. Players in the same channel share a table. Syntax: !blackjack <melpoints>")
     async def blackjack(ctx, points: int = None):
         user_id = ctx.author.id
-        blackjack = Blackjack(user_id)
+        config = get_config()
+        db = await guilds.get_db(ctx.guild)
         user_points = await db.get_total_currency(str(user_id))
 
         # Validate points
@@ -90,21 +240,32 @@ def add_bot_commands(bot: Bot, playing_blackjack: dict, db: DBHelper):
         if points > user_points:
             await ctx.send(f"You do not have enough melpoints to bet {points} points. You have {user_points} melpoints.")
             return
-        if points < blackjack.config['min_bet']:
-            await ctx.send(f"The minimum bet is {blackjack.config['min_bet']} points.")
+        if points < config['min_bet']:
+            await ctx.send(f"The minimum bet is {config['min_bet']} points.")
             return
-        if points > blackjack.config['max_bet']:
-            await ctx.send(f"The maximum bet is {blackjack.config['max_bet']} points.")
+        if points > config['max_bet']:
+            await ctx.send(f"The maximum bet is {config['max_bet']} points.")
             return
 
         if user_id in playing_blackjack:
             await ctx.send("You are already playing a game of blackjack.")
             return
 
-        blackjack.deal()
-
-        await ctx.send(f"""{ctx.author.name} - you drew: {blackjack.players[user_id].hand[0]} and {blackjack.players[user_id].hand[1]}\nI drew: {blackjack.players["dealer"].hand[0]} and something else.\n\nYou have {blackjack.calculate_score(user_id)} points. Do you want to !hit or !stand?""")
-        playing_blackjack.update({user_id: {"bet": points, "game": blackjack, "ctx": ctx,"start_time": datetime.now().timestamp()}})
+        channel_id = ctx.channel.id
+        table = tables.get(channel_id)
+        # Checked and seated in one step, without awaiting anything, so joins in the same tick
+        # cannot overfill a table; a full table that is not dealt yet makes way for a new one.
+        opened = table is None or not table.add_player(user_id, ctx.author.name, points)
+        if opened:
+            table = Blackjack(get_shoe(channel_id, config), guilds.resolve_guild_id(ctx.guild))
+            tables[channel_id] = table
+            table.task = asyncio.create_task(run_table(channel_id, table, ctx))
+            table.add_player(user_id, ctx.author.name, points)
+        playing_blackjack.update({user_id: {"bet": points, "game": table, "ctx": ctx, "guild_id": table.guild_id, "start_time": datetime.now().timestamp()}})
+        if opened:
+            await ctx.send(f"{ctx.author.name} opened a blackjack table. Use !blackjack <melpoints> in the next {config['join_window']} seconds to join.")
+        else:
+            await ctx.send(f"{ctx.author.name} joined the blackjack table.")
 
     @bot.command()
     async def hit(ctx):
@@ -113,15 +274,20 @@ def add_bot_commands(bot: Bot, playing_blackjack: dict, db: DBHelper):
             await ctx.send("You are not playing blackjack.")
             return
         blackjack = playing_blackjack[user_id]["game"]
+        if not blackjack.started:
+            await ctx.send("The cards have not been dealt yet.")
+            return
+        if blackjack.players[user_id].done:
+            await ctx.send(f"{ctx.author.name} - you are done for this round, wait for the dealer.")
+            return
         blackjack.hit(user_id)
         score = blackjack.calculate_score(user_id)
         if score > 21:
             await ctx.send(f"{ctx.author.name} - you drew: {blackjack.players[user_id].hand[-1]}\n\nYou have {score} points. You busted!")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * -1, 'blackjack')
-            playing_blackjack.pop(user_id)
+            blackjack.stand(user_id)
             return
         await ctx.send(f"{ctx.author.name} - you drew: {blackjack.players[user_id].hand[-1]}\n\nYou have {score} points. Do you want to !hit or !stand?")
-        playing_blackjack[user_id].update({"game": blackjack})
+        blackjack.changed.set()
 
     @bot.command()
     async def stand(ctx):
@@ -130,26 +296,12 @@ def add_bot_commands(bot: Bot, playing_blackjack: dict, db: DBHelper):
             await ctx.send("You are not playing blackjack.")
             return
         blackjack = playing_blackjack[user_id]["game"]
-        user_score = blackjack.calculate_score(user_id)
-        dealer_score = blackjack.calculate_score("dealer")
-        while dealer_score < 17:
-            blackjack.hit("dealer")
-            await ctx.send(f"The dealer drew: {blackjack.players['dealer'].hand[-1]}")
-            dealer_score = blackjack.calculate_score("dealer")
-            await asyncio.sleep(0.5)
-        if dealer_score > 21:
-            await ctx.send(f"{ctx.author.name} - you have {user_score} points. The dealer busted with {dealer_score} points. You win!")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * (blackjack.config["payout"] - 1), 'blackjack')
-        elif user_score > dealer_score:
-            await ctx.send(f"{ctx.author.name} - you have {user_score} points. The dealer has {dealer_score} points. You win!")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * (blackjack.config["payout"] - 1), 'blackjack')
-        elif user_score < dealer_score:
-            await ctx.send(f"{ctx.author.name} - you have {user_score} points. The dealer has {dealer_score} points. You lose!")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * -1, 'blackjack')
-        elif user_score == 21 and len(blackjack.players[user_id].hand) == 2 and user_score > dealer_score:
-            await ctx.send(f"{ctx.author.name} - you have {user_score} points. You got a blackjack! You win!")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * (blackjack.config["payout"] - 1), 'blackjack')
-        else:
-            await ctx.send(f"{ctx.author.name} - you have {user_score} points. The dealer has {dealer_score} points. It's a tie! But the house always wins.")
-            await db.add_event(user_id, playing_blackjack[user_id]["bet"] * -1, 'blackjack')
-        playing_blackjack.pop(user_id)
\ No newline at end of file
+        if not blackjack.started:
+            await ctx.send("The cards have not been dealt yet.")
+            return
+        if blackjack.players[user_id].done:
+            await ctx.send(f"{ctx.author.name} - you are done for this round, wait for the dealer.")
+            return
+        blackjack.stand(user_id)
+        if not blackjack.is_finished():
+            await ctx.send(f"{ctx.author.name} - you stand with {blackjack.calculate_score(user_id)} points.")
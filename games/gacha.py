@@ -6,98 +6,324 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
 
 import json
+import time
 import logging
-import random
+import bisect
 from datetime import datetime
-from helpers.db_helper import DBHelper
+from typing import TYPE_CHECKING
+from helpers.storage_backend import StorageBackend
+from helpers.guild_manager import GuildManager
 from discord.ext.commands import Bot
 from helpers.gdrive_helper import GDriveHelper
 
+if TYPE_CHECKING:
+    # numpy is imported where it is used, so loading the bot does not load it.
+    import numpy as np
+
+def five_star_rate(config: dict, pulls: int) -> float:
+    soft_pity = config['five_star_soft_pity']
+    hard_pity = config['five_star_pity']
+    premium_rate = config['five_star_rate']
+    if pulls < soft_pity:
+        return config['five_star_rate']
+    elif soft_pity <= pulls < hard_pity:
+        return max(0, pulls - soft_pity) * (1 - premium_rate) / (hard_pity - soft_pity) + premium_rate
+    else:
+        return 1.0
+
+class PityTable:
+    """Rates of one gacha config for every pity value up to hard pity.
+
+    resolve_one is the scalar path for a single roll. resolve gives the same results
+    for a whole batch of rolls, carrying the 4 and 5 star pity from roll to roll.
+    """
+    def __init__(self, config: dict) -> None:
+        import numpy as np
+        self.hard_pity = config['five_star_pity']
+        self.five_star = np.array([five_star_rate(config, pulls) for pulls in range(self.hard_pity + 1)])
+        self.four_star_rate = config['four_star_rate']
+        self.four_star_pity = config['four_star_pity']
+
+    def five_star_rate(self, pulls: int) -> float:
+        return float(self.five_star[min(pulls, self.hard_pity)])
+
+    def resolve_one(self, roll: float, pity_4: int, pity_5: int) -> int:
+        if roll <= self.five_star_rate(pity_5):
+            return 5
+        elif roll <= self.four_star_rate or pity_4 >= self.four_star_pity:
+            return 4
+        else:
+            return 3
+
+    def resolve(self, rolls: "np.ndarray", pity_4: int, pity_5: int) -> tuple:
+        """Returns the rarity of every roll and the 4 and 5 star pity after the last one."""
+        import numpy as np
+        rolls = np.asarray(rolls, dtype=np.float64)
+        n = len(rolls)
+
+        # 5 star pulls only depend on the 5 star pity. A 5 star is guaranteed within
+        # hard pity, so each search only looks at the next hard_pity + 1 rolls.
+        five = np.zeros(n, dtype=bool)
+        pos = 0
+        while pos < n:
+            window = min(n - pos, max(1, self.hard_pity - pity_5 + 1))
+            rates = self.five_star[np.minimum(pity_5 + np.arange(window), self.hard_pity)]
+            hits = np.flatnonzero(rolls[pos:pos + window] <= rates)
+            if len(hits) == 0:
+                pity_5 += window
+                pos += window
+            else:
+                five[pos + hits[0]] = True
+                pity_5 = 0
+                pos += hits[0] + 1
+
+        # A 4 star is either a lucky roll or forced by pity on the first pull that is not a 5 star.
+        # The walk only stops on 4 star pulls; plain lists make each step cheap.
+        natural = np.flatnonzero((rolls <= self.four_star_rate) & ~five).tolist()
+        not_five = np.flatnonzero(~five).tolist()
+        fours = []
+        pos = 0
+        while pos < n:
+            i = bisect.bisect_left(not_five, pos + max(0, self.four_star_pity - pity_4))
+            forced = not_five[i] if i < len(not_five) else n
+            j = bisect.bisect_left(natural, pos)
+            lucky = natural[j] if j < len(natural) else n
+            hit = min(forced, lucky)
+            if hit >= n:
+                pity_4 += n - pos
+                break
+            fours.append(hit)
+            pity_4 = 0
+            pos = hit + 1
+
+        rarities = np.full(n, 3, dtype=np.int8)
+        rarities[five] = 5
+        rarities[fours] = 4
+        return rarities, pity_4, pity_5
+
+_pity_tables = {}
+
+def get_pity_table(config: dict) -> PityTable:
+    # Tables are built once per config version.
+    key = json.dumps(config, sort_keys=True)
+    if key not in _pity_tables:
+        _pity_tables[key] = PityTable(config)
+    return _pity_tables[key]
+
+class RewardPool:
+    """Rewards of one rarity as (name, link) entries, drawn in O(1) with Vose's alias method."""
+    def __init__(self, entries: tuple, weights: list) -> None:
+        import numpy as np
+        self.entries = entries
+        n = len(entries)
+        scaled = [weight * n / sum(weights) for weight in weights]
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+    def sample(self, rng: "np.random.Generator", count: int) -> "np.ndarray":
+        import numpy as np
+        columns = rng.integers(0, len(self.entries), count)
+        keep = rng.random(count) < self.prob[columns]
+        return np.where(keep, columns, self.alias[columns])
+
+class RewardPools:
+    """Reward pool of every rarity, built from one Drive file listing.
+
+    Rewards are the files in the "N Stars" folders. "reward_weights" in gacha.json
+    maps reward names to weights (default 1); a weight of 0 disables a reward.
+    Missing folders and empty pools are logged when the pools are built.
+    """
+    def __init__(self, gdrive_files: list, weights: dict, rarities: tuple = (3, 4, 5)) -> None:
+        started = time.perf_counter()
+        folders = {}
+        children = {}
+        for file in gdrive_files:
+            folders.setdefault(file['name'], file['id'])
+            for parent in file.get('parents', []):
+                children.setdefault(parent, []).append(file)
+        self.pools = {}
+        self.missing = []
+        for rarity in rarities:
+            folder_id = folders.get(f"{rarity} Stars")
+            if folder_id is None:
+                logging.error(f"Folder for {rarity} stars not found.")
+                self.missing.append(rarity)
+                continue
+            rewards = [file for file in children.get(folder_id, []) if weights.get(file['name'], 1) > 0]
+            if not rewards:
+                logging.error(f"No rewards found for {rarity} stars.")
+                self.missing.append(rarity)
+                continue
+            entries = tuple((file['name'], file['webViewLink']) for file in rewards)
+            self.pools[rarity] = RewardPool(entries, [weights.get(file['name'], 1) for file in rewards])
+        sizes = ", ".join(f"{rarity} stars: {len(pool.entries)}" for rarity, pool in self.pools.items())
+        logging.info(f"Built gacha reward pools from {len(gdrive_files)} files in {(time.perf_counter() - started) * 1000:.1f}ms ({sizes}).")
+
+    def draw(self, rarity: int, rng: "np.random.Generator", count: int = 1) -> list:
+        pool = self.pools[rarity]
+        return [pool.entries[i] for i in pool.sample(rng, count).tolist()]
+
+_reward_pools = (None, None)
+
+def get_reward_pools(gdrive_files: list, config: dict) -> RewardPools:
+    # Pools are rebuilt only when the Drive listing or the weights change.
+    global _reward_pools
+    weights = config.get('reward_weights', {})
+    key = (
+        json.dumps(weights, sort_keys=True),
+        tuple((file['id'], file['name'], tuple(file.get('parents', [])), file.get('webViewLink')) for file in gdrive_files)
+    )
+    if _reward_pools[0] != key:
+        _reward_pools = (key, RewardPools(gdrive_files, weights))
+    return _reward_pools[1]
+
 class Gacha:
-    def __init__(self, db: DBHelper, user: int) -> None:
+    def __init__(self, db: StorageBackend, user: int, rng: "np.random.Generator" = None) -> None:
+        import numpy as np
         self.db = db
         self.user = user
         self.config = json.load(open('games/gacha.json'))
+        self.pity_table = get_pity_table(self.config)
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     async def _get_pity(self):
         self.pity_4, self.pity_5 = await self.db.get_pity(self.user)
 
-    async def _update_db(self, reward_name: str, reward: int):
-        await self.db.add_event(self.user, self.config['pull_price'] * -1, 'gacha')
-        await self.db.add_gacha_event(self.user, reward, reward_name, datetime.now().timestamp())
-
-    async def _five_star_pity(self, pulls: int) -> float:
-        soft_pity = self.config['five_star_soft_pity']
-        hard_pity = self.config['five_star_pity']
-        premium_rate = self.config['five_star_rate']
-        if pulls < soft_pity:
-            return self.config['five_star_rate']
-        elif soft_pity <= pulls < hard_pity:
-            return max(0, pulls - soft_pity) * (1 - premium_rate) / (hard_pity - soft_pity) + premium_rate
-        else:
-            return 1.0
-        
-    async def get_reward(self, rarity: int, gdrive_files: list) -> str:
-        for file in gdrive_files:
-            if file['name'] == f"{rarity} Stars":
-                parent_folder = file["id"]
-                break
-        if not parent_folder:
-            logging.error(f"Folder for {rarity} stars not found.")
-            return "Parent folder not found."
-        potential_rewards = [file for file in gdrive_files if parent_folder in file.get("parents", [])]
-        if not potential_rewards or len(potential_rewards) == 0:
-            logging.error(f"No rewards found for {rarity} stars.")
-            return "No rewards found."
-        reward = random.choice(potential_rewards)
-        return reward["webViewLink"], reward["name"]
-
-    async def pull(self, gdrive_files: list):
+    async def _update_db(self, rewards: list):
+        # The points and the pulls are written together, one transaction (or one log record) for the whole batch.
+        # Pity is counted by timestamp, so every pull of the batch needs its own.
+        timestamp = datetime.now().timestamp()
+        await self.db.add_gacha_events(
+            [(self.user, self.config['pull_price'] * -1, 'gacha')] * len(rewards),
+            [(self.user, reward, reward_name, timestamp + i * 1e-6) for i, (reward, reward_name) in enumerate(rewards)]
+        )
+
+    def get_reward(self, rarity: int, pools: RewardPools) -> tuple:
+        reward_name, reward_link = pools.draw(rarity, self.rng)[0]
+        return reward_link, reward_name
+
+    async def pull(self, pools: RewardPools):
         await self._get_pity()
-        roll = random.random()
-        print(f"Roll: {roll}")
-        if roll <= await self._five_star_pity(self.pity_5):
-            reward = 5
-        elif roll <= self.config['four_star_rate'] or self.pity_4 >= self.config['four_star_pity']:
-            reward = 4
-        else:
-            reward = 3
-        reward_link, reward_name = await self.get_reward(reward, gdrive_files)
-        await self._update_db(reward_name, reward)
+        roll = self.rng.random()
+        logging.debug(f"Gacha roll {roll} for {self.user}.")
+        reward = self.pity_table.resolve_one(roll, self.pity_4, self.pity_5)
+        reward_link, reward_name = self.get_reward(reward, pools)
+        await self._update_db([(reward, reward_name)])
         return (reward, reward_link)
 
-def add_bot_commands(bot: Bot, db: DBHelper):
-    @bot.command(help="Pull from the gacha. You can use !pull to pull from the gacha.")
-    async def gacha(ctx, amt: int|str = 1):
-        user_id = str(ctx.author.id)
+    async def pull_many(self, amount: int, pools: RewardPools) -> list:
+        import numpy as np
+        await self._get_pity()
+        rarities, self.pity_4, self.pity_5 = self.pity_table.resolve(self.rng.random(amount), self.pity_4, self.pity_5)
+        # Draw the rewards of each rarity in one go, then put them back in pull order.
+        drawn = {int(rarity): iter(pools.draw(rarity, self.rng, int(count))) for rarity, count in zip(*np.unique(rarities, return_counts=True))}
+        results = []
+        rewards = []
+        for reward in rarities.tolist():
+            reward_name, reward_link = next(drawn[reward])
+            results.append((reward, reward_link))
+            rewards.append((reward, reward_name))
+        await self._update_db(rewards)
+        return results
+
+async def pull_job(context, guild_id: int, user_id: str, amount: int|str) -> dict:
+    """Runs a gacha pull for the user. Takes and returns plain data, so it can run in a worker process.
+
+    Returns {"error": message} or {"rewards": [(stars, link)], "drive_file": the Drive file of a single reward}.
+    """
+    # Leased, fetching the Drive listing can outlast database_min_idle.
+    async with context.guilds.lease(guild_id) as db:
         gacha = Gacha(db, user_id)
         user_points = await db.get_total_currency(user_id)
-        if amt == 'max':
-            amt = user_points // gacha.config['pull_price']
-        if user_points < gacha.config['pull_price'] * amt:
-            await ctx.send(f"{ctx.author} - You don't have enough points to pull from the gacha.")
+        if amount == 'max':
+            amount = user_points // gacha.config['pull_price']
+        else:
+            try:
+                amount = int(amount)
+            except (TypeError, ValueError):
+                return {"error": "Please pull a number of times, or max."}
+            if amount < 1:
+                return {"error": "You have to pull at least once."}
+        if amount < 1 or user_points < gacha.config['pull_price'] * amount:
+            return {"error": "You don't have enough points to pull from the gacha."}
+        gdrive_files = await asyncio.to_thread(context.gdrive.get_files)
+        pools = get_reward_pools(gdrive_files, gacha.config)
+        if pools.missing:
+            return {"error": "Something went wrong with the gacha pull. Please contact an admin."}
+        if amount == 1:
+            total_rewards = [await gacha.pull(pools)]
+        else:
+            total_rewards = await gacha.pull_many(amount, pools)
+        drive_file = None
+        if len(total_rewards) == 1:
+            reward_link = total_rewards[0][1]
+            drive_file = next((file for file in gdrive_files if file.get('webViewLink') == reward_link), None)
+        return {"rewards": total_rewards, "drive_file": drive_file}
+
+def add_bot_commands(bot: Bot, guilds: GuildManager, get_attachment, run_job):
+    @bot.command(help="Pull from the gacha. You can use !pull to pull from the gacha.")
+    async def gacha(ctx, amt: int|str = 1):
+        result = await run_job(ctx.author.id, "gacha", guild_id=guilds.resolve_guild_id(ctx.guild), user_id=str(ctx.author.id), amount=amt)
+        if "error" in result:
+            await ctx.send(f"{ctx.author} - {result['error']}")
             return
-        gdrive_files = GDriveHelper().get_files()
-        total_rewards = [await gacha.pull(gdrive_files) for _ in range(amt)]
+        total_rewards = result["rewards"]
         if len(total_rewards) == 1:
             reward, reward_link = total_rewards[0]
             await ctx.send(f"{ctx.author} - You pulled and got a {reward} stars reward.")
-            await ctx.author.send(f"Congratulations! You just got a {reward} stars pull!\n"+reward_link)
+            # Send the reward itself when it is small enough, so popular rewards come from the local cache.
+            attachment = await get_attachment(result["drive_file"])
+            if attachment is not None:
+                await ctx.author.send(f"Congratulations! You just got a {reward} stars pull!", file=attachment)
+            else:
+                await ctx.author.send(f"Congratulations! You just got a {reward} stars pull!\n"+reward_link)
         elif len(total_rewards) < 1:
             await ctx.send(f"{ctx.author} - Something went wrong with the gacha pull. Please contact an admin.")
         else:
             list_of_links = [f"{reward[0]} stars: {reward[1]}\n" for reward in total_rewards]
             best_reward = max([reward[0] for reward in total_rewards])
-            await ctx.send(f"{ctx.author} - You pulled {amt} times! Your best pull was a {best_reward} stars reward.")
+            await ctx.send(f"{ctx.author} - You pulled {len(total_rewards)} times! Your best pull was a {best_reward} stars reward.")
             await ctx.author.send(f"Congratulations! You just got all of these pulls!\n"+"\n".join(list_of_links))
 
 if __name__ == '__main__':
-    db = DBHelper("gacha_test.db")
-    gacha = Gacha(db, 1)
+    import numpy as np
+    config = json.load(open('games/gacha.json'))
+    table = get_pity_table(config)
+    for i in range(config['five_star_pity'] + 1):
+        print(f"Chances to get a 5 star on pull number {i}: {table.five_star_rate(i)}")
+
+    # The batch path must give exactly the scalar results for the same rolls.
+    rng = np.random.default_rng(1234)
+    for pity_4, pity_5 in [(0, 0), (9, 74), (12, 89), (3, 120)]:
+        rolls = rng.random(20000)
+        expected = []
+        scalar_4, scalar_5 = pity_4, pity_5
+        for roll in rolls.tolist():
+            reward = table.resolve_one(roll, scalar_4, scalar_5)
+            expected.append(reward)
+            scalar_4 = 0 if reward == 4 else scalar_4 + 1
+            scalar_5 = 0 if reward == 5 else scalar_5 + 1
+        rarities, batch_4, batch_5 = table.resolve(rolls, pity_4, pity_5)
+        assert rarities.tolist() == expected and (batch_4, batch_5) == (scalar_4, scalar_5), (pity_4, pity_5)
+    print("Batch rolls match the scalar path.")
 
-    async def main():
-        for i in range(gacha.config['five_star_pity'] + 1):
-            chance = await gacha._five_star_pity(i)
-            print(f"Chances to get a 5 star on pull number {i}: {chance}")
+    rolls = rng.random(10000)
+    started = time.perf_counter()
+    rarities, _, _ = table.resolve(rolls, 0, 0)
+    elapsed = time.perf_counter() - started
+    print(f"Resolved 10000 pulls in {elapsed * 1000:.2f}ms: {np.bincount(rarities, minlength=6)[3:].tolist()} 3/4/5 stars")
 
-    asyncio.run(main())
\ No newline at end of file
+    # Weighted rewards are drawn in proportion to their weights.
+    files = [{'id': 'f4', 'name': '4 Stars'}, {'id': 'f5', 'name': '5 Stars'}]
+    files += [{'id': name, 'name': name, 'parents': ['f4'], 'webViewLink': name} for name in ('common', 'rare', 'off')]
+    pools = RewardPools(files, {'rare': 3, 'off': 0})
+    names = [name for name, _ in pools.draw(4, rng, 100000)]
+    print(f"Missing pools: {pools.missing}, common/rare draws: {names.count('common')}/{names.count('rare')} (expected 1:3)")
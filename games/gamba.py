@@ -1,7 +1,7 @@
 import random
 import os
 import json
-from helpers.db_helper import DBHelper
+from helpers.guild_manager import GuildManager
 from discord.ext.commands import Bot
 
 def gamba_odds(value: int) -> int:
@@ -10,39 +10,51 @@ def gamba_odds(value: int) -> int:
     else:
         return 0
 
-config = json.load(open('games/gamba.json'))
+_config = None
 
-def add_bot_commands(bot: Bot, db: DBHelper):    
+def get_config() -> dict:
+    global _config
+    if _config is None:
+        _config = json.load(open('games/gamba.json'))
+    return _config
+
+async def gamble_job(context, guild_id: int, user_id: str, points: int|str) -> dict:
+    """Runs a gamble for the user. Takes and returns plain data, so it can run in a worker process.
+
+    Returns {"error": message} for invalid bets or {"result": message}.
+    """
+    config = get_config()
+    db = await context.guilds.get_db(guild_id)
+    user_points = await db.get_total_currency(user_id)
+    # Handle string inputs
+    if type(points) == str:
+        if points.lower() == 'all':
+            points = user_points
+        elif points.lower() == 'half':
+            points = user_points // 2
+        elif points.lower() == 'max':
+            points = min(user_points, config.get("gamble_limit"))
+        else:
+            return {"error": "Wrong syntax, it should be like this '!gamble 100' or '!gamble all'"}
+    if points > user_points:
+        return {"error": f"You do not have enough points to gamble {points} points. You have {user_points} points."}
+    if points < 0:
+        return {"error": "You cannot gamble a negative number of points."}
+    if points == 0:
+        return {"error": "You cannot gamble 0 points."}
+    if points > config.get("gamble_limit"):
+        return {"error": f"You can't bet more than {config.get('gamble_limit')} points."}
+    earned_points = gamba_odds(points)
+    await db.add_event(user_id, earned_points - points, 'gamble')
+    if earned_points == 0:
+        return {"result": f"You lost {points} points."}
+    return {"result": f"You won {earned_points} points."}
+
+def add_bot_commands(bot: Bot, guilds: GuildManager, run_job):
     @bot.command(help="Gamble your melpoints. You can use !gamble <number> to gamble a specific number of melpoints.")
     async def gamble(ctx, points: int|str):
-        user_id = str(ctx.author.id)
-        user_points = await db.get_total_currency(user_id)
-        # Handle string inputs
-        if type(points) == str:
-            if points.lower() == 'all':
-                points = user_points
-            elif points.lower() == 'half':
-                points = user_points // 2
-            elif points.lower() == 'max':
-                points = min(user_points, config.get("gamble_limit"))
-            else:
-                await ctx.send("Wrong syntax, it should be like this '!gamble 100' or '!gamble all'")
-                return
-        if points > user_points:
-            await ctx.send(f"You do not have enough points to gamble {points} points. You have {user_points} points.")
-            return
-        if points < 0:
-            await ctx.send("You cannot gamble a negative number of points.")
-            return
-        if points == 0:
-            await ctx.send("You cannot gamble 0 points.")
-            return
-        if points > config.get("gamble_limit"):
-            await ctx.send(f"You can't bet more than {config.get("gamble_limit")} points.")
-            return
-        earned_points = gamba_odds(points)
-        await db.add_event(user_id, earned_points - points, 'gamble')
-        if earned_points == 0:
-            await ctx.send(f"{ctx.author} - You lost {points} points.")
+        result = await run_job(ctx.author.id, "gamble", guild_id=guilds.resolve_guild_id(ctx.guild), user_id=str(ctx.author.id), points=points)
+        if "error" in result:
+            await ctx.send(result["error"])
         else:
-            await ctx.send(f"{ctx.author} - You won {earned_points} points.")
\ No newline at end of file
+            await ctx.send(f"{ctx.author} - {result['result']}")
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import contextlib
+from helpers.gdrive_helper import GDriveHelper
+
+
+class _HashingWriter:
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.file.write(data)
+
+
+class AssetCache:
+    """Content-addressed local cache of Drive files.
+
+    Blobs are stored under their md5 and Drive file ids map onto them, so two Drive
+    files with the same content share one blob. A cached file is reused as long as its
+    md5 matches the one Drive reports; when the caller has no fresh md5 the cache
+    trusts its entry for "revalidate_after" seconds and then asks Drive for the file's
+    metadata only, downloading again only if the content changed. Least recently used
+    blobs are evicted once the cache grows past "max_bytes", except blobs that are
+    being handed out at that moment.
+    """
+    def __init__(self, gdrive: GDriveHelper, directory: str, max_bytes: int = 1024 ** 3, revalidate_after: int = 3600):
+        self.gdrive = gdrive
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.index_path = os.path.join(directory, "index.json")
+        self.files = {}
+        self.blobs = {}
+        # Lock and number of users per key; a lock is dropped once nobody waits on it.
+        self.locks = {}
+        # Callers being handed each blob; those blobs are never evicted.
+        self.pins = {}
+        self.save_lock = asyncio.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revalidations": 0, "evictions": 0}
+        self._load_index()
+
+    def _load_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as file:
+                index = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Asset cache index is unreadable, starting empty: {e}")
+            return
+        self.blobs = {md5: blob for md5, blob in index.get("blobs", {}).items() if os.path.exists(self._blob_path(md5))}
+        self.files = {file_id: entry for file_id, entry in index.get("files", {}).items() if entry["md5"] in self.blobs}
+
+    def _write_index(self, index: str):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(index)
+        os.replace(temp_path, self.index_path)
+
+    async def _save_index(self):
+        index = json.dumps({"files": self.files, "blobs": self.blobs})
+        async with self.save_lock:
+            await asyncio.to_thread(self._write_index, index)
+
+    def _blob_path(self, md5: str) -> str:
+        return os.path.join(self.directory, md5)
+
+    def total_bytes(self) -> int:
+        return sum(blob["size"] for blob in self.blobs.values())
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def _unpin(self, md5: str):
+        self.pins[md5] -= 1
+        if self.pins[md5] == 0:
+            del self.pins[md5]
+
+    async def get(self, drive_file: dict) -> str:
+        """Returns the local path of a Drive file, downloading it only if needed.
+
+        drive_file is a Drive file resource with at least an "id"; "md5Checksum" is used
+        for validation when present. Files without content (Google Docs) return None.
+        The blob can be evicted once this returns; use open to read it safely.
+        """
+        md5 = await self._get_pinned(drive_file)
+        if md5 is None:
+            return None
+        self._unpin(md5)
+        return self._blob_path(md5)
+
+    async def open(self, drive_file: dict):
+        """Like get, but returns the file opened for reading, so a later eviction cannot take it away."""
+        md5 = await self._get_pinned(drive_file)
+        if md5 is None:
+            return None
+        try:
+            return open(self._blob_path(md5), 'rb')
+        finally:
+            self._unpin(md5)
+
+    async def _get_pinned(self, drive_file: dict) -> str:
+        # Returns the md5 of the file's blob, pinned until the caller unpins it.
+        file_id = drive_file['id']
+        if drive_file.get('mimeType', '').startswith('application/vnd.google-apps'):
+            return None
+        async with self._lock(("file", file_id)):
+            md5 = drive_file.get('md5Checksum')
+            entry = self.files.get(file_id)
+            if md5 is None:
+                if entry is not None and time.time() - entry["validated"] < self.revalidate_after:
+                    md5 = entry["md5"]
+                else:
+                    self.stats["revalidations"] += 1
+                    metadata = await asyncio.to_thread(self.gdrive.get_file_metadata, file_id)
+                    md5 = metadata.get('md5Checksum')
+                    if md5 is None:
+                        return None
+            if entry is not None and entry["md5"] == md5:
+                self.stats["hits"] += 1
+                entry["validated"] = time.time()
+                self.blobs[md5]["last_used"] = time.time()
+                self.pins[md5] = self.pins.get(md5, 0) + 1
+                return md5
+            self.stats["misses"] += 1
+            # Blobs are per content, so Drive files with the same content share the download.
+            async with self._lock(("blob", md5)):
+                if md5 not in self.blobs:
+                    size = await asyncio.to_thread(self._download, file_id, md5)
+                    self.blobs[md5] = {"size": size, "last_used": time.time()}
+                self.pins[md5] = self.pins.get(md5, 0) + 1
+            self.blobs[md5]["last_used"] = time.time()
+            self.files[file_id] = {"md5": md5, "validated": time.time()}
+            self._evict()
+            try:
+                await self._save_index()
+            except Exception:
+                self._unpin(md5)
+                raise
+            return md5
+
+    def _download(self, file_id: str, md5: str) -> int:
+        started = time.perf_counter()
+        temp_path = self._blob_path(md5) + ".part"
+        try:
+            with open(temp_path, 'wb') as file:
+                writer = _HashingWriter(file)
+                self.gdrive.download_to(file_id, writer)
+            if writer.md5.hexdigest() != md5:
+                raise ValueError(f"Downloaded file {file_id} does not match its md5 {md5}.")
+            os.replace(temp_path, self._blob_path(md5))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        size = os.path.getsize(self._blob_path(md5))
+        logging.info(f"Cached Drive file {file_id} ({size} bytes) in {time.perf_counter() - started:.2f}s.")
+        return size
+
+    def _evict(self):
+        total = self.total_bytes()
+        for md5 in sorted(self.blobs, key=lambda md5: self.blobs[md5]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if md5 in self.pins:
+                continue
+            total -= self.blobs.pop(md5)["size"]
+            self.files = {file_id: entry for file_id, entry in self.files.items() if entry["md5"] != md5}
+            try:
+                os.remove(self._blob_path(md5))
+            except FileNotFoundError:
+                pass
+            self.stats["evictions"] += 1
+
+    async def open_attachment(self, drive_file: dict, max_bytes: int):
+        """Like open, but returns None instead of raising, and for files too big to attach."""
+        if drive_file is None or int(drive_file.get('size', 0)) > max_bytes:
+            return None
+        try:
+            return await self.open(drive_file)
+        except Exception as e:
+            logging.error(f"Failed to fetch {drive_file.get('name')} from the asset cache: {e}")
+            return None
@@ -0,0 +1,197 @@
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+class BackupHelper:
+    """Online snapshots of the SQLite databases.
+
+    Snapshots use SQLite's backup API from a separate connection in a worker thread,
+    copying "pages_per_step" pages at a time and sleeping "step_sleep" seconds in
+    between. In WAL mode (DBHelper's default) the copy reads from one pinned snapshot,
+    so writers are never blocked and the copy never restarts. In rollback journal mode
+    the source is only locked for one step at a time, but a write from another
+    connection makes SQLite restart the copy; after "max_restarts" restarts the copy
+    is done in a single step instead.
+    Every snapshot is checked with PRAGMA integrity_check, then optionally gzipped,
+    and only the newest "keep" snapshots of each database are kept.
+    """
+    def __init__(self, backup_dir: str = "backups", pages_per_step: int = 256, step_sleep: float = 0.01, max_restarts: int = 5, keep: int = 7, compress: bool = True):
+        self.backup_dir = backup_dir
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        self.max_restarts = max_restarts
+        self.keep = keep
+        self.compress = compress
+
+    def _copy(self, source_path: str, target_path: str, pages: int) -> dict:
+        stats = {"steps": 0, "restarts": 0, "pages": 0}
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal last_remaining
+            stats["steps"] += 1
+            stats["pages"] = total
+            if last_remaining is not None and remaining > last_remaining:
+                stats["restarts"] += 1
+                if stats["restarts"] > self.max_restarts:
+                    raise _TooManyRestarts()
+            last_remaining = remaining
+            time.sleep(self.step_sleep)
+
+        source = sqlite3.connect(source_path, timeout=30)
+        target = sqlite3.connect(target_path)
+        try:
+            if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                # An open read transaction pins the snapshot the copy is made from.
+                source.execute('BEGIN')
+                source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=pages, progress=progress)
+        finally:
+            target.close()
+            source.close()
+        return stats
+
+    def _snapshot(self, source_path: str) -> dict:
+        os.makedirs(self.backup_dir, exist_ok=True)
+        base_name = os.path.splitext(os.path.basename(source_path))[0]
+        target_path = os.path.join(self.backup_dir, f"{base_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+        started = time.perf_counter()
+        try:
+            stats = self._copy(source_path, target_path, self.pages_per_step)
+        except _TooManyRestarts:
+            logging.warning(f"Backup of {source_path} kept restarting, copying it in one step.")
+            os.remove(target_path)
+            stats = self._copy(source_path, target_path, -1)
+        stats["seconds"] = time.perf_counter() - started
+        stats["bytes"] = os.path.getsize(target_path)
+
+        check = sqlite3.connect(target_path)
+        try:
+            integrity = check.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            check.close()
+        if integrity != 'ok':
+            os.remove(target_path)
+            raise RuntimeError(f"Backup of {source_path} failed the integrity check: {integrity}")
+
+        if self.compress:
+            with open(target_path, 'rb') as source, gzip.open(target_path + '.gz', 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.remove(target_path)
+            target_path += '.gz'
+        stats["path"] = target_path
+        self._rotate(base_name)
+        logging.info(
+            f"Backed up {source_path} to {target_path}: {stats['bytes']} bytes in {stats['seconds']:.2f}s "
+            f"({stats['bytes'] / max(stats['seconds'], 1e-9) / 1024 / 1024:.1f} MiB/s, {stats['steps']} steps, {stats['restarts']} restarts)."
+        )
+        return stats
+
+    def list_backups(self, base_name: str) -> list:
+        if not os.path.isdir(self.backup_dir):
+            return []
+        # Timestamps in the names sort chronologically.
+        return sorted(
+            name for name in os.listdir(self.backup_dir)
+            if name.startswith(base_name + '-') and (name.endswith('.db') or name.endswith('.db.gz'))
+        )
+
+    def _rotate(self, base_name: str):
+        backups = self.list_backups(base_name)
+        for name in backups[:max(0, len(backups) - self.keep)]:
+            os.remove(os.path.join(self.backup_dir, name))
+            logging.info(f"Removed old backup {name}.")
+
+    def _restore(self, backup_name: str, target_path: str):
+        backup_path = os.path.join(self.backup_dir, os.path.basename(backup_name))
+        if not os.path.exists(backup_path):
+            raise FileNotFoundError(f"Backup {backup_name} does not exist.")
+        if backup_path.endswith('.gz'):
+            source_path = backup_path[:-len('.gz')] + '.restore'
+            with gzip.open(backup_path, 'rb') as source, open(source_path, 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+        else:
+            source_path = backup_path
+        try:
+            # Copying through the backup API keeps the swap atomic for connections that have the live file open.
+            source = sqlite3.connect(source_path)
+            target = sqlite3.connect(target_path, timeout=30)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+        finally:
+            if source_path != backup_path:
+                os.remove(source_path)
+        logging.info(f"Restored {target_path} from {backup_name}.")
+
+    async def backup(self, source_path: str) -> dict:
+        return await asyncio.to_thread(self._snapshot, source_path)
+
+    async def restore(self, backup_name: str, target_path: str):
+        await asyncio.to_thread(self._restore, backup_name, target_path)
+
+
+if __name__ == "__main__":
+    import statistics
+    from helpers.db_helper import DBHelper
+
+    async def measure_writes(db: DBHelper, stop: asyncio.Event) -> list:
+        latencies = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            await db.add_event("writer", 1, "message")
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.001)
+        return latencies
+
+    def cleanup():
+        for name in os.listdir('.'):
+            if name.startswith('backup_bench'):
+                if os.path.isdir(name):
+                    shutil.rmtree(name)
+                else:
+                    os.remove(name)
+
+    async def benchmark():
+        cleanup()
+        db = DBHelper("backup_bench")
+        await db.initialize()
+        await db.create_db()
+        async with db.write_lock:
+            reason_id = (await db._reason_ids(["message"]))["message"]
+            await db.conn.executemany('INSERT INTO events VALUES (?, ?, ?, ?)', ((f"u{i % 5000}", i, 1, reason_id) for i in range(500000)))
+            await db.conn.commit()
+        helper = BackupHelper("backup_bench_dir", compress=False)
+
+        stop = asyncio.Event()
+        writer = asyncio.create_task(measure_writes(db, stop))
+        await asyncio.sleep(2)
+        stop.set()
+        idle = await writer
+
+        stop = asyncio.Event()
+        writer = asyncio.create_task(measure_writes(db, stop))
+        stats = await helper.backup(db.db_name)
+        stop.set()
+        during = await writer
+
+        for label, latencies in (("idle", idle), ("during backup", during)):
+            latencies.sort()
+            print(f"write latency {label}: p50 {statistics.median(latencies) * 1000:.2f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms over {len(latencies)} writes")
+        print(f"backup: {stats['bytes'] / 1024 / 1024:.1f} MiB in {stats['seconds']:.2f}s, {stats['steps']} steps, {stats['restarts']} restarts")
+        await db.close()
+        cleanup()
+
+    asyncio.run(benchmark())
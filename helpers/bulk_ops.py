@@ -0,0 +1,105 @@
+import io
+import csv
+import logging
+from helpers.storage_backend import StorageBackend
+
+
+def parse_grants(text: str, default_points: int = None) -> list:
+    """Reads "userid,points" CSV rows into (userid, points) pairs.
+
+    A row with only a userid gets default_points. A header row and blank lines are skipped.
+    """
+    grants = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        row = [value.strip() for value in row if value.strip()]
+        if not row:
+            continue
+        if not row[0].isdigit():
+            if line_number == 1:
+                continue
+            raise ValueError(f"Line {line_number}: {row[0]} is not a user id.")
+        if len(row) > 1:
+            try:
+                points = int(row[1])
+            except ValueError:
+                raise ValueError(f"Line {line_number}: {row[1]} is not a number of points.")
+        elif default_points is not None:
+            points = default_points
+        else:
+            raise ValueError(f"Line {line_number}: no points given for {row[0]}.")
+        grants.append((row[0], points))
+    return grants
+
+
+async def apply_grants(db: StorageBackend, grants: list, reason: str, sign: int = 1) -> int:
+    """Adds all grants in one transaction; sign=-1 revokes them. Returns the number of events."""
+    events = [(str(userid), points * sign, reason) for userid, points in grants]
+    if events:
+        await db.add_events(events)
+    logging.info(f"Applied {len(events)} bulk point changes ({reason}).")
+    return len(events)
+
+
+async def export_csv(rows, file, header: tuple = ("userid", "total_points")) -> int:
+    """Writes the rows of an async iterator to a text file as CSV, one row at a time."""
+    writer = csv.writer(file)
+    writer.writerow(header)
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import asyncio
+    import argparse
+    from helpers.guild_manager import GuildManager
+
+    parser = argparse.ArgumentParser(description="Bulk point changes and CSV exports for one guild's database.")
+    parser.add_argument("--guild", type=int, default=None, help="Guild id, defaults to the first guild in bot.json.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command in ("grant", "revoke"):
+        subparser = subparsers.add_parser(command, help=f"{command.capitalize()} points from a CSV file of userid,points rows or a list of user ids.")
+        subparser.add_argument("--csv", help="CSV file, - for stdin.")
+        subparser.add_argument("--users", default="", help="Comma separated user ids.")
+        subparser.add_argument("--points", type=int, default=None, help="Points for --users and for CSV rows without points.")
+        subparser.add_argument("--reason", default="admin added" if command == "grant" else "admin removed")
+    export_parser = subparsers.add_parser("export", help="Stream balances or the leaderboard to a CSV file.")
+    export_parser.add_argument("what", choices=("balances", "leaderboard"))
+    export_parser.add_argument("--output", default="-", help="Output file, - for stdout.")
+    args = parser.parse_args()
+
+    async def main():
+        guilds = GuildManager(json.load(open('bot.json')))
+        db = await guilds.get_db(args.guild)
+        try:
+            if args.command == "export":
+                rows = db.iter_balances() if args.what == "balances" else db.iter_leaderboard()
+                if args.output == "-":
+                    count = await export_csv(rows, sys.stdout)
+                else:
+                    with open(args.output, 'w', newline='') as file:
+                        count = await export_csv(rows, file)
+                print(f"Exported {count} rows.", file=sys.stderr)
+                return
+            grants = []
+            if args.csv:
+                text = sys.stdin.read() if args.csv == "-" else open(args.csv).read()
+                try:
+                    grants += parse_grants(text, args.points)
+                except ValueError as e:
+                    parser.error(str(e))
+            user_ids = [userid.strip() for userid in args.users.split(",") if userid.strip()]
+            if user_ids:
+                if args.points is None:
+                    parser.error("--users needs --points.")
+                grants += [(userid, args.points) for userid in user_ids]
+            count = await apply_grants(db, grants, args.reason, 1 if args.command == "grant" else -1)
+            print(f"{'Granted' if args.command == 'grant' else 'Revoked'} points for {count} users.", file=sys.stderr)
+        finally:
+            await guilds.close()
+
+    asyncio.run(main())
@@ -1,25 +1,50 @@
+import time
 import aiosqlite
 import asyncio
 import logging
 from datetime import datetime, timezone
+from helpers.storage_backend import StorageBackend
+from helpers.outbox import Outbox
 
+_EVENTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS events
+    (
+        userid text,
+        event_timestamp integer,
+        currency_change integer,
+        reason_id integer
+    )
+'''
 
-class DBHelper:
-    def __init__(self, db_name):
+
+class DBHelper(StorageBackend):
+    def __init__(self, db_name, outbox: Outbox = None):
         self.db_name = db_name + ".db"
         self.conn = None
+        self.reason_ids = {}
+        # Every write on the shared connection holds this for its whole transaction, so no
+        # commit or rollback can ever take another coroutine's half-finished writes with it.
+        self.write_lock = asyncio.Lock()
+        self.season_lock = asyncio.Lock()
+        # Failed ledger writes are spooled here and retried; see Outbox.
+        self.outbox = outbox
         
     async def initialize(self):
         self.conn = await aiosqlite.connect(self.db_name)
-        self.c = await self.conn.cursor()
+        # WAL lets backups and other readers run without blocking writes.
+        await self.conn.execute('PRAGMA journal_mode=WAL')
+        if self.outbox:
+            await self.outbox.start(self.add_event_batch)
 
     async def close(self):
+        if self.outbox:
+            await self.outbox.stop()
         if self.conn:
             await self.conn.close()
+            self.conn = None
 
     async def __aenter__(self):
-        self.conn = await aiosqlite.connect(self.db_name)
-        self.c = await self.conn.cursor()
+        await self.initialize()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
@@ -28,31 +53,125 @@ class DBHelper:
     async def create_db(self):
         if self.conn is None:
             raise RuntimeError("Database connection is not initialized.")
-        
-        await self.c.execute('''
-            CREATE TABLE IF NOT EXISTS events
-            (
-                userid text,
-                event_timestamp integer,
-                currency_change integer,
-                reason text
-            )
-        ''')
-        await self.c.execute('CREATE INDEX IF NOT EXISTS idx_userid ON events(userid)')
-        await self.c.execute('''
-            CREATE TABLE IF NOT EXISTS shop
-            (
-                item_id integer PRIMARY KEY,
-                item_name text,
-                item_price integer,
-                item_file text,
-                item_description text
-            )
+        async with self.write_lock:
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS reasons
+                (
+                    reason_id integer PRIMARY KEY,
+                    reason text UNIQUE
+                )
+            ''')
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS economy_daily
+                (
+                    day integer,
+                    reason_id integer,
+                    earned integer,
+                    spent integer,
+                    event_count integer,
+                    PRIMARY KEY (day, reason_id)
+                ) WITHOUT ROWID
+            ''')
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS economy_user_daily
+                (
+                    reason_id integer,
+                    day integer,
+                    userid text,
+                    earned integer,
+                    spent integer,
+                    event_count integer,
+                    PRIMARY KEY (reason_id, day, userid)
+                ) WITHOUT ROWID
+            ''')
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS seasons
+                (
+                    season_id integer PRIMARY KEY,
+                    name text,
+                    started_at integer,
+                    ended_at integer,
+                    snapshot_done integer DEFAULT 0
+                )
+            ''')
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS season_balances
+                (
+                    season_id integer,
+                    userid text,
+                    total_points integer,
+                    PRIMARY KEY (season_id, userid)
+                ) WITHOUT ROWID
+            ''')
+            await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_season_balances_points ON season_balances(season_id, total_points)')
+            await self.conn.execute("INSERT INTO seasons (season_id, name, started_at) SELECT 1, 'Season 1', ? WHERE NOT EXISTS (SELECT 1 FROM seasons)", (int(datetime.now(timezone.utc).timestamp()),))
+            await self._create_ledger_tables(await self._active_season())
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS shop
+                (
+                    item_id integer PRIMARY KEY,
+                    item_name text,
+                    item_price integer,
+                    item_file text,
+                    item_description text
+                )
+            ''')
+            await self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_item_id ON shop(item_id)')
+            await self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_item_name ON shop(item_name)')
+            await self.conn.commit()
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS gacha_events
+                (
+                    userid text,
+                    reward_rarity integer,
+                    reward_name text,
+                    event_timestamp integer
+                )
+            ''')
+            await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_gacha_userid ON gacha_events(userid)')
+            await self.conn.commit()
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS users
+                (
+                    userid text
+                )
+            ''')
+            await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_users_userid ON users(userid)')
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS event_batches
+                (
+                    batch_id text PRIMARY KEY,
+                    event_count integer,
+                    event_timestamp integer
+                )
+            ''')
+            await self.conn.commit()
+
+    async def _create_ledger_tables(self, season_id: int):
+        # The tables a season resets. Index names are unique per database and the indexes of
+        # past seasons keep theirs, so every season after the first gets its own.
+        suffix = "" if season_id == 1 else f"_season_{season_id}"
+        await self.conn.execute(_EVENTS_TABLE)
+        async with self.conn.execute('PRAGMA table_info(events)') as cursor:
+            if 'reason' in [row[1] for row in await cursor.fetchall()]:
+                await self._intern_event_reasons()
+        await self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_userid{suffix} ON events(userid)')
+        # Every event is added to the daily rollups as it is written; the rollups are never
+        # reduced, so they keep the history after events are aggregated or deleted.
+        await self.conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS events_economy_rollup AFTER INSERT ON events
+            BEGIN
+                INSERT INTO economy_daily (day, reason_id, earned, spent, event_count)
+                VALUES (CAST(NEW.event_timestamp / 86400 AS integer), NEW.reason_id, max(NEW.currency_change, 0), max(-NEW.currency_change, 0), 1)
+                ON CONFLICT (day, reason_id) DO UPDATE
+                SET earned = earned + excluded.earned, spent = spent + excluded.spent, event_count = event_count + 1;
+                INSERT INTO economy_user_daily (reason_id, day, userid, earned, spent, event_count)
+                VALUES (NEW.reason_id, CAST(NEW.event_timestamp / 86400 AS integer), NEW.userid, max(NEW.currency_change, 0), max(-NEW.currency_change, 0), 1)
+                ON CONFLICT (reason_id, day, userid) DO UPDATE
+                SET earned = earned + excluded.earned, spent = spent + excluded.spent, event_count = event_count + 1;
+            END
         ''')
-        await self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_item_id ON shop(item_id)')
-        await self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_item_name ON shop(item_name)')
-        await self.conn.commit()
-        await self.c.execute('''
+        await self.conn.execute('''
             CREATE TABLE IF NOT EXISTS points_agg
             (
                 userid text PRIMARY KEY,
@@ -60,102 +179,182 @@ class DBHelper:
                 last_update integer
             )
         ''')
-        await self.c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_userid_agg ON points_agg(userid)')
-        await self.conn.commit()
-        await self.c.execute('''
-            CREATE TABLE IF NOT EXISTS gacha_events
-            (
-                userid text,
-                reward_rarity integer,
-                reward_name text,
-                event_timestamp integer
-            )
+        await self.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_userid_agg{suffix} ON points_agg(userid)')
+
+    async def _intern_event_reasons(self):
+        # Databases from before reasons were interned keep the reason text in every event.
+        # The table is rebuilt with reason ids and the rollups are filled from the events
+        # it still has, all in one transaction.
+        started = time.perf_counter()
+        await self.conn.execute("INSERT OR IGNORE INTO reasons (reason) SELECT DISTINCT coalesce(reason, '') FROM events")
+        await self.conn.execute('ALTER TABLE events RENAME TO events_text')
+        await self.conn.execute(_EVENTS_TABLE)
+        await self.conn.execute('''
+            INSERT INTO events (userid, event_timestamp, currency_change, reason_id)
+            SELECT e.userid, e.event_timestamp, e.currency_change, r.reason_id
+            FROM events_text e
+            JOIN reasons r ON r.reason = coalesce(e.reason, '')
         ''')
-        await self.c.execute('CREATE INDEX IF NOT EXISTS idx_gacha_userid ON gacha_events(userid)')
-        await self.conn.commit()
-        await self.c.execute("DROP TABLE IF EXISTS users")
-        await self.c.execute('''
-            CREATE TABLE IF NOT EXISTS users
-            (
-                userid text
-            )
+        await self.conn.execute('DROP TABLE events_text')
+        await self.conn.execute('''
+            INSERT INTO economy_daily (day, reason_id, earned, spent, event_count)
+            SELECT CAST(event_timestamp / 86400 AS integer), reason_id, SUM(max(currency_change, 0)), SUM(max(-currency_change, 0)), COUNT(*)
+            FROM events
+            GROUP BY 1, 2
+        ''')
+        await self.conn.execute('''
+            INSERT INTO economy_user_daily (reason_id, day, userid, earned, spent, event_count)
+            SELECT reason_id, CAST(event_timestamp / 86400 AS integer), userid, SUM(max(currency_change, 0)), SUM(max(-currency_change, 0)), COUNT(*)
+            FROM events
+            GROUP BY 1, 2, 3
         ''')
-        await self.c.execute('CREATE INDEX IF NOT EXISTS idx_userid ON users(userid)')
         await self.conn.commit()
+        logging.info(f"Interned the event reasons of {self.db_name} in {time.perf_counter() - started:.2f}s.")
+
+    async def _reason_ids(self, reasons) -> dict:
+        """Maps reasons to their interned ids, adding new reasons in their own transaction. The caller holds write_lock."""
+        missing = {reason for reason in reasons if reason not in self.reason_ids}
+        if missing:
+            # Committed right away, so a rolled back event insert never leaves a cached id behind.
+            await self.conn.executemany('INSERT OR IGNORE INTO reasons (reason) VALUES (?)', [(reason,) for reason in missing])
+            await self.conn.commit()
+            for reason in missing:
+                async with self.conn.execute('SELECT reason_id FROM reasons WHERE reason = ?', (reason,)) as cursor:
+                    self.reason_ids[reason] = (await cursor.fetchone())[0]
+        return self.reason_ids
 
     async def aggregate_points(self, cutoff_timestamp):
-        async with self.conn.execute('''
-            CREATE TEMP TABLE total_points AS
-                SELECT userid, SUM(currency_change) AS currency_change
-                FROM (SELECT * FROM events WHERE event_timestamp < ?)
-                GROUP BY userid;
-        ''', (cutoff_timestamp,)) as cursor:
-            await cursor.close()
-        async with self.conn.execute('''
-            UPDATE points_agg
-            SET total_points = points_agg.total_points + (SELECT currency_change FROM total_points WHERE points_agg.userid = total_points.userid),
-                last_update = ?
-            WHERE EXISTS (
-                SELECT 1
+        async with self.write_lock:
+            async with self.conn.execute('''
+                CREATE TEMP TABLE total_points AS
+                    SELECT userid, SUM(currency_change) AS currency_change
+                    FROM (SELECT * FROM events WHERE event_timestamp < ?)
+                    GROUP BY userid;
+            ''', (cutoff_timestamp,)) as cursor:
+                await cursor.close()
+            async with self.conn.execute('''
+                UPDATE points_agg
+                SET total_points = points_agg.total_points + (SELECT currency_change FROM total_points WHERE points_agg.userid = total_points.userid),
+                    last_update = ?
+                WHERE EXISTS (
+                    SELECT 1
+                    FROM total_points
+                    WHERE points_agg.userid = total_points.userid
+                );
+            ''', (cutoff_timestamp,)) as cursor:
+                await cursor.close()
+            async with self.conn.execute('''
+                INSERT INTO points_agg (userid, total_points, last_update)
+                SELECT userid, currency_change, ?
                 FROM total_points
-                WHERE points_agg.userid = total_points.userid
-            );
-        ''', (cutoff_timestamp,)) as cursor:
-            await cursor.close()
-        async with self.conn.execute('''
-            INSERT INTO points_agg (userid, total_points, last_update)
-            SELECT userid, currency_change, ?
-            FROM total_points
-            WHERE NOT EXISTS (
-                SELECT 1
-                FROM points_agg
-                WHERE points_agg.userid = total_points.userid
-            );
-        ''', (cutoff_timestamp,)) as cursor:
-            await cursor.close()
-        async with self.conn.execute('DROP TABLE total_points;') as cursor:
-            await cursor.close()
-        async with self.conn.execute('DELETE FROM events WHERE event_timestamp < ?', (cutoff_timestamp,)) as cursor:
-            await cursor.close()
-        await self.conn.commit()
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM points_agg
+                    WHERE points_agg.userid = total_points.userid
+                );
+            ''', (cutoff_timestamp,)) as cursor:
+                await cursor.close()
+            async with self.conn.execute('DROP TABLE total_points;') as cursor:
+                await cursor.close()
+            async with self.conn.execute('DELETE FROM events WHERE event_timestamp < ?', (cutoff_timestamp,)) as cursor:
+                await cursor.close()
+            await self.conn.commit()
+
+    async def _insert_events(self, events: list, event_timestamp: int):
+        async with self.write_lock:
+            reason_ids = await self._reason_ids(reason for _, _, reason in events)
+            query = 'INSERT INTO events VALUES (?, ?, ?, ?)'
+            try:
+                await self.conn.executemany(query, [(userid, event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+        self._bump_version("leaderboard")
 
     async def add_event(self, userid: str, currency_change: int, reason: str):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
         try:
-            event_timestamp = int(datetime.now(timezone.utc).timestamp())
-            query = 'INSERT INTO events VALUES (?, ?, ?, ?)'
-            async with self.conn.execute(query, (userid, event_timestamp, currency_change, reason)) as cursor:
-                await cursor.close()
-            await self.conn.commit()
+            await self._insert_events([(userid, currency_change, reason)], event_timestamp)
         except Exception as e:
-            logging.error(f"Failed to add event: {e}")
+            await self._spool_failed_write([(userid, currency_change, reason)], event_timestamp, e)
 
-    async def _add_event_test(self, userid: str, event_timestamp:int, currency_change: int, reason: str):
+    async def add_events(self, events: list):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
         try:
-            query = 'INSERT INTO events VALUES (?, ?, ?, ?)'
-            async with self.conn.execute(query, (userid, event_timestamp, currency_change, reason)) as cursor:
-                await cursor.close()
-            await self.conn.commit()
+            await self._insert_events(events, event_timestamp)
         except Exception as e:
-            logging.error(f"Failed to add event: {e}")
+            if self.outbox is None:
+                raise
+            await self._spool_failed_write(events, event_timestamp, e)
+
+    async def add_event_batch(self, batch_id: str, events: list, event_timestamp: int = None, gacha_events: list = None) -> bool:
+        if event_timestamp is None:
+            event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        async with self.write_lock:
+            reason_ids = await self._reason_ids(reason for _, _, reason in events)
+            try:
+                # The batch id is recorded in the same transaction as its events. It is written
+                # first, so a duplicate is found before anything else and there is nothing to undo.
+                query = 'INSERT OR IGNORE INTO event_batches VALUES (?, ?, ?)'
+                async with self.conn.execute(query, (batch_id, len(events), event_timestamp)) as cursor:
+                    added = cursor.rowcount == 1
+                if not added:
+                    # Ends the write transaction the ignored insert opened, without a rollback.
+                    await self.conn.commit()
+                    return False
+                query = 'INSERT INTO events VALUES (?, ?, ?, ?)'
+                await self.conn.executemany(query, [(userid, event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+                if gacha_events:
+                    await self.conn.executemany('INSERT INTO gacha_events VALUES (?, ?, ?, ?)', gacha_events)
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+        self._bump_version("leaderboard")
+        return True
+
+    async def _add_event_test(self, userid: str, event_timestamp:int, currency_change: int, reason: str):
+        async with self.write_lock:
+            try:
+                reason_ids = await self._reason_ids([reason])
+                query = 'INSERT INTO events VALUES (?, ?, ?, ?)'
+                async with self.conn.execute(query, (userid, event_timestamp, currency_change, reason_ids[reason])) as cursor:
+                    await cursor.close()
+                await self.conn.commit()
+            except Exception as e:
+                logging.error(f"Failed to add event: {e}")
 
     async def add_item(self, item_name: str, item_price: int, item_description: str, item_file: str):
-        query = 'INSERT INTO shop (item_name, item_price, item_description, item_file) VALUES (?, ?, ?, ?)'
-        await self.c.execute(query, (item_name, item_price, item_description, item_file))
-        await self.conn.commit()
+        async with self.write_lock:
+            query = 'INSERT INTO shop (item_name, item_price, item_description, item_file) VALUES (?, ?, ?, ?)'
+            try:
+                async with self.conn.execute(query, (item_name, item_price, item_description, item_file)) as cursor:
+                    await cursor.close()
+                await self.conn.commit()
+            except Exception:
+                # A duplicate name; nothing else can be in the transaction while the lock is held.
+                await self.conn.rollback()
+                raise
+            self._bump_version("shop")
 
     async def remove_item_by_id(self, item_id: int):
-        query = 'DELETE FROM shop WHERE item_id=?'
-        await self.c.execute(query, (item_id,))
-        rows_deleted = self.c.rowcount
-        await self.conn.commit()
-        return rows_deleted
+        async with self.write_lock:
+            query = 'DELETE FROM shop WHERE item_id=?'
+            async with self.conn.execute(query, (item_id,)) as cursor:
+                rows_deleted = cursor.rowcount
+            await self.conn.commit()
+            self._bump_version("shop")
+            return rows_deleted
 
     async def remove_item_by_name(self, item_name: str) -> int:
-        query = 'DELETE FROM shop WHERE item_name=?'
-        await self.c.execute(query, (item_name,))
-        rows_deleted = self.c.rowcount
-        await self.conn.commit()
-        return rows_deleted
+        async with self.write_lock:
+            query = 'DELETE FROM shop WHERE item_name=?'
+            async with self.conn.execute(query, (item_name,)) as cursor:
+                rows_deleted = cursor.rowcount
+            await self.conn.commit()
+            self._bump_version("shop")
+            return rows_deleted
     
     async def get_live_currency(self, userid: str):
         query = 'SELECT SUM(currency_change) FROM events WHERE userid=?'
@@ -169,11 +368,6 @@ class DBHelper:
             result = await cursor.fetchone()
             return result[0] if result else 0
 
-    async def get_total_currency(self, userid: str):
-        live_currency = await self.get_live_currency(userid)
-        aggregated_currency = await self.get_aggregated_currency(userid)
-        return live_currency + aggregated_currency
-
     async def buy_items_by_id(self, item_id: int):
         query = "SELECT item_price, coalesce(item_file, '') as item_file FROM shop WHERE item_id=?"
         async with self.conn.execute(query, (item_id,)) as cursor:
@@ -190,6 +384,44 @@ class DBHelper:
         async with self.conn.execute('SELECT item_id, item_name, item_price, item_description FROM shop') as cursor:
             return await cursor.fetchall()
     
+    async def _iter_rows(self, query: str, batch_size: int):
+        # A separate connection reads one consistent WAL snapshot without holding up writes on self.conn.
+        async with aiosqlite.connect(self.db_name) as conn:
+            async with conn.execute(query) as cursor:
+                while rows := await cursor.fetchmany(batch_size):
+                    for row in rows:
+                        yield row
+
+    async def iter_balances(self, batch_size: int = 1000):
+        query = '''
+            SELECT userid, SUM(total_points) AS total_points
+            FROM (
+                SELECT userid, SUM(currency_change) AS total_points FROM events GROUP BY userid
+                UNION ALL
+                SELECT userid, total_points FROM points_agg
+            )
+            GROUP BY userid
+            ORDER BY userid
+        '''
+        async for row in self._iter_rows(query, batch_size):
+            yield row
+
+    async def iter_leaderboard(self, batch_size: int = 1000):
+        query = '''
+            SELECT sq.userid, SUM(sq.total_points) AS total_points
+            FROM (
+                SELECT userid, SUM(currency_change) AS total_points FROM events GROUP BY userid
+                UNION ALL
+                SELECT userid, total_points FROM points_agg
+            ) sq
+            JOIN users u
+                ON sq.userid = u.userid
+            GROUP BY sq.userid
+            ORDER BY total_points DESC
+        '''
+        async for row in self._iter_rows(query, batch_size):
+            yield row
+
     async def get_leaderboard(self, limit: int = 10):
         query = '''
             SELECT sq2.userid, sq2.total_points
@@ -218,53 +450,165 @@ class DBHelper:
             return await cursor.fetchall()
     
     async def aggregate_points_async(self, cutoff_timestamp):
-        async with aiosqlite.connect('melbot.db') as adb:
-            # Create a temporary table to hold the aggregated points
-            await adb.execute('''
-                CREATE TEMPORARY TABLE total_points AS
-                    SELECT userid, SUM(currency_change) AS currency_change, MAX(event_timestamp) AS event_timestamp
+        # One transaction on the shared connection, like the PostgreSQL version: a reader never
+        # sees the points in both points_agg and events, and a crash leaves neither half behind.
+        async with self.write_lock:
+            try:
+                async with self.conn.execute('''
+                    INSERT INTO points_agg (userid, total_points, last_update)
+                    SELECT userid, SUM(currency_change), MAX(event_timestamp)
                     FROM events
                     WHERE event_timestamp < ?
-                    GROUP BY userid;
-            ''', (cutoff_timestamp,))
-            # Insert new aggregated points into points_agg
-            await adb.execute('''
-                INSERT INTO points_agg (userid, total_points, last_update)
-                SELECT userid, currency_change, event_timestamp
-                FROM total_points
-                WHERE NOT EXISTS (
-                    SELECT 1
-                    FROM points_agg
-                    WHERE points_agg.userid = total_points.userid
-                );
-            ''')
-            # Update existing records in points_agg with new aggregated points
-            await adb.execute('''
-                UPDATE points_agg
-                SET total_points = (SELECT currency_change FROM total_points WHERE points_agg.userid = total_points.userid),
-                    last_update = (SELECT event_timestamp FROM total_points WHERE points_agg.userid = total_points.userid)
-                WHERE EXISTS (
-                    SELECT 1
-                    FROM total_points
-                    WHERE points_agg.userid = total_points.userid
-                    AND points_agg.last_update < total_points.event_timestamp
-                );
-            ''')
-            # Drop the temporary table
-            await adb.execute('DROP TABLE total_points;')
-            await adb.commit()
+                    GROUP BY userid
+                    ON CONFLICT (userid) DO UPDATE
+                    SET total_points = points_agg.total_points + excluded.total_points,
+                        last_update = MAX(points_agg.last_update, excluded.last_update);
+                ''', (cutoff_timestamp,)) as cursor:
+                    await cursor.close()
+                async with self.conn.execute('DELETE FROM events WHERE event_timestamp < ?', (cutoff_timestamp,)) as cursor:
+                    await cursor.close()
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+        self._bump_version("leaderboard")
+
+    async def get_economy(self, since_timestamp: float) -> list:
+        query = '''
+            SELECT r.reason, SUM(d.earned), SUM(d.spent), SUM(d.event_count)
+            FROM economy_daily d
+            JOIN reasons r ON r.reason_id = d.reason_id
+            WHERE d.day >= ?
+            GROUP BY d.reason_id
+            ORDER BY SUM(d.earned) + SUM(d.spent) DESC
+        '''
+        async with self.conn.execute(query, (self.rollup_day(since_timestamp),)) as cursor:
+            return await cursor.fetchall()
+
+    async def get_economy_users(self, reason: str, since_timestamp: float, limit: int = 10) -> list:
+        query = '''
+            SELECT u.userid, SUM(u.earned), SUM(u.spent), SUM(u.event_count)
+            FROM economy_user_daily u
+            JOIN reasons r ON r.reason_id = u.reason_id
+            WHERE r.reason = ? AND u.day >= ?
+            GROUP BY u.userid
+            ORDER BY SUM(u.earned) + SUM(u.spent) DESC
+            LIMIT ?
+        '''
+        async with self.conn.execute(query, (reason, self.rollup_day(since_timestamp), limit)) as cursor:
+            return await cursor.fetchall()
+
+    async def _active_season(self) -> int:
+        async with self.conn.execute('SELECT MAX(season_id) FROM seasons') as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def _flip_season(self, name: str, timestamp: int) -> int:
+        """Moves the live ledger tables aside and creates empty ones, without committing.
+
+        Renames only change the schema, so this takes the same time whatever the size
+        of the tables. The caller holds write_lock until it commits or rolls back.
+        """
+        if not self.conn.in_transaction:
+            await self.conn.execute('BEGIN IMMEDIATE')
+        season_id = await self._active_season()
+        await self.conn.execute(f'ALTER TABLE events RENAME TO events_season_{season_id}')
+        await self.conn.execute(f'ALTER TABLE points_agg RENAME TO points_agg_season_{season_id}')
+        # The rollup trigger moved along with the table.
+        await self.conn.execute('DROP TRIGGER IF EXISTS events_economy_rollup')
+        await self.conn.execute('UPDATE seasons SET ended_at = ? WHERE season_id = ?', (timestamp, season_id))
+        await self.conn.execute('INSERT INTO seasons (season_id, name, started_at) VALUES (?, ?, ?)', (season_id + 1, name, timestamp))
+        await self._create_ledger_tables(season_id + 1)
+        return season_id + 1
+
+    async def _finish_season_snapshots(self, batch_size: int = 5000):
+        # Past seasons' tables never change, so their balances are read on a separate
+        # connection and written in short transactions that never hold up the live ledger.
+        # One caller at a time; the next finds the seasons already done.
+        async with self.season_lock:
+            await self._save_season_balances(batch_size)
+
+    async def _save_season_balances(self, batch_size: int):
+        async with self.conn.execute('SELECT season_id FROM seasons WHERE ended_at IS NOT NULL AND snapshot_done = 0') as cursor:
+            season_ids = [row[0] for row in await cursor.fetchall()]
+        for season_id in season_ids:
+            started = time.perf_counter()
+            query = f'''
+                SELECT userid, SUM(total_points) AS total_points
+                FROM (
+                    SELECT userid, SUM(currency_change) AS total_points FROM events_season_{season_id} GROUP BY userid
+                    UNION ALL
+                    SELECT userid, total_points FROM points_agg_season_{season_id}
+                )
+                GROUP BY userid
+            '''
+            batch = []
+            count = 0
+            async for userid, total_points in self._iter_rows(query, batch_size):
+                batch.append((season_id, userid, total_points))
+                if len(batch) >= batch_size:
+                    async with self.write_lock:
+                        await self.conn.executemany('INSERT OR REPLACE INTO season_balances VALUES (?, ?, ?)', batch)
+                        await self.conn.commit()
+                    count += len(batch)
+                    batch = []
+            async with self.write_lock:
+                await self.conn.executemany('INSERT OR REPLACE INTO season_balances VALUES (?, ?, ?)', batch)
+                await self.conn.execute('UPDATE seasons SET snapshot_done = 1 WHERE season_id = ?', (season_id,))
+                await self.conn.commit()
+            logging.info(f"Saved the balances of {count + len(batch)} users for season {season_id} in {time.perf_counter() - started:.2f}s.")
 
-            # Delete events that have been aggregated
-            await adb.execute('DELETE FROM events WHERE event_timestamp < ?', (cutoff_timestamp,))
-            await adb.commit()
+    async def start_season(self, name: str) -> int:
+        # Held for the whole flip, so no other write can commit the renames halfway through.
+        async with self.write_lock:
+            try:
+                season_id = await self._flip_season(name, int(datetime.now(timezone.utc).timestamp()))
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+        self._bump_version("leaderboard")
+        await self._finish_season_snapshots()
+        return season_id
+
+    async def get_seasons(self) -> list:
+        async with self.conn.execute('SELECT season_id, name, started_at, ended_at FROM seasons ORDER BY season_id') as cursor:
+            return await cursor.fetchall()
 
-    def close(self):
-        self.conn.close()
+    async def get_season_leaderboard(self, season_id: int, limit: int = 10) -> list:
+        if season_id == await self._active_season():
+            return await self.get_leaderboard(limit)
+        # Resumes a snapshot that a restart interrupted.
+        await self._finish_season_snapshots()
+        query = 'SELECT userid, total_points FROM season_balances WHERE season_id = ? ORDER BY total_points DESC LIMIT ?'
+        async with self.conn.execute(query, (season_id, limit)) as cursor:
+            return await cursor.fetchall()
 
     async def add_gacha_event(self, userid: str, reward_rarity: int, reward_name: str, event_timestamp: int):
-        query = 'INSERT INTO gacha_events VALUES (?, ?, ?, ?)'
-        await self.c.execute(query, (userid, reward_rarity, reward_name, event_timestamp))
-        await self.conn.commit()
+        async with self.write_lock:
+            query = 'INSERT INTO gacha_events VALUES (?, ?, ?, ?)'
+            async with self.conn.execute(query, (userid, reward_rarity, reward_name, event_timestamp)) as cursor:
+                await cursor.close()
+            await self.conn.commit()
+
+    async def add_gacha_events(self, events: list, gacha_events: list):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        try:
+            async with self.write_lock:
+                reason_ids = await self._reason_ids(reason for _, _, reason in events)
+                try:
+                    await self.conn.executemany('INSERT INTO events VALUES (?, ?, ?, ?)', [(userid, event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+                    await self.conn.executemany('INSERT INTO gacha_events VALUES (?, ?, ?, ?)', gacha_events)
+                    await self.conn.commit()
+                except Exception:
+                    await self.conn.rollback()
+                    raise
+        except Exception as e:
+            if self.outbox is None:
+                raise
+            # Spooled together, so a retry adds the points and the pulls in one transaction again.
+            await self._spool_failed_write(events, event_timestamp, e, gacha_events)
+            return
+        self._bump_version("leaderboard")
 
     async def get_pity(self, userid: str):
         query = """WITH last_rewards AS (
@@ -291,19 +635,26 @@ class DBHelper:
                 return result[1], result[2]
     
     async def replace_users(self, user_list: list, batch_size: int = -1):
-        if batch_size == -1:
-            batch_size = len(user_list)
-        for i in range(0, len(user_list), batch_size):
-            batch = user_list[i:i+batch_size]
-            batch_ids = [member.id for member in batch]
-            sql = f"INSERT INTO users (userid) VALUES (?)"
-            await self.c.executemany(sql, [(userid,) for userid in batch_ids])
-            await self.conn.commit()
+        async with self.write_lock:
+            if batch_size == -1:
+                batch_size = max(1, len(user_list))
+            async with self.conn.execute("DELETE FROM users") as cursor:
+                await cursor.close()
+            for i in range(0, len(user_list), batch_size):
+                batch = user_list[i:i+batch_size]
+                batch_ids = [member.id for member in batch]
+                sql = f"INSERT INTO users (userid) VALUES (?)"
+                await self.conn.executemany(sql, [(userid,) for userid in batch_ids])
+                await self.conn.commit()
+            self._bump_version("leaderboard")
 
     async def delete_user(self, userid:str):
-        query = """DELETE FROM events WHERE userid = ?"""
-        await self.c.execute(query, (userid,))
-        await self.conn.commit()
+        async with self.write_lock:
+            query = """DELETE FROM events WHERE userid = ?"""
+            async with self.conn.execute(query, (userid,)) as cursor:
+                await cursor.close()
+            await self.conn.commit()
+            self._bump_version("leaderboard")
 
 if __name__ == "__main__":
     import os
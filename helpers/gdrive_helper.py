@@ -1,45 +1,95 @@
 import os
 import uuid
+import logging
+import threading
 import dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
 
 class GDriveHelper:
     def __init__(self):
-        service_account_file = os.getenv("GOOGLE_SERVICE_ACCOUNT")
-        SCOPES = ['https://www.googleapis.com/auth/drive']
-        credentials = service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+        # The Google client libraries are slow to import and the Drive client is slow to
+        # build, so both are deferred until Drive is first used (or warm_up is called).
+        self.service_account_file = os.getenv("GOOGLE_SERVICE_ACCOUNT")
         self.main_folder_id = os.getenv("GDRIVE_FOLDER_ID")
-        self.drive_service = build('drive', 'v3', credentials=credentials)
+        self.discovery_cache = os.getenv("GDRIVE_DISCOVERY_CACHE", "drive_v3_discovery.json")
+        self._drive_service = None
+        self._service_lock = threading.Lock()
+        # The underlying httplib2 client is not thread-safe, and Drive calls run in worker threads.
+        self._request_lock = threading.Lock()
+
+    @property
+    def drive_service(self):
+        if self._drive_service is None:
+            with self._service_lock:
+                if self._drive_service is None:
+                    self._drive_service = self._build_service()
+        return self._drive_service
+
+    def _build_service(self):
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        SCOPES = ['https://www.googleapis.com/auth/drive']
+        credentials = service_account.Credentials.from_service_account_file(self.service_account_file, scopes=SCOPES)
+        if os.path.exists(self.discovery_cache):
+            with open(self.discovery_cache) as file:
+                discovery_doc = file.read()
+        else:
+            # The client library ships the Drive discovery document, so it never has to be fetched.
+            discovery_doc = get_static_doc('drive', 'v3')
+            if discovery_doc is None:
+                from googleapiclient.discovery import build
+                logging.warning("No bundled Drive discovery document, fetching it.")
+                return build('drive', 'v3', credentials=credentials, static_discovery=False)
+            with open(self.discovery_cache, 'w') as file:
+                file.write(discovery_doc)
+        return build_from_document(discovery_doc, credentials=credentials)
+
+    def warm_up(self):
+        self.drive_service
+        logging.info("Google Drive client ready.")
 
     def get_files(self, folder_id: str = None):
         folder_id = folder_id or self.main_folder_id
-        results = self.drive_service.files().list(
+        request = self.drive_service.files().list(
             #q=f"'{folder_id}' in parents and trashed=false",
             q="trashed = false",
-            fields="files(id, name, mimeType, webViewLink, parents)"
-        ).execute()
+            fields="files(id, name, mimeType, webViewLink, parents, md5Checksum, size)"
+        )
+        with self._request_lock:
+            results = request.execute()
         return results.get('files', [])
-    
+
+    def get_file_metadata(self, file_id: str):
+        request = self.drive_service.files().get(fileId=file_id, fields="id, name, md5Checksum, size, webViewLink")
+        with self._request_lock:
+            return request.execute()
+
+    def download_to(self, file_id: str, file, chunk_size: int = 4 * 1024 * 1024):
+        from googleapiclient.http import MediaIoBaseDownload
+        request = self.drive_service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(file, request, chunksize=chunk_size)
+        done = False
+        while done is False:
+            with self._request_lock:
+                status, done = downloader.next_chunk()
+            logging.debug(f"Download of {file_id} {int(status.progress() * 100)}%.")
+
     def download_file(self, file_id: str, destination: str):
         file_name = str(uuid.uuid4())
-        request = self.drive_service.files().get_media(fileId=file_id)
         os.makedirs(destination, exist_ok=True)
         with open(destination + "/" + file_name, 'wb') as file:
-            downloader = MediaIoBaseDownload(file, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                print(f"Download {int(status.progress() * 100)}%.")
+            self.download_to(file_id, file)
         return file_name
-    
-    def file_in_drive(self, file_name):
+
+    def find_file(self, file_name):
         files = self.get_files()
         for file in files:
             if file['name'] == file_name:
-                return True
-        return False
+                return file
+        return None
+
+    def file_in_drive(self, file_name):
+        return self.find_file(file_name) is not None
 
 if __name__ == "__main__":
     dotenv.load_dotenv()
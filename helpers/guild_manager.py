@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from helpers.db_helper import DBHelper
+from helpers.memory_ledger import MemoryLedger
+from helpers.postgres_helper import PostgresHelper
+from helpers.storage_backend import StorageBackend
+from helpers.outbox import Outbox
+
+
+class GuildManager:
+    """Per-guild configuration and lazily opened per-guild databases.
+
+    bot.json may contain a "guilds" mapping of guild id to config overrides. Every
+    other top-level key is the default for all guilds. Without "guilds" the bot
+    serves the single legacy "bot_guild" using the top-level "db_name".
+    Open connections are kept in an LRU capped at "max_open_databases" and closed
+    once idle for "database_idle_timeout" seconds. Work that keeps a database longer
+    than "database_min_idle" seconds (a blackjack table, an export) takes a lease,
+    and a leased database is never closed by eviction.
+    "db_backend" picks the storage: "sqlite" (default) uses one file per guild, and
+    "postgres" uses one schema per guild in the database at "db_dsn", with the pool
+    options in "db_pool". "memory" serves the guild from memory on top of its SQLite
+    file, with the MemoryLedger options in "ledger".
+    The sqlite and postgres backends spool failed ledger writes to an Outbox next to
+    the database, configured by "outbox" ("enabled": false turns it off). Each
+    process needs its own spool file, named by "process_name" in "outbox".
+    """
+    def __init__(self, config: dict):
+        base_config = {key: value for key, value in config.items() if key != "guilds"}
+        guilds = config.get("guilds")
+        self.guild_configs = {}
+        if guilds:
+            for guild_id, overrides in guilds.items():
+                guild_config = {**base_config, "db_name": f"{base_config['db_name']}_{guild_id}"}
+                guild_config.update(overrides)
+                self.guild_configs[int(guild_id)] = guild_config
+        else:
+            self.guild_configs[int(config.get("bot_guild", 0))] = base_config
+        self.default_guild_id = next(iter(self.guild_configs))
+        self.max_open = config.get("max_open_databases", 8)
+        self.idle_timeout = config.get("database_idle_timeout", 600)
+        # Connections used more recently than this are never evicted, so a command
+        # that is still awaiting its database cannot have it closed underneath it.
+        self.min_idle = config.get("database_min_idle", 30)
+        self.open_dbs = OrderedDict()
+        self.last_used = {}
+        # guild id -> number of leases on its open database.
+        self.leases = {}
+        # guild id -> event set once its database is back from offline().
+        self.offline_dbs = {}
+        self.created = set()
+        self.lock = asyncio.Lock()
+
+    def resolve_guild_id(self, guild) -> int:
+        if guild is None:
+            return self.default_guild_id
+        if isinstance(guild, int):
+            return guild
+        return guild.id
+
+    def is_configured(self, guild) -> bool:
+        return self.resolve_guild_id(guild) in self.guild_configs
+
+    def guild_ids(self) -> list:
+        return list(self.guild_configs)
+
+    def get_config(self, guild) -> dict:
+        guild_id = self.resolve_guild_id(guild)
+        if guild_id not in self.guild_configs:
+            raise KeyError(f"Guild {guild_id} is not configured.")
+        return self.guild_configs[guild_id]
+
+    def get_db_path(self, guild) -> str:
+        return self.get_config(guild)['db_name'] + ".db"
+
+    def uses_sqlite(self, guild) -> bool:
+        return self.get_config(guild).get('db_backend', 'sqlite') == 'sqlite'
+
+    def _create_outbox(self, guild_config: dict) -> Outbox:
+        outbox_config = dict(guild_config.get('outbox', {}))
+        if not outbox_config.pop('enabled', True):
+            return None
+        process_name = outbox_config.pop('process_name', None)
+        path = f"{guild_config['db_name']}.{process_name}.outbox" if process_name else f"{guild_config['db_name']}.outbox"
+        return Outbox(path, **outbox_config)
+
+    def _create_backend(self, guild_config: dict) -> StorageBackend:
+        backend = guild_config.get('db_backend', 'sqlite')
+        if backend == 'sqlite':
+            return DBHelper(guild_config['db_name'], outbox=self._create_outbox(guild_config))
+        if backend == 'memory':
+            # Its writes are in its own fsynced log, so it has no outbox.
+            return MemoryLedger(guild_config['db_name'], **guild_config.get('ledger', {}))
+        if backend == 'postgres':
+            return PostgresHelper(guild_config['db_dsn'], schema=guild_config['db_name'], outbox=self._create_outbox(guild_config), **guild_config.get('db_pool', {}))
+        raise ValueError(f"Unknown db_backend {backend}.")
+
+    async def get_db(self, guild) -> StorageBackend:
+        return await self._get_db(self.resolve_guild_id(guild), lease=False)
+
+    @asynccontextmanager
+    async def lease(self, guild):
+        """Yields the guild's database and keeps it from being evicted until the block ends."""
+        guild_id = self.resolve_guild_id(guild)
+        db = await self._get_db(guild_id, lease=True)
+        try:
+            yield db
+        finally:
+            self.leases[guild_id] -= 1
+            if self.leases[guild_id] == 0:
+                del self.leases[guild_id]
+            if guild_id in self.last_used:
+                self.last_used[guild_id] = time.monotonic()
+
+    async def _get_db(self, guild_id: int, lease: bool) -> StorageBackend:
+        # Waits while the database is offline, the next caller opens it again.
+        while guild_id in self.offline_dbs:
+            await self.offline_dbs[guild_id].wait()
+        async with self.lock:
+            if guild_id in self.offline_dbs:
+                return await self._get_db(guild_id, lease)
+            if guild_id not in self.open_dbs:
+                guild_config = self.get_config(guild_id)
+                db = self._create_backend(guild_config)
+                await db.initialize()
+                if guild_id not in self.created:
+                    await db.create_db()
+                    self.created.add(guild_id)
+                logging.info(f"Opened database {db.db_name} for guild {guild_id}.")
+                self.open_dbs[guild_id] = db
+            self.open_dbs.move_to_end(guild_id)
+            self.last_used[guild_id] = time.monotonic()
+            # Counted under the lock and before evicting, so a leased database is never closed.
+            if lease:
+                self.leases[guild_id] = self.leases.get(guild_id, 0) + 1
+            db = self.open_dbs[guild_id]
+            await self._evict(self.min_idle, keep=guild_id)
+            return db
+
+    async def _evict(self, min_idle: float, keep: int = None):
+        now = time.monotonic()
+        for guild_id in list(self.open_dbs):
+            if len(self.open_dbs) <= self.max_open:
+                break
+            if guild_id != keep and guild_id not in self.leases and now - self.last_used[guild_id] >= min_idle:
+                await self._close_db(guild_id)
+
+    async def _close_db(self, guild_id: int):
+        db = self.open_dbs.pop(guild_id)
+        self.last_used.pop(guild_id, None)
+        await db.close()
+        logging.info(f"Closed database {db.db_name} for guild {guild_id}.")
+
+    @asynccontextmanager
+    async def offline(self, guild, timeout: float = 60):
+        """Closes the guild's database for the block, e.g. while its file is replaced.
+
+        New get_db calls wait until the block ends, and the first one reopens the database
+        and reruns create_db. The database is only closed once it is unleased and unused for
+        database_min_idle seconds, the same rule as eviction; TimeoutError is raised if that
+        takes longer than timeout seconds.
+        """
+        guild_id = self.resolve_guild_id(guild)
+        if guild_id in self.offline_dbs:
+            raise RuntimeError(f"The database for guild {guild_id} is already offline.")
+        back_online = asyncio.Event()
+        self.offline_dbs[guild_id] = back_online
+        try:
+            deadline = time.monotonic() + timeout
+            while guild_id in self.leases or (guild_id in self.last_used and time.monotonic() - self.last_used[guild_id] < self.min_idle):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"The database for guild {guild_id} is still in use.")
+                await asyncio.sleep(0.5)
+            async with self.lock:
+                if guild_id in self.open_dbs:
+                    await self._close_db(guild_id)
+                self.created.discard(guild_id)
+            yield
+        finally:
+            del self.offline_dbs[guild_id]
+            back_online.set()
+
+    async def close_idle(self):
+        async with self.lock:
+            now = time.monotonic()
+            for guild_id in list(self.open_dbs):
+                if guild_id not in self.leases and now - self.last_used[guild_id] >= self.idle_timeout:
+                    await self._close_db(guild_id)
+            await self._evict(self.min_idle)
+
+    async def close(self):
+        async with self.lock:
+            for guild_id in list(self.open_dbs):
+                await self._close_db(guild_id)
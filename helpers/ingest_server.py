@@ -0,0 +1,121 @@
+import hmac
+import time
+import logging
+from aiohttp import web
+from helpers.guild_manager import GuildManager
+
+
+class IngestServer:
+    """Local HTTP endpoint for points from external sources (streams, webhooks).
+
+    POST /events with "Authorization: Bearer <token>" and a JSON body
+        {"batch_id": "watchtime-2024-05-01", "guild_id": 33333, "events": [["userid", 10, "watchtime"], ...]}
+    adds all events to the guild's database in one transaction. "guild_id" defaults to
+    the first configured guild. A batch id is only ever added once, so a client can
+    safely resend a batch when it did not get an answer.
+    """
+    def __init__(self, guilds: GuildManager, token: str, host: str = "127.0.0.1", port: int = 8765, max_events: int = 10000):
+        self.guilds = guilds
+        self.token = token
+        self.host = host
+        self.port = port
+        self.max_events = max_events
+        self.runner = None
+
+    async def start(self):
+        # Roughly 100 bytes per event is plenty for ids, deltas and short reasons.
+        app = web.Application(client_max_size=max(1024 ** 2, self.max_events * 100))
+        app.router.add_post('/events', self.handle_events)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f"Ingestion endpoint listening on http://{self.host}:{self.port}/events")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _parse(self, body) -> tuple:
+        if not isinstance(body, dict):
+            raise ValueError("The body must be a JSON object.")
+        batch_id = body.get("batch_id")
+        if not isinstance(batch_id, str) or not batch_id:
+            raise ValueError("batch_id must be a non-empty string.")
+        guild_id = body.get("guild_id")
+        if guild_id is not None and not isinstance(guild_id, int):
+            raise ValueError("guild_id must be an integer.")
+        events = body.get("events")
+        if not isinstance(events, list) or not events:
+            raise ValueError("events must be a non-empty list.")
+        if len(events) > self.max_events:
+            raise ValueError(f"A batch can have at most {self.max_events} events.")
+        parsed = []
+        for event in events:
+            if not isinstance(event, list) or len(event) != 3:
+                raise ValueError("Every event must be [userid, delta, reason].")
+            userid, delta, reason = event
+            if not isinstance(userid, (str, int)) or isinstance(delta, bool) or not isinstance(delta, int) or not isinstance(reason, str):
+                raise ValueError(f"Invalid event {event}.")
+            parsed.append((str(userid), delta, reason))
+        return batch_id, self.guilds.resolve_guild_id(guild_id), parsed
+
+    async def handle_events(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {self.token}"):
+            return web.json_response({"error": "Unauthorized."}, status=401)
+        try:
+            batch_id, guild_id, events = self._parse(await request.json())
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        if not self.guilds.is_configured(guild_id):
+            return web.json_response({"error": f"Guild {guild_id} is not configured."}, status=404)
+
+        started = time.perf_counter()
+        db = await self.guilds.get_db(guild_id)
+        added = await db.add_event_batch(batch_id, events)
+        seconds = time.perf_counter() - started
+        events_per_second = len(events) / max(seconds, 1e-9)
+        if added:
+            logging.info(f"Ingested batch {batch_id} for guild {guild_id}: {len(events)} events in {seconds * 1000:.1f}ms ({events_per_second:.0f} events/s).")
+        else:
+            logging.info(f"Skipped batch {batch_id} for guild {guild_id}, it was already ingested.")
+        return web.json_response({
+            "batch_id": batch_id,
+            "events": len(events),
+            "duplicate": not added,
+            "seconds": seconds,
+            "events_per_second": events_per_second
+        })
+
+
+if __name__ == "__main__":
+    import os
+    import asyncio
+    import aiohttp
+
+    async def benchmark():
+        for name in os.listdir('.'):
+            if name.startswith('ingest_bench.db'):
+                os.remove(name)
+        guilds = GuildManager({"db_name": "ingest_bench", "bot_guild": 1})
+        server = IngestServer(guilds, "secret", port=8766)
+        await server.start()
+        headers = {"Authorization": "Bearer secret"}
+        async with aiohttp.ClientSession() as session:
+            for size in (100, 1000, 10000):
+                body = {"batch_id": f"bench-{size}", "events": [[f"u{i % 500}", 1, "watchtime"] for i in range(size)]}
+                started = time.perf_counter()
+                async with session.post("http://127.0.0.1:8766/events", json=body, headers=headers) as response:
+                    result = await response.json()
+                print(f"{size} events: {result['events_per_second']:.0f} events/s in the database, {size / (time.perf_counter() - started):.0f} events/s end to end")
+            async with session.post("http://127.0.0.1:8766/events", json=body, headers=headers) as response:
+                print(f"Resent batch: duplicate={(await response.json())['duplicate']}")
+        db = await guilds.get_db(1)
+        print(f"Total for u0: {await db.get_total_currency('u0')} (expected 23)")
+        await server.stop()
+        await guilds.close()
+        for name in os.listdir('.'):
+            if name.startswith('ingest_bench.db'):
+                os.remove(name)
+
+    asyncio.run(benchmark())
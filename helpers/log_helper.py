@@ -0,0 +1,150 @@
+import os
+import re
+import json
+import time
+import queue
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+# Attributes every LogRecord has; anything else was passed through extra= and is logged as a field.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+# The suffix doRollover gives a rotated file, with a counter when one already has the name.
+_ROTATED_SUFFIX = re.compile(r'\d{8}-\d{6}(\.\d+)?')
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, extra fields and the traceback."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """Rotates once the file reaches max_bytes or at every interval boundary (UTC), whichever comes first.
+
+    Rotated files get a timestamp suffix and only the newest backup_count are kept.
+    """
+    def __init__(self, filename: str, max_bytes: int = 50 * 1024 * 1024, interval: int = 24 * 60 * 60, backup_count: int = 14):
+        super().__init__(filename, 'a', encoding='utf-8')
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.rollover_at = self._next_rollover()
+
+    def _next_rollover(self) -> float:
+        return (int(time.time()) // self.interval + 1) * self.interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            # Checking the size already written avoids formatting every record twice.
+            return self.stream.tell() >= self.max_bytes
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        suffix = datetime.now().strftime("%Y%m%d-%H%M%S")
+        target = f"{self.baseFilename}.{suffix}"
+        counter = 1
+        while os.path.exists(target):
+            target = f"{self.baseFilename}.{suffix}.{counter}"
+            counter += 1
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, target)
+        directory, base = os.path.split(self.baseFilename)
+        # The timestamp suffixes sort chronologically.
+        # Only this handler's own backups; other files may share the prefix.
+        rotated = sorted(name for name in os.listdir(directory) if name.startswith(base + ".") and _ROTATED_SUFFIX.fullmatch(name[len(base) + 1:]))
+        for name in rotated[:max(0, len(rotated) - self.backup_count)]:
+            os.remove(os.path.join(directory, name))
+        self.stream = self._open()
+        self.rollover_at = self._next_rollover()
+
+
+_sample_rates = {}
+_sample_counters = {}
+
+
+def log_sampled(name: str, level: int, msg: str, *args, **fields):
+    """Logs one in every N calls for the sample name, N being set by "sample" in the logging config.
+
+    For hot paths such as per-message points: the skipped calls return before a log
+    record is even created. Kept records carry "sample" and "sample_rate" fields so
+    readers can scale counts back up. msg is %-formatted with args only when kept.
+    """
+    rate = _sample_rates.get(name, 1)
+    count = _sample_counters.get(name, 0)
+    _sample_counters[name] = count + 1
+    if count % rate != 0 or not logging.getLogger().isEnabledFor(level):
+        return
+    logging.log(level, msg, *args, extra={"sample": name, "sample_rate": rate, **fields})
+
+
+def setup_logging(config: dict) -> logging.handlers.QueueListener:
+    """Routes the root logger through a queue to a background thread that does the file I/O.
+
+    config keys (all optional): "file", "level", "max_bytes", "interval",
+    "backup_count", "console" and "sample" (sample name -> keep one in N).
+    """
+    handlers = [SizeAndTimeRotatingFileHandler(
+        config.get("file", "melbot.log"),
+        max_bytes=config.get("max_bytes", 50 * 1024 * 1024),
+        interval=config.get("interval", 24 * 60 * 60),
+        backup_count=config.get("backup_count", 14)
+    )]
+    if config.get("console", False):
+        handlers.append(logging.StreamHandler())
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _sample_rates.clear()
+    _sample_rates.update(config.get("sample", {}))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config.get("level", "INFO"))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        listener = setup_logging({"file": os.path.join(directory, "bench.log"), "max_bytes": 1024 * 1024, "backup_count": 3, "sample": {"message_points": 100}})
+        started = time.perf_counter()
+        for i in range(100000):
+            log_sampled("message_points", logging.INFO, "Message points for %s in guild %s.", i, 1)
+        sampled = time.perf_counter() - started
+        started = time.perf_counter()
+        for i in range(20000):
+            logging.info(f"Event {i}", extra={"userid": str(i)})
+        queued = time.perf_counter() - started
+        listener.stop()
+        files = sorted(os.listdir(directory))
+        print(f"Sampled records: {sampled / 100000 * 1e6:.2f}us each, queued records: {queued / 20000 * 1e6:.2f}us each on the calling thread.")
+        print(f"Files after rotation: {files}")
+        with open(os.path.join(directory, "bench.log")) as file:
+            print(f"Last record: {file.readlines()[-1].strip()}")
@@ -0,0 +1,464 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timezone
+from helpers.db_helper import DBHelper
+from helpers.storage_backend import StorageBackend
+
+
+class MemoryLedger(StorageBackend):
+    """StorageBackend that serves everything from memory, for high traffic events.
+
+    Balances, pity counters, the shop and the users list live in dicts. Every mutation
+    is appended to a log file and applied in memory once the log is fsynced, which is
+    also when it returns; writes that arrive within "fsync_interval" seconds of each
+    other share one fsync, and a failed fsync leaves the state untouched. Every
+    "snapshot_interval" seconds the logged mutations are written to the SQLite
+    database in one transaction, together with the sequence number of the last one,
+    and the log segments they came from are deleted. On startup the state is loaded
+    from SQLite and the log records after that sequence number are replayed.
+    The SQLite database keeps the usual schema, so it can be opened with DBHelper.
+    """
+    def __init__(self, db_name: str, snapshot_interval: float = 60, fsync_interval: float = 0.05):
+        self.store = DBHelper(db_name)
+        self.db_name = self.store.db_name
+        self.log_prefix = db_name + ".ledger"
+        self.snapshot_interval = snapshot_interval
+        self.fsync_interval = fsync_interval
+        self.balances = {}
+        self.aggregated = {}
+        self.pity = {}
+        self.shop = {}
+        self.users = set()
+        self.batches = set()
+        self.logging_batches = set()
+        self.seq = 0
+        self.pending = []
+        self.log_file = None
+        self.log_path = None
+        self.log_buffer = []
+        self.log_waiters = []
+        self.log_lock = asyncio.Lock()
+        self.shop_lock = asyncio.Lock()
+        self.log_ready = asyncio.Event()
+        self.tasks = []
+
+    # --- persistence ---
+    def _segments(self) -> list:
+        directory = os.path.dirname(self.log_prefix) or '.'
+        base = os.path.basename(self.log_prefix)
+        first_seqs = []
+        for name in os.listdir(directory):
+            if name.startswith(base + '.') and name.endswith('.log'):
+                first_seqs.append(int(name[len(base) + 1:-len('.log')]))
+        return [f"{self.log_prefix}.{first_seq}.log" for first_seq in sorted(first_seqs)]
+
+    def _open_segment(self):
+        self.log_path = f"{self.log_prefix}.{self.seq + 1}.log"
+        self.log_file = open(self.log_path, 'a')
+
+    async def initialize(self):
+        await self.store.initialize()
+        await self.store.create_db()
+        async with self.store.write_lock:
+            await self.store.conn.execute('CREATE TABLE IF NOT EXISTS ledger_meta (key text PRIMARY KEY, value integer)')
+            await self.store.conn.commit()
+        await self._load()
+        replayed = self._replay()
+        self._open_segment()
+        self.tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._snapshot_loop())]
+        logging.info(f"Loaded in-memory ledger for {self.db_name}: {len(self.balances)} balances, {replayed} log records replayed.")
+
+    async def create_db(self):
+        # The schema is created in initialize, before the state is loaded from it.
+        pass
+
+    async def _load(self):
+        conn = self.store.conn
+        async with conn.execute("SELECT value FROM ledger_meta WHERE key = 'last_seq'") as cursor:
+            row = await cursor.fetchone()
+            self.seq = row[0] if row else 0
+        async with conn.execute('SELECT userid, total_points FROM points_agg') as cursor:
+            self.aggregated = {str(userid): total for userid, total in await cursor.fetchall()}
+        self.balances = dict(self.aggregated)
+        async with conn.execute('SELECT userid, SUM(currency_change) FROM events GROUP BY userid') as cursor:
+            for userid, total in await cursor.fetchall():
+                self.balances[str(userid)] = self.balances.get(str(userid), 0) + total
+        async with conn.execute('SELECT item_id, item_name, item_price, coalesce(item_file, \'\'), item_description FROM shop') as cursor:
+            self.shop = {row[0]: tuple(row) for row in await cursor.fetchall()}
+        async with conn.execute('SELECT userid FROM users') as cursor:
+            self.users = {str(row[0]) for row in await cursor.fetchall()}
+        async with conn.execute('SELECT batch_id FROM event_batches') as cursor:
+            self.batches = {row[0] for row in await cursor.fetchall()}
+        query = """WITH last_rewards AS (
+                SELECT
+                    userid,
+                    MAX(CASE WHEN reward_rarity = 4 THEN event_timestamp ELSE 0 END) AS last_reward_4,
+                    MAX(CASE WHEN reward_rarity = 5 THEN event_timestamp ELSE 0 END) AS last_reward_5
+                FROM gacha_events
+                GROUP BY userid
+            )
+            SELECT
+                e.userid,
+                SUM(CASE WHEN e.event_timestamp > lr.last_reward_4 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN e.event_timestamp > lr.last_reward_5 THEN 1 ELSE 0 END)
+            FROM gacha_events e
+            JOIN last_rewards lr ON e.userid = lr.userid
+            GROUP BY e.userid"""
+        async with conn.execute(query) as cursor:
+            self.pity = {str(userid): [pity_4, pity_5] for userid, pity_4, pity_5 in await cursor.fetchall()}
+
+    def _replay(self) -> int:
+        replayed = 0
+        for path in self._segments():
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash was never acknowledged.
+                        logging.warning(f"Skipping unreadable record in {path}.")
+                        continue
+                    if record["seq"] <= self.seq:
+                        continue
+                    self.seq = record["seq"]
+                    self._apply(record["op"], record["args"])
+                    self.pending.append(record)
+                    replayed += 1
+        return replayed
+
+    async def _log(self, op: str, *args):
+        self.seq += 1
+        record = {"seq": self.seq, "op": op, "args": list(args)}
+        waiter = asyncio.get_running_loop().create_future()
+        self.log_buffer.append(record)
+        self.log_waiters.append(waiter)
+        self.log_ready.set()
+        await waiter
+
+    def _write_log(self, lines: list):
+        position = self.log_file.tell()
+        try:
+            self.log_file.write("".join(lines))
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+        except Exception:
+            # Cut off what may have reached the file, so a restart doesn't replay writes that failed.
+            try:
+                self.log_file.truncate(position)
+            except Exception as e:
+                logging.error(f"Failed to truncate {self.log_path} after a failed write: {e}")
+            raise
+
+    async def _flush(self):
+        async with self.log_lock:
+            records, waiters = self.log_buffer, self.log_waiters
+            self.log_buffer, self.log_waiters = [], []
+            if not records:
+                return
+            try:
+                await asyncio.to_thread(self._write_log, [json.dumps(record) + "\n" for record in records])
+            except Exception as e:
+                for waiter in waiters:
+                    waiter.set_exception(e)
+                raise
+            # Applied here rather than by the waiters, so memory and the snapshot see the records in log order.
+            for record in records:
+                self._apply(record["op"], record["args"])
+                self.pending.append(record)
+            for waiter in waiters:
+                waiter.set_result(None)
+
+    async def _flush_loop(self):
+        while True:
+            await self.log_ready.wait()
+            # Let the writes of the next few milliseconds share this fsync.
+            await asyncio.sleep(self.fsync_interval)
+            self.log_ready.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                logging.error(f"Failed to write the ledger log: {e}")
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception as e:
+                logging.error(f"Ledger snapshot failed: {e}")
+
+    async def snapshot(self):
+        started = time.perf_counter()
+        await self._flush()
+        async with self.log_lock:
+            if not self.pending:
+                return
+            records, self.pending = self.pending, []
+            # Nothing was logged since the current segment was opened if it already has the next name.
+            if self.log_path != f"{self.log_prefix}.{self.seq + 1}.log":
+                self.log_file.close()
+                self._open_segment()
+            closed_segments = [path for path in self._segments() if path != self.log_path]
+        try:
+            await self._write_snapshot(records)
+        except Exception:
+            self.pending = records + self.pending
+            raise
+        for path in closed_segments:
+            os.remove(path)
+        logging.info(f"Snapshotted {len(records)} ledger records to {self.db_name} in {time.perf_counter() - started:.2f}s.")
+
+    async def _write_snapshot(self, records: list):
+        conn = self.store.conn
+        # The whole snapshot is one transaction on the store's shared connection.
+        async with self.store.write_lock:
+            events = []
+            reasons = set()
+            for record in records:
+                op, args = record["op"], record["args"]
+                if op == "event":
+                    reasons.add(args[2])
+                elif op == "events":
+                    reasons.update(event[2] for event in args[0])
+                elif op == "batch":
+                    reasons.update(event[2] for event in args[2])
+                elif op == "pulls":
+                    reasons.update(event[2] for event in args[0])
+            reason_ids = await self.store._reason_ids(reasons)
+
+            async def insert_events():
+                await conn.executemany('INSERT INTO events VALUES (?, ?, ?, ?)', [(userid, timestamp, change, reason_ids[reason]) for userid, change, reason, timestamp in events])
+                events.clear()
+
+            try:
+                for record in records:
+                    op, args = record["op"], record["args"]
+                    # Runs of events are inserted together, everything else in log order.
+                    if op == "event":
+                        events.append(args)
+                        continue
+                    if op == "events":
+                        events.extend(args[0])
+                        continue
+                    if op == "pulls":
+                        events.extend(args[0])
+                        await conn.executemany('INSERT INTO gacha_events VALUES (?, ?, ?, ?)', args[1])
+                        continue
+                    if op == "batch":
+                        await conn.execute('INSERT INTO event_batches VALUES (?, ?, ?)', (args[0], len(args[2]), args[1]))
+                        events.extend(args[2])
+                        # Logs from before batches carried gacha events have three arguments.
+                        if len(args) > 3 and args[3]:
+                            await conn.executemany('INSERT INTO gacha_events VALUES (?, ?, ?, ?)', args[3])
+                        continue
+                    await insert_events()
+                    if op == "gacha":
+                        await conn.execute('INSERT INTO gacha_events VALUES (?, ?, ?, ?)', args)
+                    elif op == "add_item":
+                        await conn.execute('INSERT INTO shop (item_id, item_name, item_price, item_file, item_description) VALUES (?, ?, ?, ?, ?)', args)
+                    elif op == "remove_item":
+                        await conn.execute('DELETE FROM shop WHERE item_id = ?', args)
+                    elif op == "replace_users":
+                        await conn.execute('DELETE FROM users')
+                        await conn.executemany('INSERT INTO users (userid) VALUES (?)', [(userid,) for userid in args[0]])
+                    elif op == "delete_user":
+                        await conn.execute('DELETE FROM events WHERE userid = ?', args)
+                    elif op == "season":
+                        # Events logged before the new season go to the old tables, later ones to the new.
+                        await self.store._flip_season(args[0], args[1])
+                await insert_events()
+                await conn.execute("INSERT OR REPLACE INTO ledger_meta VALUES ('last_seq', ?)", (records[-1]["seq"],))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.log_file is not None:
+            await self.snapshot()
+            self.log_file.close()
+            self.log_file = None
+        await self.store.close()
+
+    # --- in-memory state ---
+    def _apply(self, op: str, args: list):
+        if op in ("add_item", "remove_item"):
+            self._bump_version("shop")
+        elif op != "gacha":
+            self._bump_version("leaderboard")
+        if op == "event":
+            userid, change = args[0], args[1]
+            self.balances[userid] = self.balances.get(userid, 0) + change
+        elif op == "events":
+            for userid, change, _, _ in args[0]:
+                self.balances[userid] = self.balances.get(userid, 0) + change
+        elif op == "batch":
+            self.batches.add(args[0])
+            for userid, change, _, _ in args[2]:
+                self.balances[userid] = self.balances.get(userid, 0) + change
+            for userid, rarity, _, _ in args[3] if len(args) > 3 else []:
+                self._apply_pull(userid, rarity)
+        elif op == "gacha":
+            self._apply_pull(args[0], args[1])
+        elif op == "pulls":
+            for userid, change, _, _ in args[0]:
+                self.balances[userid] = self.balances.get(userid, 0) + change
+            for userid, rarity, _, _ in args[1]:
+                self._apply_pull(userid, rarity)
+        elif op == "add_item":
+            self.shop[args[0]] = (args[0], args[1], args[2], args[3], args[4])
+        elif op == "remove_item":
+            self.shop.pop(args[0], None)
+        elif op == "replace_users":
+            self.users = set(args[0])
+        elif op == "delete_user":
+            self.balances[args[0]] = self.aggregated.get(args[0], 0)
+        elif op == "season":
+            self.balances = {}
+            self.aggregated = {}
+
+    def _apply_pull(self, userid: str, rarity: int):
+        pity = self.pity.setdefault(userid, [0, 0])
+        pity[0] = 0 if rarity == 4 else pity[0] + 1
+        pity[1] = 0 if rarity == 5 else pity[1] + 1
+
+    @staticmethod
+    def _now() -> int:
+        return int(datetime.now(timezone.utc).timestamp())
+
+    async def add_event(self, userid: str, currency_change: int, reason: str):
+        try:
+            await self._log("event", str(userid), currency_change, reason, self._now())
+        except Exception as e:
+            logging.error(f"Failed to add event: {e}")
+
+    async def add_events(self, events: list):
+        now = self._now()
+        await self._log("events", [[str(userid), currency_change, reason, now] for userid, currency_change, reason in events])
+
+    async def add_event_batch(self, batch_id: str, events: list, event_timestamp: int = None, gacha_events: list = None) -> bool:
+        # A batch id waiting for its fsync is reserved, so the same batch is never logged twice.
+        if batch_id in self.batches or batch_id in self.logging_batches:
+            return False
+        if event_timestamp is None:
+            event_timestamp = self._now()
+        self.logging_batches.add(batch_id)
+        try:
+            await self._log("batch", batch_id, event_timestamp, [[str(userid), currency_change, reason, event_timestamp] for userid, currency_change, reason in events], [[str(userid), reward_rarity, reward_name, timestamp] for userid, reward_rarity, reward_name, timestamp in gacha_events or []])
+        finally:
+            self.logging_batches.discard(batch_id)
+        return True
+
+    async def get_total_currency(self, userid: str) -> int:
+        return self.balances.get(str(userid), 0)
+
+    async def get_live_currency(self, userid: str) -> int:
+        return self.balances.get(str(userid), 0) - self.aggregated.get(str(userid), 0)
+
+    async def get_aggregated_currency(self, userid: str) -> int:
+        return self.aggregated.get(str(userid), 0)
+
+    async def get_leaderboard(self, limit: int = 10) -> list:
+        return heapq.nlargest(limit, ((userid, self.balances.get(userid, 0)) for userid in self.users if userid in self.balances), key=lambda row: row[1])
+
+    async def iter_balances(self, batch_size: int = 1000):
+        for userid in sorted(self.balances):
+            yield userid, self.balances[userid]
+
+    async def iter_leaderboard(self, batch_size: int = 1000):
+        rows = sorted(((userid, self.balances[userid]) for userid in self.users if userid in self.balances), key=lambda row: row[1], reverse=True)
+        for row in rows:
+            yield row
+
+    async def aggregate_points_async(self, cutoff_timestamp):
+        # Aggregation only moves points between tables, so it runs on the snapshot.
+        await self.snapshot()
+        await self.store.aggregate_points_async(cutoff_timestamp)
+        async with self.store.conn.execute('SELECT userid, total_points FROM points_agg') as cursor:
+            self.aggregated = {str(userid): total for userid, total in await cursor.fetchall()}
+
+    async def get_economy(self, since_timestamp: float) -> list:
+        # The rollups are kept by the SQLite triggers, so the report runs on the snapshot.
+        await self.snapshot()
+        return await self.store.get_economy(since_timestamp)
+
+    async def get_economy_users(self, reason: str, since_timestamp: float, limit: int = 10) -> list:
+        await self.snapshot()
+        return await self.store.get_economy_users(reason, since_timestamp, limit)
+
+    async def start_season(self, name: str) -> int:
+        # Balances reset in memory right away; the tables switch with the snapshot, in log order.
+        await self._log("season", name, self._now())
+        await self.snapshot()
+        await self.store._finish_season_snapshots()
+        return await self.store._active_season()
+
+    async def get_seasons(self) -> list:
+        return await self.store.get_seasons()
+
+    async def get_season_leaderboard(self, season_id: int, limit: int = 10) -> list:
+        if season_id == await self.store._active_season():
+            return await self.get_leaderboard(limit)
+        return await self.store.get_season_leaderboard(season_id, limit)
+
+    async def add_item(self, item_name: str, item_price: int, item_description: str, item_file: str):
+        # The shop only changes after the fsync, so shop edits wait for each other to see it.
+        async with self.shop_lock:
+            if any(item[1] == item_name for item in self.shop.values()):
+                raise ValueError(f"Item {item_name} already exists.")
+            item_id = max(self.shop, default=0) + 1
+            await self._log("add_item", item_id, item_name, item_price, item_file, item_description)
+
+    async def remove_item_by_id(self, item_id: int) -> int:
+        async with self.shop_lock:
+            if item_id not in self.shop:
+                return 0
+            await self._log("remove_item", item_id)
+            return 1
+
+    async def remove_item_by_name(self, item_name: str) -> int:
+        async with self.shop_lock:
+            item_id = next((item_id for item_id, item in self.shop.items() if item[1] == item_name), None)
+            if item_id is None:
+                return 0
+            await self._log("remove_item", item_id)
+            return 1
+
+    async def buy_items_by_id(self, item_id: int):
+        item = self.shop.get(item_id)
+        # Like DBHelper, an item without a file has '' rather than None, which is how the shop command tells them apart.
+        return (item[2], item[3] or '') if item else None
+
+    async def buy_items_by_name(self, item_name: str):
+        for item in self.shop.values():
+            if item[1] == item_name:
+                return item[2], item[3] or ''
+        return None, None
+
+    async def get_shop_items(self) -> list:
+        return [(item[0], item[1], item[2], item[4]) for item in self.shop.values()]
+
+    async def add_gacha_event(self, userid: str, reward_rarity: int, reward_name: str, event_timestamp: float):
+        await self._log("gacha", str(userid), reward_rarity, reward_name, event_timestamp)
+
+    async def add_gacha_events(self, events: list, gacha_events: list):
+        now = self._now()
+        await self._log("pulls", [[str(userid), currency_change, reason, now] for userid, currency_change, reason in events], [[str(userid), reward_rarity, reward_name, event_timestamp] for userid, reward_rarity, reward_name, event_timestamp in gacha_events])
+
+    async def get_pity(self, userid: str):
+        pity = self.pity.get(str(userid))
+        return (pity[0], pity[1]) if pity else (0, 0)
+
+    async def replace_users(self, user_list: list, batch_size: int = -1):
+        await self._log("replace_users", [str(member.id) for member in user_list])
+
+    async def delete_user(self, userid: str):
+        await self._log("delete_user", str(userid))
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+
+
+class Outbox:
+    """Durable spool for ledger writes that failed, retried until they are applied exactly once.
+
+    A failed write is appended to the spool file under a new batch id, and put only
+    returns once the file is fsynced. A background task retries the pending batches,
+    oldest first, with exponential backoff from "retry_interval" up to
+    "max_retry_interval" seconds. Retries go through add_event_batch, which records the
+    batch id in the same transaction as the events, so a batch whose result was lost
+    is never applied twice. Batches are applied with their original timestamp, together
+    with the gacha events of the pulls they paid for, if any.
+    Applied batches are marked done by another record; the file is rewritten with only
+    the pending batches when it is empty or past "compact_bytes". Batches still failing
+    after "max_age" seconds are dropped and logged in full, so they can be re-entered.
+    """
+    def __init__(self, path: str, retry_interval: float = 1.0, max_retry_interval: float = 60.0, max_age: float = 7 * 24 * 60 * 60, compact_bytes: int = 1024 * 1024):
+        self.path = path
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_age = max_age
+        self.compact_bytes = compact_bytes
+        self.pending = {}
+        self.stats = {"spooled": 0, "applied": 0, "duplicates": 0, "failed_retries": 0, "dropped": 0}
+        self.apply = None
+        self.file = None
+        self.task = None
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    def metrics(self) -> dict:
+        return {**self.stats, "pending": len(self.pending), "pending_events": sum(len(entry["events"]) for entry in self.pending.values())}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash was never acknowledged.
+                    logging.warning(f"Skipping unreadable record in {self.path}.")
+                    continue
+                if "done" in record:
+                    self.pending.pop(record["done"], None)
+                else:
+                    self.pending[record["id"]] = record
+
+    async def start(self, apply):
+        """apply(batch_id, events, event_timestamp, gacha_events) adds a batch once and returns False for one it already has."""
+        self.apply = apply
+        await asyncio.to_thread(self._load)
+        self.file = open(self.path, 'a')
+        self.task = asyncio.create_task(self._retry_loop())
+        if self.pending:
+            logging.warning(f"{len(self.pending)} ledger writes are waiting in {self.path}.")
+            self.wake.set()
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        # One last try, whatever is left is retried when the database is opened again.
+        if self.pending:
+            await self.flush()
+        self.file.close()
+        self.file = None
+
+    def _append(self, records: list):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _compact(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write("".join(json.dumps(entry) + "\n" for entry in self.pending.values()))
+            file.flush()
+            os.fsync(file.fileno())
+        self.file.close()
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a')
+
+    async def put(self, events: list, event_timestamp: int, gacha_events: list = None) -> str:
+        entry = {"id": uuid.uuid4().hex, "timestamp": event_timestamp, "events": [list(event) for event in events]}
+        if gacha_events:
+            entry["gacha_events"] = [list(gacha_event) for gacha_event in gacha_events]
+        async with self.lock:
+            await asyncio.to_thread(self._append, [entry])
+            # Added under the lock, so a compaction never rewrites the file without it.
+            self.pending[entry["id"]] = entry
+        self.stats["spooled"] += 1
+        self.wake.set()
+        return entry["id"]
+
+    async def flush(self) -> bool:
+        """Retries the pending batches in order. Returns False when one failed again; later ones wait for the next try."""
+        done = []
+        succeeded = True
+        for batch_id, entry in list(self.pending.items()):
+            if time.time() - entry["timestamp"] > self.max_age:
+                logging.error(f"Dropping ledger write {batch_id} from {entry['timestamp']} after {self.max_age}s of retries: {entry['events']}")
+                self.stats["dropped"] += 1
+            else:
+                try:
+                    added = await self.apply(batch_id, entry["events"], entry["timestamp"], entry.get("gacha_events"))
+                except Exception as e:
+                    logging.warning(f"Retrying ledger write {batch_id} failed: {e}")
+                    self.stats["failed_retries"] += 1
+                    succeeded = False
+                    break
+                self.stats["applied" if added else "duplicates"] += 1
+            del self.pending[batch_id]
+            done.append({"done": batch_id})
+        if done:
+            async with self.lock:
+                await asyncio.to_thread(self._append, done)
+                if not self.pending or os.path.getsize(self.path) > self.compact_bytes:
+                    await asyncio.to_thread(self._compact)
+            logging.info(f"Outbox {self.path}: {len(done)} batches done, {len(self.pending)} pending.")
+        return succeeded
+
+    async def _retry_loop(self):
+        delay = self.retry_interval
+        while True:
+            if not self.pending:
+                self.wake.clear()
+                await self.wake.wait()
+                delay = self.retry_interval
+            # Jitter keeps the retries of several processes from colliding again.
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            if await self.flush():
+                delay = self.retry_interval
+            else:
+                delay = min(delay * 2, self.max_retry_interval)
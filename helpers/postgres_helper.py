@@ -0,0 +1,602 @@
+import re
+import logging
+from datetime import datetime, timezone
+from helpers.storage_backend import StorageBackend
+from helpers.outbox import Outbox
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+class PostgresHelper(StorageBackend):
+    """StorageBackend on a PostgreSQL server through an asyncpg connection pool.
+
+    Each guild lives in its own schema of a shared database. asyncpg prepares every
+    query on first use and reuses the prepared statement on that connection, up to
+    "statement_cache_size" statements per connection.
+    """
+    def __init__(self, dsn: str, schema: str = "melbot", min_size: int = 1, max_size: int = 5, statement_cache_size: int = 100, outbox: Outbox = None):
+        if asyncpg is None:
+            raise RuntimeError("The postgres backend needs asyncpg, install it with 'pip install asyncpg'.")
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', schema):
+            raise ValueError(f"Invalid schema name {schema}.")
+        self.dsn = dsn
+        self.schema = schema
+        self.db_name = schema
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.pool = None
+        self.reason_ids = {}
+        # Failed ledger writes are spooled here and retried; see Outbox.
+        self.outbox = outbox
+
+    async def initialize(self):
+        # The schema must exist before it can be on the pool's search_path.
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            await conn.execute(f'CREATE SCHEMA IF NOT EXISTS {self.schema}')
+        finally:
+            await conn.close()
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+            server_settings={'search_path': self.schema}
+        )
+        if self.outbox:
+            await self.outbox.start(self.add_event_batch)
+
+    async def close(self):
+        if self.outbox:
+            await self.outbox.stop()
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def __aenter__(self):
+        await self.initialize()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def create_db(self):
+        if self.pool is None:
+            raise RuntimeError("Database connection is not initialized.")
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS reasons
+                    (
+                        reason_id serial PRIMARY KEY,
+                        reason text UNIQUE
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS economy_daily
+                    (
+                        day integer,
+                        reason_id integer,
+                        earned bigint,
+                        spent bigint,
+                        event_count bigint,
+                        PRIMARY KEY (day, reason_id)
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS economy_user_daily
+                    (
+                        reason_id integer,
+                        day integer,
+                        userid text,
+                        earned bigint,
+                        spent bigint,
+                        event_count bigint,
+                        PRIMARY KEY (reason_id, day, userid)
+                    )
+                ''')
+                # Every event is added to the daily rollups as it is written, once per statement
+                # from its transition table; the rollups are never reduced, so they keep the
+                # history after events are aggregated or deleted.
+                await conn.execute('''
+                    CREATE OR REPLACE FUNCTION economy_rollup() RETURNS trigger LANGUAGE plpgsql AS $$
+                    BEGIN
+                        INSERT INTO economy_daily (day, reason_id, earned, spent, event_count)
+                        SELECT event_timestamp / 86400, reason_id, SUM(GREATEST(currency_change, 0)), SUM(GREATEST(-currency_change, 0)), COUNT(*)
+                        FROM new_events
+                        GROUP BY 1, 2
+                        ORDER BY 1, 2
+                        ON CONFLICT (day, reason_id) DO UPDATE
+                        SET earned = economy_daily.earned + excluded.earned,
+                            spent = economy_daily.spent + excluded.spent,
+                            event_count = economy_daily.event_count + excluded.event_count;
+                        INSERT INTO economy_user_daily (reason_id, day, userid, earned, spent, event_count)
+                        SELECT reason_id, event_timestamp / 86400, userid, SUM(GREATEST(currency_change, 0)), SUM(GREATEST(-currency_change, 0)), COUNT(*)
+                        FROM new_events
+                        GROUP BY 1, 2, 3
+                        ORDER BY 1, 2, 3
+                        ON CONFLICT (reason_id, day, userid) DO UPDATE
+                        SET earned = economy_user_daily.earned + excluded.earned,
+                            spent = economy_user_daily.spent + excluded.spent,
+                            event_count = economy_user_daily.event_count + excluded.event_count;
+                        RETURN NULL;
+                    END
+                    $$
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS seasons
+                    (
+                        season_id integer PRIMARY KEY,
+                        name text,
+                        started_at bigint,
+                        ended_at bigint,
+                        snapshot_done boolean DEFAULT false
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS season_balances
+                    (
+                        season_id integer,
+                        userid text,
+                        total_points bigint,
+                        PRIMARY KEY (season_id, userid)
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_season_balances_points ON season_balances(season_id, total_points)')
+                await conn.execute("INSERT INTO seasons (season_id, name, started_at) SELECT 1, 'Season 1', $1 WHERE NOT EXISTS (SELECT 1 FROM seasons)", int(datetime.now(timezone.utc).timestamp()))
+                await self._create_ledger_tables(conn)
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS shop
+                    (
+                        item_id serial PRIMARY KEY,
+                        item_name text UNIQUE,
+                        item_price bigint,
+                        item_file text,
+                        item_description text
+                    )
+                ''')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS gacha_events
+                    (
+                        userid text,
+                        reward_rarity integer,
+                        reward_name text,
+                        event_timestamp double precision
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_gacha_userid ON gacha_events(userid, event_timestamp)')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS users
+                    (
+                        userid text
+                    )
+                ''')
+                await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_userid ON users(userid)')
+                await conn.execute('''
+                    CREATE TABLE IF NOT EXISTS event_batches
+                    (
+                        batch_id text PRIMARY KEY,
+                        event_count integer,
+                        event_timestamp bigint
+                    )
+                ''')
+
+    async def _create_ledger_tables(self, conn):
+        # The tables a season resets.
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS events
+            (
+                userid text,
+                event_timestamp bigint,
+                currency_change bigint,
+                reason_id integer
+            )
+        ''')
+        has_reason_text = await conn.fetchval('''
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = $1 AND table_name = 'events' AND column_name = 'reason'
+            )
+        ''', self.schema)
+        if has_reason_text:
+            await self._intern_event_reasons(conn)
+        await conn.execute('DROP TRIGGER IF EXISTS events_economy_rollup ON events')
+        await conn.execute('''
+            CREATE TRIGGER events_economy_rollup AFTER INSERT ON events
+            REFERENCING NEW TABLE AS new_events
+            FOR EACH STATEMENT EXECUTE FUNCTION economy_rollup()
+        ''')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_userid ON events(userid)')
+        await conn.execute('CREATE INDEX IF NOT EXISTS idx_event_timestamp ON events(event_timestamp)')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS points_agg
+            (
+                userid text PRIMARY KEY,
+                total_points bigint,
+                last_update bigint
+            )
+        ''')
+
+    async def _intern_event_reasons(self, conn):
+        # Schemas from before reasons were interned keep the reason text in every event.
+        # Runs inside create_db's transaction, so the switch to reason ids is all or nothing.
+        await conn.execute("INSERT INTO reasons (reason) SELECT DISTINCT coalesce(reason, '') FROM events ON CONFLICT (reason) DO NOTHING")
+        await conn.execute('ALTER TABLE events ADD COLUMN reason_id integer')
+        await conn.execute("UPDATE events e SET reason_id = r.reason_id FROM reasons r WHERE r.reason = coalesce(e.reason, '')")
+        await conn.execute('ALTER TABLE events DROP COLUMN reason')
+        await conn.execute('''
+            INSERT INTO economy_daily (day, reason_id, earned, spent, event_count)
+            SELECT event_timestamp / 86400, reason_id, SUM(GREATEST(currency_change, 0)), SUM(GREATEST(-currency_change, 0)), COUNT(*)
+            FROM events
+            GROUP BY 1, 2
+        ''')
+        await conn.execute('''
+            INSERT INTO economy_user_daily (reason_id, day, userid, earned, spent, event_count)
+            SELECT reason_id, event_timestamp / 86400, userid, SUM(GREATEST(currency_change, 0)), SUM(GREATEST(-currency_change, 0)), COUNT(*)
+            FROM events
+            GROUP BY 1, 2, 3
+        ''')
+        logging.info(f"Interned the event reasons of schema {self.schema}.")
+
+    async def _reason_ids(self, reasons) -> dict:
+        """Maps reasons to their interned ids, adding new reasons outside of any event transaction."""
+        missing = list({reason for reason in reasons if reason not in self.reason_ids})
+        if missing:
+            await self.pool.execute('INSERT INTO reasons (reason) SELECT unnest($1::text[]) ON CONFLICT (reason) DO NOTHING', missing)
+            for reason_id, reason in await self.pool.fetch('SELECT reason_id, reason FROM reasons WHERE reason = ANY($1::text[])', missing):
+                self.reason_ids[reason] = reason_id
+        return self.reason_ids
+
+    @staticmethod
+    def _rowcount(status: str) -> int:
+        # asyncpg returns the command tag, e.g. "DELETE 3".
+        return int(status.split()[-1])
+
+    async def _insert_events(self, events: list, event_timestamp: int):
+        reason_ids = await self._reason_ids(reason for _, _, reason in events)
+        query = 'INSERT INTO events VALUES ($1, $2, $3, $4)'
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(query, [(str(userid), event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+        self._bump_version("leaderboard")
+
+    async def add_event(self, userid: str, currency_change: int, reason: str):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        try:
+            await self._insert_events([(userid, currency_change, reason)], event_timestamp)
+        except Exception as e:
+            await self._spool_failed_write([(str(userid), currency_change, reason)], event_timestamp, e)
+
+    async def add_events(self, events: list):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        try:
+            await self._insert_events(events, event_timestamp)
+        except Exception as e:
+            if self.outbox is None:
+                raise
+            await self._spool_failed_write([(str(userid), change, reason) for userid, change, reason in events], event_timestamp, e)
+
+    async def add_event_batch(self, batch_id: str, events: list, event_timestamp: int = None, gacha_events: list = None) -> bool:
+        reason_ids = await self._reason_ids(reason for _, _, reason in events)
+        if event_timestamp is None:
+            event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                query = 'INSERT INTO event_batches VALUES ($1, $2, $3) ON CONFLICT (batch_id) DO NOTHING'
+                if self._rowcount(await conn.execute(query, batch_id, len(events), event_timestamp)) == 0:
+                    return False
+                query = 'INSERT INTO events VALUES ($1, $2, $3, $4)'
+                await conn.executemany(query, [(str(userid), event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+                if gacha_events:
+                    await conn.executemany('INSERT INTO gacha_events VALUES ($1, $2, $3, $4)', [(str(userid), reward_rarity, reward_name, float(timestamp)) for userid, reward_rarity, reward_name, timestamp in gacha_events])
+        self._bump_version("leaderboard")
+        return True
+
+    async def get_live_currency(self, userid: str):
+        result = await self.pool.fetchval('SELECT SUM(currency_change)::bigint FROM events WHERE userid=$1', str(userid))
+        return result if result is not None else 0
+
+    async def get_aggregated_currency(self, userid: str):
+        result = await self.pool.fetchval('SELECT total_points FROM points_agg WHERE userid=$1', str(userid))
+        return result if result is not None else 0
+
+    async def get_leaderboard(self, limit: int = 10):
+        query = '''
+            SELECT sq.userid, SUM(sq.total_points)::bigint AS total_points
+            FROM (
+                SELECT userid, SUM(currency_change) AS total_points FROM events GROUP BY userid
+                UNION ALL
+                SELECT userid, total_points FROM points_agg
+            ) sq
+            JOIN users u
+                ON sq.userid = u.userid
+            GROUP BY sq.userid
+            ORDER BY total_points DESC
+            LIMIT $1
+        '''
+        return [tuple(row) for row in await self.pool.fetch(query, limit)]
+
+    async def _iter_rows(self, query: str, batch_size: int):
+        # A server-side cursor only keeps batch_size rows on the client at a time.
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                async for row in conn.cursor(query, prefetch=batch_size):
+                    yield tuple(row)
+
+    async def iter_balances(self, batch_size: int = 1000):
+        query = '''
+            SELECT userid, SUM(total_points)::bigint AS total_points
+            FROM (
+                SELECT userid, SUM(currency_change) AS total_points FROM events GROUP BY userid
+                UNION ALL
+                SELECT userid, total_points FROM points_agg
+            ) sq
+            GROUP BY userid
+            ORDER BY userid
+        '''
+        async for row in self._iter_rows(query, batch_size):
+            yield row
+
+    async def iter_leaderboard(self, batch_size: int = 1000):
+        query = '''
+            SELECT sq.userid, SUM(sq.total_points)::bigint AS total_points
+            FROM (
+                SELECT userid, SUM(currency_change) AS total_points FROM events GROUP BY userid
+                UNION ALL
+                SELECT userid, total_points FROM points_agg
+            ) sq
+            JOIN users u
+                ON sq.userid = u.userid
+            GROUP BY sq.userid
+            ORDER BY total_points DESC
+        '''
+        async for row in self._iter_rows(query, batch_size):
+            yield row
+
+    async def aggregate_points_async(self, cutoff_timestamp):
+        # Moving the events and adding them to points_agg is a single atomic statement.
+        query = '''
+            WITH moved AS (
+                DELETE FROM events WHERE event_timestamp < $1
+                RETURNING userid, currency_change, event_timestamp
+            )
+            INSERT INTO points_agg (userid, total_points, last_update)
+            SELECT userid, SUM(currency_change), MAX(event_timestamp)
+            FROM moved
+            GROUP BY userid
+            ON CONFLICT (userid) DO UPDATE
+            SET total_points = points_agg.total_points + excluded.total_points,
+                last_update = GREATEST(points_agg.last_update, excluded.last_update)
+        '''
+        await self.pool.execute(query, int(cutoff_timestamp))
+
+    async def get_economy(self, since_timestamp: float) -> list:
+        query = '''
+            SELECT r.reason, SUM(d.earned)::bigint, SUM(d.spent)::bigint, SUM(d.event_count)::bigint
+            FROM economy_daily d
+            JOIN reasons r ON r.reason_id = d.reason_id
+            WHERE d.day >= $1
+            GROUP BY r.reason
+            ORDER BY SUM(d.earned) + SUM(d.spent) DESC
+        '''
+        return [tuple(row) for row in await self.pool.fetch(query, self.rollup_day(since_timestamp))]
+
+    async def get_economy_users(self, reason: str, since_timestamp: float, limit: int = 10) -> list:
+        query = '''
+            SELECT u.userid, SUM(u.earned)::bigint, SUM(u.spent)::bigint, SUM(u.event_count)::bigint
+            FROM economy_user_daily u
+            JOIN reasons r ON r.reason_id = u.reason_id
+            WHERE r.reason = $1 AND u.day >= $2
+            GROUP BY u.userid
+            ORDER BY SUM(u.earned) + SUM(u.spent) DESC
+            LIMIT $3
+        '''
+        return [tuple(row) for row in await self.pool.fetch(query, reason, self.rollup_day(since_timestamp), limit)]
+
+    async def start_season(self, name: str) -> int:
+        timestamp = int(datetime.now(timezone.utc).timestamp())
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Renames only change the catalog; the locks they take are held for the rest of this short transaction.
+                await conn.execute('LOCK TABLE seasons IN EXCLUSIVE MODE')
+                season_id = await conn.fetchval('SELECT MAX(season_id) FROM seasons')
+                await conn.execute(f'ALTER TABLE events RENAME TO events_season_{season_id}')
+                await conn.execute(f'ALTER TABLE points_agg RENAME TO points_agg_season_{season_id}')
+                # Index names are unique per schema, so the old ones make way for the new tables'.
+                await conn.execute(f'ALTER INDEX idx_userid RENAME TO idx_userid_season_{season_id}')
+                await conn.execute(f'ALTER INDEX idx_event_timestamp RENAME TO idx_event_timestamp_season_{season_id}')
+                await conn.execute(f'ALTER INDEX points_agg_pkey RENAME TO points_agg_season_{season_id}_pkey')
+                await conn.execute(f'DROP TRIGGER IF EXISTS events_economy_rollup ON events_season_{season_id}')
+                await conn.execute('UPDATE seasons SET ended_at = $1 WHERE season_id = $2', timestamp, season_id)
+                await conn.execute('INSERT INTO seasons (season_id, name, started_at) VALUES ($1, $2, $3)', season_id + 1, name, timestamp)
+                await self._create_ledger_tables(conn)
+        self._bump_version("leaderboard")
+        await self._finish_season_snapshots()
+        return season_id + 1
+
+    async def _finish_season_snapshots(self):
+        # Past seasons' tables never change, and MVCC lets the copy run without blocking the live ledger.
+        async with self.pool.acquire() as conn:
+            season_ids = [row[0] for row in await conn.fetch('SELECT season_id FROM seasons WHERE ended_at IS NOT NULL AND NOT snapshot_done')]
+            for season_id in season_ids:
+                async with conn.transaction():
+                    await conn.execute(f'''
+                        INSERT INTO season_balances (season_id, userid, total_points)
+                        SELECT $1, userid, SUM(total_points)
+                        FROM (
+                            SELECT userid, SUM(currency_change) AS total_points FROM events_season_{season_id} GROUP BY userid
+                            UNION ALL
+                            SELECT userid, total_points FROM points_agg_season_{season_id}
+                        ) sq
+                        GROUP BY userid
+                        ON CONFLICT (season_id, userid) DO NOTHING
+                    ''', season_id)
+                    await conn.execute('UPDATE seasons SET snapshot_done = true WHERE season_id = $1', season_id)
+                logging.info(f"Saved the balances for season {season_id} of schema {self.schema}.")
+
+    async def get_seasons(self) -> list:
+        return [tuple(row) for row in await self.pool.fetch('SELECT season_id, name, started_at, ended_at FROM seasons ORDER BY season_id')]
+
+    async def get_season_leaderboard(self, season_id: int, limit: int = 10) -> list:
+        if season_id == await self.pool.fetchval('SELECT MAX(season_id) FROM seasons'):
+            return await self.get_leaderboard(limit)
+        await self._finish_season_snapshots()
+        query = 'SELECT userid, total_points FROM season_balances WHERE season_id = $1 ORDER BY total_points DESC LIMIT $2'
+        return [tuple(row) for row in await self.pool.fetch(query, season_id, limit)]
+
+    async def add_item(self, item_name: str, item_price: int, item_description: str, item_file: str):
+        # Ids are max + 1 like SQLite's integer primary key, not the serial sequence, so removing the
+        # newest item frees its id on every backend.
+        query = 'INSERT INTO shop (item_id, item_name, item_price, item_description, item_file) SELECT COALESCE(MAX(item_id), 0) + 1, $1, $2, $3, $4 FROM shop'
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('LOCK TABLE shop IN EXCLUSIVE MODE')
+                await conn.execute(query, item_name, item_price, item_description, item_file)
+        self._bump_version("shop")
+
+    async def remove_item_by_id(self, item_id: int):
+        rows_deleted = self._rowcount(await self.pool.execute('DELETE FROM shop WHERE item_id=$1', item_id))
+        self._bump_version("shop")
+        return rows_deleted
+
+    async def remove_item_by_name(self, item_name: str) -> int:
+        rows_deleted = self._rowcount(await self.pool.execute('DELETE FROM shop WHERE item_name=$1', item_name))
+        self._bump_version("shop")
+        return rows_deleted
+
+    async def buy_items_by_id(self, item_id: int):
+        query = "SELECT item_price, coalesce(item_file, '') as item_file FROM shop WHERE item_id=$1"
+        result = await self.pool.fetchrow(query, item_id)
+        return tuple(result) if result else None
+
+    async def buy_items_by_name(self, item_name: str):
+        query = "SELECT item_price, coalesce(item_file, '') as item_file FROM shop WHERE item_name=$1"
+        result = await self.pool.fetchrow(query, item_name)
+        return tuple(result) if result else (None, None)
+
+    async def get_shop_items(self):
+        rows = await self.pool.fetch('SELECT item_id, item_name, item_price, item_description FROM shop ORDER BY item_id')
+        return [tuple(row) for row in rows]
+
+    async def add_gacha_event(self, userid: str, reward_rarity: int, reward_name: str, event_timestamp: float):
+        query = 'INSERT INTO gacha_events VALUES ($1, $2, $3, $4)'
+        await self.pool.execute(query, str(userid), reward_rarity, reward_name, float(event_timestamp))
+
+    async def add_gacha_events(self, events: list, gacha_events: list):
+        event_timestamp = int(datetime.now(timezone.utc).timestamp())
+        try:
+            reason_ids = await self._reason_ids(reason for _, _, reason in events)
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany('INSERT INTO events VALUES ($1, $2, $3, $4)', [(str(userid), event_timestamp, currency_change, reason_ids[reason]) for userid, currency_change, reason in events])
+                    await conn.executemany('INSERT INTO gacha_events VALUES ($1, $2, $3, $4)', [(str(userid), reward_rarity, reward_name, float(timestamp)) for userid, reward_rarity, reward_name, timestamp in gacha_events])
+        except Exception as e:
+            if self.outbox is None:
+                raise
+            await self._spool_failed_write([(str(userid), change, reason) for userid, change, reason in events], event_timestamp, e, [(str(userid), reward_rarity, reward_name, float(timestamp)) for userid, reward_rarity, reward_name, timestamp in gacha_events])
+            return
+        self._bump_version("leaderboard")
+
+    async def get_pity(self, userid: str):
+        query = """WITH last_rewards AS (
+                SELECT
+                    MAX(CASE WHEN reward_rarity = 4 THEN event_timestamp ELSE 0 END) AS last_reward_4,
+                    MAX(CASE WHEN reward_rarity = 5 THEN event_timestamp ELSE 0 END) AS last_reward_5
+                FROM gacha_events
+                WHERE userid = $1
+            )
+            SELECT
+                SUM(CASE WHEN e.event_timestamp > lr.last_reward_4 THEN 1 ELSE 0 END),
+                SUM(CASE WHEN e.event_timestamp > lr.last_reward_5 THEN 1 ELSE 0 END)
+            FROM gacha_events e, last_rewards lr
+            WHERE e.userid = $1"""
+        result = await self.pool.fetchrow(query, str(userid))
+        if result is None or result[0] is None:
+            return 0, 0
+        return result[0], result[1]
+
+    async def replace_users(self, user_list: list, batch_size: int = -1):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('DELETE FROM users')
+                await conn.executemany('INSERT INTO users (userid) VALUES ($1)', [(str(member.id),) for member in user_list])
+        self._bump_version("leaderboard")
+
+    async def delete_user(self, userid: str):
+        await self.pool.execute('DELETE FROM events WHERE userid = $1', str(userid))
+        self._bump_version("leaderboard")
+
+
+if __name__ == "__main__":
+    import os
+    import asyncio
+    from helpers.db_helper import DBHelper
+    from games.blackjack import Blackjack, Card
+
+    class Member:
+        def __init__(self, id):
+            self.id = id
+
+    async def run_operations(db: StorageBackend) -> list:
+        # The same operations on both backends must give the same results.
+        await db.create_db()
+        results = []
+        await db.add_event("u1", 100, "message")
+        await db.add_events([("u1", 200, "gamble"), ("u2", 300, "gamble"), ("u3", -50, "blackjack")])
+        # A blackjack win with an odd bet, settled the way the tables settle it.
+        table = Blackjack()
+        table.add_player("u3", "u3", 15)
+        table.players["u3"].hand = [Card("hearts", 10), Card("hearts", 9)]
+        table.players["dealer"].hand = [Card("clubs", 10), Card("clubs", 7)]
+        await db.add_events([(player_id, currency_change, "blackjack") for player_id, currency_change, _ in table.settle()])
+        await db.add_gacha_events([("u2", -10, "gacha")] * 2, [("u2", 3, "reward", 0.5), ("u2", 4, "reward", 0.5 + 1e-6)])
+        results.append(await db.add_event_batch("batch-1", [("u1", 7, "stream"), ("u2", 3, "stream")]))
+        results.append(await db.add_event_batch("batch-1", [("u1", 7, "stream"), ("u2", 3, "stream")]))
+        await db.replace_users([Member("u1"), Member("u2")])
+        await db.aggregate_points_async(int(datetime.now(timezone.utc).timestamp()) + 1)
+        await db.add_event("u2", 5, "message")
+        results.append([await db.get_total_currency(userid) for userid in ("u1", "u2", "u3", "u4")])
+        results.append(await db.get_leaderboard())
+        results.append([row async for row in db.iter_balances(batch_size=2)])
+        results.append([row async for row in db.iter_leaderboard(batch_size=2)])
+        await db.add_item("gen", 500, "nice gen", "mel.png")
+        await db.add_item("pic", 50, "a pic", "")
+        results.append(await db.buy_items_by_name("gen"))
+        results.append(await db.buy_items_by_name("missing"))
+        results.append(await db.remove_item_by_name("pic"))
+        results.append([item[1:] for item in await db.get_shop_items()])
+        for timestamp, rarity in enumerate([3, 3, 4, 3, 5, 3, 3]):
+            await db.add_gacha_event("u1", rarity, "reward", float(timestamp + 1))
+        results.append(await db.get_pity("u1"))
+        results.append(await db.get_pity("u2"))
+        results.append(await db.get_economy(0))
+        results.append(await db.get_economy_users("gamble", 0))
+        results.append(await db.start_season("Season 2"))
+        await db.add_event("u1", 11, "message")
+        results.append(await db.get_season_leaderboard(1))
+        results.append(await db.get_season_leaderboard(2))
+        results.append([season[:2] for season in await db.get_seasons()])
+        return results
+
+    async def main():
+        if os.path.exists("postgres_check.db"):
+            os.remove("postgres_check.db")
+        sqlite_db = DBHelper("postgres_check")
+        await sqlite_db.initialize()
+        postgres_db = PostgresHelper(os.environ["POSTGRES_DSN"], schema="postgres_check")
+        await postgres_db.initialize()
+        async with postgres_db.pool.acquire() as conn:
+            await conn.execute("DROP SCHEMA IF EXISTS postgres_check CASCADE; CREATE SCHEMA postgres_check")
+        expected = await run_operations(sqlite_db)
+        actual = await run_operations(postgres_db)
+        for sqlite_result, postgres_result in zip(expected, actual):
+            print("ok  " if sqlite_result == postgres_result else "DIFF", sqlite_result, postgres_result)
+        await sqlite_db.close()
+        await postgres_db.close()
+        os.remove("postgres_check.db")
+
+    asyncio.run(main())
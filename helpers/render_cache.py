@@ -0,0 +1,113 @@
+import io
+import time
+import asyncio
+import logging
+
+
+class RenderCache:
+    """Rendered messages (embeds, text, images) keyed by what they show and the data version they were built from.
+
+    A render is reused while the version it was built from is current. With max_stale
+    set, it is also reused for that many seconds after the data changed, which keeps
+    busy leaderboards from being rebuilt on every message. Only one render per key runs
+    at a time; other callers wait for it.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, key: tuple, version, max_stale: float):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        entry_version, rendered_at, value = entry
+        if entry_version == version or time.monotonic() - rendered_at < max_stale:
+            return entry
+        return None
+
+    async def get(self, key: tuple, version, render, max_stale: float = 0):
+        entry = self._fresh(key, version, max_stale)
+        if entry is None:
+            async with self.locks.setdefault(key, asyncio.Lock()):
+                entry = self._fresh(key, version, max_stale)
+                if entry is None:
+                    self.misses += 1
+                    started = time.perf_counter()
+                    entry = (version, time.monotonic(), await render())
+                    self.entries[key] = entry
+                    logging.debug(f"Rendered {key} in {(time.perf_counter() - started) * 1000:.1f}ms.")
+                    return entry[2]
+        self.hits += 1
+        return entry[2]
+
+    def invalidate(self, guild_id: int = None):
+        for key in list(self.entries):
+            if guild_id is None or key[0] == guild_id:
+                self.entries.pop(key)
+
+
+def render_leaderboard_card(title: str, rows: list) -> bytes:
+    """Draws (name, points) rows as a PNG. Returns None when Pillow is not installed.
+
+    Runs in a worker thread, never on the event loop.
+    """
+    # Pillow is only imported once a card is drawn, so it costs nothing at startup.
+    try:
+        from PIL import Image, ImageDraw, ImageFont
+    except ImportError:
+        return None
+    width, row_height, padding = 640, 44, 24
+    height = padding * 2 + row_height * (len(rows) + 1)
+    image = Image.new("RGB", (width, height), (35, 39, 42))
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.load_default(size=24)
+    except TypeError:
+        # Pillow before 10.1 only has the fixed size bitmap font.
+        font = ImageFont.load_default()
+    draw.text((padding, padding), title, fill=(255, 255, 255), font=font)
+    for idx, (name, points) in enumerate(rows):
+        y = padding + row_height * (idx + 1)
+        if idx % 2 == 0:
+            draw.rectangle((padding // 2, y - 6, width - padding // 2, y + row_height - 10), fill=(47, 49, 54))
+        color = [(255, 215, 0), (192, 192, 192), (205, 127, 50)][idx] if idx < 3 else (220, 221, 222)
+        draw.text((padding, y), f"{idx + 1}.", fill=color, font=font)
+        draw.text((padding + 56, y), str(name)[:32], fill=color, font=font)
+        points_text = str(points)
+        draw.text((width - padding - draw.textlength(points_text, font=font), y), points_text, fill=color, font=font)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    async def main():
+        cache = RenderCache()
+        rows = [(f"member{i}", 1000 - i * 37) for i in range(10)]
+
+        async def render():
+            return await asyncio.to_thread(render_leaderboard_card, "Leaderboard", rows)
+
+        started = time.perf_counter()
+        card = await cache.get((1, "leaderboard"), (0, 1), render)
+        first = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(1000):
+            await cache.get((1, "leaderboard"), (0, 1), render)
+        cached = (time.perf_counter() - started) / 1000
+        if card is None:
+            print("Pillow is not installed, no image card.")
+        else:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "leaderboard_card.png")
+                with open(path, "wb") as file:
+                    file.write(card)
+                print(f"Wrote {path} ({len(card)} bytes).")
+        print(f"First render {first * 1000:.1f}ms, cached {cached * 1e6:.1f}us, {cache.hits} hits, {cache.misses} misses.")
+
+    asyncio.run(main())
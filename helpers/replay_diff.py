@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import random
+import logging
+import tempfile
+from types import SimpleNamespace
+import aiosqlite
+from helpers.storage_backend import StorageBackend
+from helpers.worker_pool import resolve_job
+
+# Stream records, one JSON list per line:
+#   ["batch", timestamp, [[userid, change, reason], ...]]
+#   ["gacha", userid, rarity, reward_name, timestamp]
+#   ["add_item", name, price, description, file]
+#   ["remove_item", name]
+#   ["users", [userid, ...]]
+#   ["aggregate", cutoff_timestamp]
+#   ["season", name]
+#   ["check"]  compare the engines here
+
+
+def read_stream(path: str) -> list:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_stream(ops, path: str) -> int:
+    count = 0
+    with open(path, 'w') as file:
+        for op in ops:
+            file.write(json.dumps(op) + "\n")
+            count += 1
+    return count
+
+
+async def record(db_name: str, check_every: int = 10000):
+    """Yields the stream of a guild's SQLite database: its users, shop, aggregated points, events and gacha pulls in time order.
+
+    Points already aggregated into points_agg come first, as one batch before the oldest event.
+    """
+    async with aiosqlite.connect(db_name + ".db") as conn:
+        async with conn.execute('SELECT userid FROM users') as cursor:
+            yield ["users", [str(userid) for userid, in await cursor.fetchall()]]
+        async with conn.execute("SELECT item_name, item_price, item_description, item_file FROM shop ORDER BY item_id") as cursor:
+            for row in await cursor.fetchall():
+                yield ["add_item", *row]
+        async with conn.execute('SELECT MIN(event_timestamp) FROM events') as cursor:
+            first = (await cursor.fetchone())[0] or 0
+        async with conn.execute('SELECT userid, total_points FROM points_agg') as cursor:
+            aggregated = [[str(userid), total, "aggregated"] for userid, total in await cursor.fetchall()]
+        if aggregated:
+            yield ["batch", first - 1, aggregated]
+        query = '''
+            SELECT 'event', e.userid, e.event_timestamp, e.currency_change, coalesce(r.reason, '')
+            FROM events e LEFT JOIN reasons r ON e.reason_id = r.reason_id
+            UNION ALL
+            SELECT 'gacha', userid, event_timestamp, reward_rarity, reward_name FROM gacha_events
+            ORDER BY 3
+        '''
+        count = 0
+        batch = None
+        async with conn.execute(query) as cursor:
+            while rows := await cursor.fetchmany(1000):
+                for kind, userid, timestamp, value, name in rows:
+                    # Events of one second become one batch, like a !gacha 10 or a bulk grant.
+                    if batch is not None and (kind != "event" or batch[1] != timestamp):
+                        yield batch
+                        batch = None
+                    if kind == "event":
+                        if batch is None:
+                            batch = ["batch", timestamp, []]
+                        batch[2].append([str(userid), value, name])
+                    else:
+                        yield ["gacha", str(userid), value, name, timestamp]
+                    count += 1
+                    if count % check_every == 0:
+                        if batch is not None:
+                            yield batch
+                            batch = None
+                        yield ["check"]
+        if batch is not None:
+            yield batch
+        yield ["check"]
+
+
+def generate(users: int = 1000, events: int = 100000, seed: int = 0, start: int = 1700000000, check_every: int = 10000, seasons: int = 1):
+    """Yields a synthetic stream with the mix of a busy guild: chat points, gambling, shop purchases,
+    gacha pulls, member list refreshes and the hourly aggregation, with "seasons" new seasons spread over it."""
+    rng = random.Random(seed)
+    userids = [str(10 ** 17 + rng.randrange(10 ** 17)) for _ in range(users)]
+    timestamp = start
+    last_aggregate = start
+    items = []
+    season_every = events // (seasons + 1) if seasons else 0
+    yield ["users", rng.sample(userids, users * 9 // 10)]
+    for count in range(1, events + 1):
+        # Several events often share a second, which is where ordering bugs hide.
+        timestamp += rng.choice((0, 0, 1, 1, 2, 5))
+        # A few users are much more active than the rest.
+        userid = userids[min(int(rng.paretovariate(1.2)) - 1, users - 1)] if rng.random() < 0.3 else rng.choice(userids)
+        kind = rng.random()
+        if kind < 0.6:
+            yield ["batch", timestamp, [[userid, rng.randint(1, 5), "message"]]]
+        elif kind < 0.75:
+            points = rng.randint(1, 500)
+            yield ["batch", timestamp, [[userid, points if rng.random() < 0.48 else -points, rng.choice(("gamble", "blackjack"))]]]
+        elif kind < 0.85:
+            pulls = rng.choice((1, 1, 1, 10))
+            yield ["batch", timestamp, [[userid, -160 * pulls, "gacha"]]]
+            for pull in range(pulls):
+                rarity = rng.choices((3, 4, 5), weights=(94, 5, 1))[0]
+                yield ["gacha", userid, rarity, f"reward {rarity}", timestamp + pull * 1e-6]
+        elif kind < 0.9 and items:
+            yield ["batch", timestamp, [[userid, -rng.randint(100, 5000), "shop"]]]
+        elif kind < 0.93:
+            grants = rng.sample(userids, rng.randint(2, 50))
+            yield ["batch", timestamp, [[grant, rng.randint(10, 1000), "admin added"] for grant in grants]]
+        elif kind < 0.94:
+            item = f"item {rng.randrange(30)}"
+            if item in items:
+                items.remove(item)
+                yield ["remove_item", item]
+            else:
+                items.append(item)
+                yield ["add_item", item, rng.randint(100, 5000), f"The {item}.", rng.choice((None, f"{item}.png"))]
+        elif kind < 0.945:
+            yield ["users", rng.sample(userids, users * 9 // 10)]
+        else:
+            yield ["batch", timestamp, [[userid, rng.randint(1, 5), "message"]]]
+        if timestamp - last_aggregate >= 3600:
+            last_aggregate = timestamp
+            yield ["aggregate", timestamp - 600]
+        if season_every and count % season_every == 0 and count // season_every <= seasons:
+            yield ["season", f"Season {count // season_every + 1}"]
+        if count % check_every == 0:
+            yield ["check"]
+    yield ["check"]
+
+
+async def open_engine(spec: str, db_name: str, dsn: str = None) -> StorageBackend:
+    """Opens an empty database on "sqlite", "memory", "postgres" or a "module:Class" StorageBackend taking a db_name."""
+    if spec == "sqlite":
+        from helpers.db_helper import DBHelper
+        db = DBHelper(db_name)
+    elif spec == "memory":
+        from helpers.memory_ledger import MemoryLedger
+        # The replay awaits one op at a time, so waiting for other writes to share the fsync only adds latency.
+        db = MemoryLedger(db_name, fsync_interval=0)
+    elif spec == "postgres":
+        from helpers.postgres_helper import PostgresHelper
+        if dsn is None:
+            raise ValueError("The postgres engine needs a dsn.")
+        # A fresh schema per run, so the replay always starts from an empty ledger.
+        db = PostgresHelper(dsn, schema=f"replay_{os.path.basename(db_name)}_{int(time.time())}")
+    else:
+        db = resolve_job(spec)(db_name)
+    await db.initialize()
+    await db.create_db()
+    return db
+
+
+async def capture(db: StorageBackend, userids: list, gacha_userids: list, item_names: list, leaderboard_size: int) -> dict:
+    """Everything the bot can read back from the ledger, for every user."""
+    balances = {str(userid): total for userid, total in [row async for row in db.iter_balances()]}
+    shop_items = await db.get_shop_items()
+    seasons = await db.get_seasons()
+    return {
+        "balance": balances,
+        "total": {userid: await db.get_total_currency(userid) for userid in userids},
+        "leaderboard": [(str(userid), total) for userid, total in await db.get_leaderboard(leaderboard_size)],
+        "pity": {userid: tuple(await db.get_pity(userid)) for userid in gacha_userids},
+        "shop": sorted((name, price, description) for _, name, price, description in shop_items),
+        "buy": {name: tuple(await db.buy_items_by_name(name)) for name in item_names},
+        "buy_by_id": {item_id: tuple(await db.buy_items_by_id(item_id) or ()) for item_id, *_ in shop_items},
+        # The dates differ between the replays, the names and numbers must not.
+        "seasons": {season_id: name for season_id, name, *_ in seasons},
+        "season_leaderboard": {season_id: [(str(userid), total) for userid, total in await db.get_season_leaderboard(season_id, leaderboard_size)] for season_id, *_ in seasons},
+    }
+
+
+async def replay(db: StorageBackend, ops: list, leaderboard_size: int = 50) -> dict:
+    """Applies the stream to db. Returns what it read back at every check, the ops that raised, and the timings."""
+    userids = set()
+    gacha_userids = set()
+    item_names = set()
+    checks = []
+    errors = {}
+    write_time = 0
+    read_time = 0
+    for index, (op, *args) in enumerate(ops):
+        started = time.perf_counter()
+        if op == "check":
+            checks.append(await capture(db, sorted(userids), sorted(gacha_userids), sorted(item_names), leaderboard_size))
+            read_time += time.perf_counter() - started
+            continue
+        try:
+            if op == "batch":
+                await db.add_event_batch(f"replay-{index}", args[1], args[0])
+                userids.update(userid for userid, _, _ in args[1])
+            elif op == "gacha":
+                await db.add_gacha_event(*args)
+                gacha_userids.add(args[0])
+            elif op == "add_item":
+                item_names.add(args[0])
+                await db.add_item(*args)
+            elif op == "remove_item":
+                await db.remove_item_by_name(args[0])
+            elif op == "users":
+                await db.replace_users([SimpleNamespace(id=userid) for userid in args[0]])
+            elif op == "aggregate":
+                await db.aggregate_points_async(args[0])
+            elif op == "season":
+                await db.start_season(args[0])
+            else:
+                raise ValueError(f"Unknown op {op}.")
+        except Exception as e:
+            errors[index] = f"{type(e).__name__}: {e}"
+        write_time += time.perf_counter() - started
+    return {"checks": checks, "errors": errors, "write_time": write_time, "read_time": read_time}
+
+
+def _diff_leaderboard(current: list, candidate: list) -> list:
+    # Users tied on points may come in any order, and a tie may straddle the cut-off.
+    for rank, (left, right) in enumerate(zip(current, candidate), start=1):
+        if left[1] != right[1]:
+            return [f"rank {rank}: {left} != {right}"]
+    if len(current) != len(candidate):
+        return [f"{len(current)} rows != {len(candidate)}"]
+    if not current:
+        return []
+    cutoff = current[-1][1]
+    above = lambda rows: {row for row in rows if row[1] > cutoff}
+    if above(current) != above(candidate):
+        return [f"users {sorted(above(current) - above(candidate))} != {sorted(above(candidate) - above(current))}"]
+    return []
+
+
+def diff(current: dict, candidate: dict, max_differences: int = 20) -> list:
+    """Lists where the candidate's replay differs from the current one, as readable lines."""
+    differences = []
+    for index in sorted(set(current["errors"]) | set(candidate["errors"])):
+        if (index in current["errors"]) != (index in candidate["errors"]):
+            differences.append(f"op {index}: current {current['errors'].get(index, 'ok')}, candidate {candidate['errors'].get(index, 'ok')}")
+    for number, (left, right) in enumerate(zip(current["checks"], candidate["checks"]), start=1):
+        for name in left:
+            if name == "leaderboard":
+                differences += [f"check {number} leaderboard: {line}" for line in _diff_leaderboard(left[name], right[name])]
+            elif name == "season_leaderboard":
+                for season_id in sorted(set(left[name]) | set(right[name])):
+                    differences += [f"check {number} season {season_id} leaderboard: {line}" for line in _diff_leaderboard(left[name].get(season_id, []), right[name].get(season_id, []))]
+            elif name == "shop":
+                if left[name] != right[name]:
+                    differences.append(f"check {number} shop: {left[name]} != {right[name]}")
+            else:
+                # A user missing on one side and at 0 on the other is the same balance.
+                default = 0 if name in ("balance", "total") else None
+                for key in sorted(set(left[name]) | set(right[name]), key=str):
+                    if left[name].get(key, default) != right[name].get(key, default):
+                        differences.append(f"check {number} {name} {key}: {left[name].get(key, default)} != {right[name].get(key, default)}")
+    if len(current["checks"]) != len(candidate["checks"]):
+        differences.append(f"{len(current['checks'])} checks != {len(candidate['checks'])}")
+    if len(differences) > max_differences:
+        differences = differences[:max_differences] + [f"... and {len(differences) - max_differences} more"]
+    return differences
+
+
+async def compare(ops: list, current: str = "sqlite", candidate: str = "memory", dsn: str = None, leaderboard_size: int = 50) -> tuple:
+    """Replays the stream on both engines, each in a fresh database. Returns (differences, results by engine)."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for label, spec in (("current", current), ("candidate", candidate)):
+            db = await open_engine(spec, os.path.join(directory, label), dsn)
+            try:
+                results[label] = await replay(db, ops, leaderboard_size)
+            finally:
+                await db.close()
+            logging.info(f"Replayed {len(ops)} ops on {spec} in {results[label]['write_time']:.2f}s, checks took {results[label]['read_time']:.2f}s.")
+    return diff(results["current"], results["candidate"]), results
+
+
+if __name__ == "__main__":
+    import sys
+    import asyncio
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Record a ledger event stream and replay it on two storage engines, comparing everything read back.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Record the stream of a guild's SQLite database.")
+    record_parser.add_argument("db_name", help="Database name without .db, e.g. melbot_1234.")
+    record_parser.add_argument("--output", required=True)
+    record_parser.add_argument("--check-every", type=int, default=10000, help="Compare the engines every this many events.")
+    generate_parser = subparsers.add_parser("generate", help="Write a synthetic stream.")
+    generate_parser.add_argument("--output", required=True)
+    generate_parser.add_argument("--users", type=int, default=1000)
+    generate_parser.add_argument("--events", type=int, default=100000)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument("--check-every", type=int, default=10000)
+    generate_parser.add_argument("--seasons", type=int, default=1, help="New seasons started along the stream.")
+    run_parser = subparsers.add_parser("run", help="Replay a stream on two engines and compare them.")
+    run_parser.add_argument("stream")
+    run_parser.add_argument("--current", default="sqlite", help="sqlite, memory, postgres or module:Class.")
+    run_parser.add_argument("--candidate", default="memory", help="sqlite, memory, postgres or module:Class.")
+    run_parser.add_argument("--dsn", default=os.environ.get("DB_DSN"), help="PostgreSQL dsn for the postgres engine.")
+    run_parser.add_argument("--leaderboard-size", type=int, default=50)
+    args = parser.parse_args()
+
+    async def main():
+        if args.command == "record":
+            ops = [op async for op in record(args.db_name, args.check_every)]
+            print(f"Recorded {write_stream(ops, args.output)} ops.")
+            return 0
+        if args.command == "generate":
+            print(f"Generated {write_stream(generate(args.users, args.events, args.seed, check_every=args.check_every, seasons=args.seasons), args.output)} ops.")
+            return 0
+        ops = read_stream(args.stream)
+        differences, results = await compare(ops, args.current, args.candidate, args.dsn, args.leaderboard_size)
+        for label, spec in (("current", args.current), ("candidate", args.candidate)):
+            result = results[label]
+            print(f"{label} ({spec}): writes {result['write_time']:.2f}s, reads {result['read_time']:.2f}s, {len(result['errors'])} failed ops, {len(result['checks'])} checks")
+        for line in differences:
+            print(line)
+        print("The engines agree." if not differences else "The engines differ.")
+        return 1 if differences else 0
+
+    sys.exit(asyncio.run(main()))
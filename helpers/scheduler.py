@@ -0,0 +1,288 @@
+import os
+import time
+import socket
+import random
+import asyncio
+import logging
+import aiosqlite
+from datetime import datetime, timedelta
+
+
+class CronSchedule:
+    """A five field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields accept "*", "*/n", "a", "a-b", "a-b/n" and comma separated lists of those.
+    Day-of-week uses 0 (or 7) for Sunday. As in cron, when both day fields are
+    restricted a day matches if either of them does.
+    """
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields.")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-'))
+            else:
+                start = end = int(part)
+            if start < low or end > high or step < 1:
+                raise ValueError(f"Cron field '{field}' is out of range {low}-{high}.")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, moment: datetime) -> datetime:
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression '{self.expression}' never matches.")
+
+
+class Job:
+    def __init__(self, name: str, func, schedule: str, jitter: int = 0, priority: int = 0, heavy: bool = False, run_at_start: bool = False, per_shard: bool = False):
+        self.name = name
+        self.func = func
+        self.schedule = CronSchedule(schedule)
+        self.jitter = jitter
+        self.priority = priority
+        self.heavy = heavy
+        self.run_at_start = run_at_start
+        # A per-shard job runs once in every shard process instead of once overall.
+        self.per_shard = per_shard
+        self.next_run = None
+        self.running = False
+
+
+class Scheduler:
+    """Runs maintenance jobs on cron schedules.
+
+    A job never overlaps itself, neither in this process nor, through a lease in the
+    scheduler database, in another process sharing that database; the lease of a
+    per-shard job is taken per "shard", so each shard process runs it for its own guilds.
+    Heavy jobs are limited to "max_heavy_jobs" at a time and are pushed out of the
+    configured "peak_hours" window. Jobs due at the same time start in priority order,
+    and every run is recorded in the job_runs table together with the CPU time it used.
+    """
+    # How far ahead a heavy job's next off-peak match is looked for.
+    PEAK_SEARCH = timedelta(days=7)
+
+    def __init__(self, db_name: str = "scheduler.db", peak_hours: list = None, max_heavy_jobs: int = 1, lease_seconds: int = 3600, shard: str = None):
+        self.db_name = db_name
+        self.peak_hours = self._check_peak_hours(peak_hours)
+        self.heavy_jobs = asyncio.Semaphore(max_heavy_jobs)
+        self.lease_seconds = lease_seconds
+        self.shard = shard
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.jobs = {}
+        self.conn = None
+        self.loop_task = None
+        self.running_tasks = set()
+
+    def add_job(self, job: Job):
+        self.jobs[job.name] = job
+
+    async def initialize(self):
+        self.conn = await aiosqlite.connect(self.db_name)
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_runs
+            (
+                job_name text,
+                started_at real,
+                finished_at real,
+                status text,
+                cpu_seconds real,
+                error text
+            )
+        ''')
+        await self.conn.execute('CREATE INDEX IF NOT EXISTS idx_job_runs_name ON job_runs(job_name, started_at)')
+        await self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_locks
+            (
+                job_name text PRIMARY KEY,
+                owner text,
+                expires_at real
+            )
+        ''')
+        await self.conn.commit()
+
+    @staticmethod
+    def _check_peak_hours(peak_hours: list) -> list:
+        # [start, end) in local hours; an end of 24 is midnight, [22, 2] wraps around it.
+        if not peak_hours:
+            return None
+        if len(peak_hours) != 2 or not all(isinstance(hour, int) for hour in peak_hours):
+            raise ValueError(f"peak_hours must be [start, end] in whole hours, got {peak_hours}.")
+        start, end = peak_hours
+        if not (0 <= start <= 23 and 0 <= end <= 24):
+            raise ValueError(f"peak_hours must start between 0 and 23 and end between 0 and 24, got {peak_hours}.")
+        if start == end % 24:
+            raise ValueError(f"peak_hours {peak_hours} is either empty or the whole day.")
+        return [start, end]
+
+    def in_peak_hours(self, moment: datetime) -> bool:
+        if not self.peak_hours:
+            return False
+        start, end = self.peak_hours
+        if start <= end:
+            return start <= moment.hour < end
+        return moment.hour >= start or moment.hour < end
+
+    def _peak_end(self, moment: datetime) -> datetime:
+        """The first moment at or after this one outside the peak hours."""
+        if not self.in_peak_hours(moment):
+            return moment
+        # An end of 24 becomes midnight at the start of the day, which the next line moves a day on.
+        end = moment.replace(hour=self.peak_hours[1] % 24, minute=0, second=0, microsecond=0)
+        return end if end > moment else end + timedelta(days=1)
+
+    def _schedule_next(self, job: Job, after: datetime):
+        next_run = job.schedule.next_after(after)
+        if job.heavy and self.in_peak_hours(next_run):
+            first_match = next_run
+            while self.in_peak_hours(next_run) and next_run - first_match < self.PEAK_SEARCH:
+                next_run = job.schedule.next_after(next_run)
+            if self.in_peak_hours(next_run):
+                # The schedule only matches inside the peak hours; run it once they are over.
+                next_run = self._peak_end(first_match)
+                logging.warning(f"Job {job.name} only matches during peak hours, running it off-peak at {next_run}.")
+        jittered = next_run + timedelta(seconds=random.uniform(0, job.jitter))
+        # Jitter must not push a heavy job back into the peak hours.
+        job.next_run = next_run if job.heavy and self.in_peak_hours(jittered) else jittered
+
+    async def start(self):
+        if self.conn is None:
+            await self.initialize()
+        now = datetime.now()
+        for job in self.jobs.values():
+            if job.run_at_start:
+                job.next_run = self._peak_end(now) if job.heavy else now
+            else:
+                self._schedule_next(job, now)
+        self.loop_task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.loop_task is not None:
+            self.loop_task.cancel()
+            await asyncio.gather(self.loop_task, return_exceptions=True)
+            self.loop_task = None
+        for task in list(self.running_tasks):
+            task.cancel()
+        await asyncio.gather(*self.running_tasks, return_exceptions=True)
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+    async def _loop(self):
+        while True:
+            now = datetime.now()
+            due = [job for job in self.jobs.values() if job.next_run <= now]
+            for job in sorted(due, key=lambda job: job.priority, reverse=True):
+                self._schedule_next(job, now)
+                if job.running:
+                    logging.info(f"Job {job.name} is still running, skipping this run.")
+                    continue
+                task = asyncio.create_task(self._run(job))
+                self.running_tasks.add(task)
+                task.add_done_callback(self.running_tasks.discard)
+            next_run = min((job.next_run for job in self.jobs.values()), default=None)
+            # Wake up at least every minute so clock changes are picked up.
+            await asyncio.sleep(60 if next_run is None else min(60, max(0, (next_run - datetime.now()).total_seconds())))
+
+    def _lease_name(self, job: Job) -> str:
+        return f"{job.name}@{self.shard}" if job.per_shard and self.shard else job.name
+
+    async def _acquire_lease(self, job: Job) -> bool:
+        now = time.time()
+        cursor = await self.conn.execute('''
+            INSERT INTO job_locks (job_name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(job_name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE job_locks.expires_at < ? OR job_locks.owner = excluded.owner
+        ''', (self._lease_name(job), self.owner, now + self.lease_seconds, now))
+        acquired = cursor.rowcount == 1
+        await cursor.close()
+        await self.conn.commit()
+        return acquired
+
+    async def _release_lease(self, job: Job):
+        await self.conn.execute('DELETE FROM job_locks WHERE job_name = ? AND owner = ?', (self._lease_name(job), self.owner))
+        await self.conn.commit()
+
+    async def _record_run(self, job: Job, started_at: float, status: str, cpu_seconds: float, error: str = None):
+        await self.conn.execute(
+            'INSERT INTO job_runs VALUES (?, ?, ?, ?, ?, ?)',
+            (job.name, started_at, time.time(), status, cpu_seconds, error)
+        )
+        await self.conn.commit()
+
+    async def _run(self, job: Job):
+        job.running = True
+        try:
+            if job.heavy:
+                async with self.heavy_jobs:
+                    await self._run_leased(job)
+            else:
+                await self._run_leased(job)
+        finally:
+            job.running = False
+
+    async def _run_leased(self, job: Job):
+        started_at = time.time()
+        if not await self._acquire_lease(job):
+            logging.info(f"Job {job.name} is running in another process, skipping this run.")
+            await self._record_run(job, started_at, 'locked', 0)
+            return
+        # process_time covers every thread, so this includes work done in aiosqlite's thread.
+        cpu_start = time.process_time()
+        try:
+            logging.info(f"Running job {job.name}...")
+            await job.func()
+            await self._record_run(job, started_at, 'ok', time.process_time() - cpu_start)
+            logging.info(f"Job {job.name} finished in {time.time() - started_at:.2f}s.")
+        except asyncio.CancelledError:
+            await self._record_run(job, started_at, 'cancelled', time.process_time() - cpu_start)
+            raise
+        except Exception as e:
+            logging.error(f"Job {job.name} failed: {e}")
+            await self._record_run(job, started_at, 'failed', time.process_time() - cpu_start, str(e))
+        finally:
+            await self._release_lease(job)
+
+    async def get_history(self, job_name: str, limit: int = 10):
+        query = 'SELECT started_at, finished_at, status, cpu_seconds, error FROM job_runs WHERE job_name = ? ORDER BY started_at DESC LIMIT ?'
+        async with self.conn.execute(query, (job_name, limit)) as cursor:
+            return await cursor.fetchall()
@@ -0,0 +1,177 @@
+import logging
+import itertools
+from abc import ABC, abstractmethod
+
+_instances = itertools.count()
+
+
+class StorageBackend(ABC):
+    """Operations the bot and the games need from a database.
+
+    DBHelper implements it on SQLite, PostgresHelper on a PostgreSQL server and
+    MemoryLedger in memory on top of a SQLite file.
+    Point changes are events; balances are the sum of a user's live events plus
+    whatever aggregate_points_async has already folded into points_agg. Every event
+    is also added to daily rollups per reason and per (reason, user) as it is written,
+    which the economy reports read instead of the events.
+    """
+    def data_version(self, name: str) -> tuple:
+        """In-process version of "shop" or "leaderboard", bumped by every write to it.
+
+        Versions also differ between backend instances, so a reopened database never
+        matches a version taken before it was closed.
+        """
+        if not hasattr(self, '_data_versions'):
+            self._data_versions = {"instance": next(_instances)}
+        return self._data_versions["instance"], self._data_versions.get(name, 0)
+
+    def _bump_version(self, *names):
+        self.data_version(names[0])
+        for name in names:
+            self._data_versions[name] = self._data_versions.get(name, 0) + 1
+
+    @abstractmethod
+    async def initialize(self):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    @abstractmethod
+    async def create_db(self):
+        ...
+
+    # --- ledger ---
+    @abstractmethod
+    async def add_event(self, userid: str, currency_change: int, reason: str):
+        ...
+
+    @abstractmethod
+    async def add_events(self, events: list):
+        """Adds (userid, currency_change, reason) events in one transaction."""
+
+    @abstractmethod
+    async def add_event_batch(self, batch_id: str, events: list, event_timestamp: int = None, gacha_events: list = None) -> bool:
+        """Like add_events, plus any gacha_events, but only once per batch_id. Returns False for a batch that was already added."""
+
+    async def _spool_failed_write(self, events: list, event_timestamp: int, error: Exception, gacha_events: list = None):
+        # With an outbox the events are retried later; without one they are lost, as they always were.
+        outbox = getattr(self, 'outbox', None)
+        if outbox is None:
+            logging.error(f"Failed to add event: {error}")
+            return
+        try:
+            await outbox.put(events, event_timestamp, gacha_events)
+            logging.warning(f"Spooled {len(events)} events after a failed write: {error}")
+        except Exception as e:
+            outbox.stats["dropped"] += 1
+            logging.error(f"Failed to add events {events} {gacha_events or ''}: {error}, and failed to spool them: {e}")
+
+    @abstractmethod
+    async def get_live_currency(self, userid: str) -> int:
+        ...
+
+    @abstractmethod
+    async def get_aggregated_currency(self, userid: str) -> int:
+        ...
+
+    async def get_total_currency(self, userid: str) -> int:
+        live_currency = await self.get_live_currency(userid)
+        aggregated_currency = await self.get_aggregated_currency(userid)
+        return live_currency + aggregated_currency
+
+    @abstractmethod
+    async def get_leaderboard(self, limit: int = 10) -> list:
+        ...
+
+    @abstractmethod
+    def iter_balances(self, batch_size: int = 1000):
+        """Async iterator over (userid, total_points) of every user, ordered by userid, fetched batch_size rows at a time."""
+
+    @abstractmethod
+    def iter_leaderboard(self, batch_size: int = 1000):
+        """Like iter_balances, but only current members, ordered by total_points descending."""
+
+    @abstractmethod
+    async def aggregate_points_async(self, cutoff_timestamp):
+        """Folds events older than cutoff_timestamp into points_agg."""
+
+    # --- economy rollups ---
+    @staticmethod
+    def rollup_day(timestamp: float) -> int:
+        """The UTC day number the rollups file a timestamp under."""
+        return int(timestamp // 86400)
+
+    @abstractmethod
+    async def get_economy(self, since_timestamp: float) -> list:
+        """(reason, earned, spent, event_count) per reason over the days since since_timestamp, busiest first."""
+
+    @abstractmethod
+    async def get_economy_users(self, reason: str, since_timestamp: float, limit: int = 10) -> list:
+        """(userid, earned, spent, event_count) of the users who moved the most points for reason since since_timestamp."""
+
+    # --- seasons ---
+    @abstractmethod
+    async def start_season(self, name: str) -> int:
+        """Ends the current season and starts a new one with empty balances. Returns the new season's id.
+
+        The cutover only switches tables, so it is quick however large the ledger is;
+        the final balances of the old season are saved for get_season_leaderboard afterwards.
+        """
+
+    @abstractmethod
+    async def get_seasons(self) -> list:
+        """(season_id, name, started_at, ended_at) of every season, the current one last with ended_at None."""
+
+    @abstractmethod
+    async def get_season_leaderboard(self, season_id: int, limit: int = 10) -> list:
+        """(userid, total_points) of the top users of a season, as they stood when it ended."""
+
+    # --- shop ---
+    @abstractmethod
+    async def add_item(self, item_name: str, item_price: int, item_description: str, item_file: str):
+        ...
+
+    @abstractmethod
+    async def remove_item_by_id(self, item_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def remove_item_by_name(self, item_name: str) -> int:
+        ...
+
+    @abstractmethod
+    async def buy_items_by_id(self, item_id: int):
+        ...
+
+    @abstractmethod
+    async def buy_items_by_name(self, item_name: str):
+        ...
+
+    @abstractmethod
+    async def get_shop_items(self) -> list:
+        ...
+
+    # --- gacha ---
+    @abstractmethod
+    async def add_gacha_event(self, userid: str, reward_rarity: int, reward_name: str, event_timestamp: float):
+        ...
+
+    @abstractmethod
+    async def add_gacha_events(self, events: list, gacha_events: list):
+        """Adds the (userid, currency_change, reason) events that pay for a set of pulls and their
+        (userid, reward_rarity, reward_name, event_timestamp) gacha events in one transaction."""
+
+    @abstractmethod
+    async def get_pity(self, userid: str):
+        """Returns the number of pulls since the last 4 star and since the last 5 star reward."""
+
+    # --- users ---
+    @abstractmethod
+    async def replace_users(self, user_list: list, batch_size: int = -1):
+        ...
+
+    @abstractmethod
+    async def delete_user(self, userid: str):
+        ...
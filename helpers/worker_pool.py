@@ -0,0 +1,280 @@
+import os
+import time
+import asyncio
+import logging
+import importlib
+import itertools
+import threading
+import multiprocessing
+import zlib
+
+
+def resolve_job(path: str):
+    """Turns "module:function" into the job function."""
+    module_name, function_name = path.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class JobContext:
+    """What a job gets to work with inside a worker process; Melbot has the same attributes."""
+    def __init__(self, config: dict):
+        from helpers.guild_manager import GuildManager
+        from helpers.gdrive_helper import GDriveHelper
+        self.config = config
+        self.guilds = GuildManager(config)
+        self.gdrive = GDriveHelper()
+
+
+async def _serve(config: dict, jobs: dict, requests, results):
+    context = JobContext(config)
+    functions = {name: resolve_job(path) for name, path in jobs.items()}
+    loop = asyncio.get_running_loop()
+    # The last job of every key; a new job for the key waits for it, which keeps each user's jobs in order.
+    tails = {}
+
+    async def run(job_id: int, key, name: str, kwargs: dict, previous: asyncio.Task):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            result = await functions[name](context, **kwargs)
+            results.put((job_id, True, result))
+        except Exception as e:
+            logging.exception(f"Job {name} failed.")
+            results.put((job_id, False, f"{type(e).__name__}: {e}"))
+
+    def forget(key, task: asyncio.Task):
+        if tails.get(key) is task:
+            del tails[key]
+
+    while True:
+        request = await loop.run_in_executor(None, requests.get)
+        if request is None:
+            break
+        job_id, key, name, kwargs = request
+        task = asyncio.create_task(run(job_id, key, name, kwargs, tails.get(key)))
+        tails[key] = task
+        task.add_done_callback(lambda task, key=key: forget(key, task))
+    if tails:
+        await asyncio.wait(list(tails.values()))
+    await context.guilds.close()
+
+
+def _worker_main(index: int, config: dict, jobs: dict, requests, results):
+    import dotenv
+    from helpers.log_helper import setup_logging
+    dotenv.load_dotenv()
+    log_config = dict(config.get("logging", {}))
+    # melbot.worker0.log, never under melbot.log.*, which the gateway's rotation treats as its backups.
+    root, extension = os.path.splitext(log_config.get('file', 'melbot.log'))
+    log_config["file"] = f"{root}.worker{index}{extension or '.log'}"
+    listener = setup_logging(log_config)
+    # Every process spools failed writes to a file of its own.
+    config = {**config, "outbox": {**config.get("outbox", {}), "process_name": f"worker{index}"}}
+    try:
+        asyncio.run(_serve(config, jobs, requests, results))
+    finally:
+        listener.stop()
+
+
+class WorkersStopped(RuntimeError):
+    """The pool is stopped, e.g. while a backup is restored."""
+
+
+class JobPending(Exception):
+    """The job outlived job_timeout. It still finishes in the worker, and future gets its result, or an error if the worker dies."""
+    def __init__(self, job: str, future: asyncio.Future):
+        super().__init__(f"Job {job} is still running.")
+        self.job = job
+        self.future = future
+
+
+class WorkerPool:
+    """Runs command jobs in separate worker processes, so CPU heavy commands never stall the gateway's event loop.
+
+    Jobs are async functions taking a JobContext and plain, picklable arguments, named
+    as "module:function" in "jobs". Each worker has its own event loop and its own
+    connections to the guild databases. All jobs of one key (a user id) go to the same
+    worker, which runs them one after another in the order they were submitted; jobs
+    of different keys run concurrently. The order only covers jobs: commands that run
+    in the gateway process are not ordered with them. A job cannot be stopped once its
+    worker has it, so a job taking longer than "job_timeout" raises JobPending and keeps
+    going. A worker that dies fails the jobs it had and is started again; checked every
+    "watch_interval" seconds.
+    """
+    def __init__(self, config: dict, jobs: dict, processes: int = 2, job_timeout: float = 60, watch_interval: float = 1):
+        self.config = config
+        self.jobs = jobs
+        self.processes = processes
+        self.job_timeout = job_timeout
+        self.watch_interval = watch_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.requests = []
+        self.workers = []
+        self.results = None
+        self.reader = None
+        self.watcher = None
+        # job id -> (worker index, future)
+        self.pending = {}
+        self.job_ids = itertools.count()
+        self.loop = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.results = self.context.Queue()
+        self.requests = [None] * self.processes
+        self.workers = [None] * self.processes
+        for index in range(self.processes):
+            self._start_worker(index)
+        self.reader = threading.Thread(target=self._read_results, name="melbot-worker-results", daemon=True)
+        self.reader.start()
+        self.watcher = asyncio.create_task(self._watch())
+        logging.info(f"Started {self.processes} worker processes.")
+
+    def _start_worker(self, index: int):
+        # A fresh queue, so a restarted worker never picks up jobs that were already failed.
+        requests = self.context.Queue()
+        worker = self.context.Process(target=_worker_main, args=(index, self.config, self.jobs, requests, self.results), name=f"melbot-worker-{index}", daemon=True)
+        worker.start()
+        self.requests[index] = requests
+        self.workers[index] = worker
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            for index, worker in enumerate(self.workers):
+                if worker.is_alive():
+                    continue
+                logging.error(f"Worker {index} exited with code {worker.exitcode}, starting it again.")
+                lost = [job_id for job_id, (job_index, _) in self.pending.items() if job_index == index]
+                self._start_worker(index)
+                # Results the worker sent before it died may still be on their way.
+                await asyncio.sleep(self.watch_interval)
+                for job_id in lost:
+                    entry = self.pending.pop(job_id, None)
+                    if entry is not None and not entry[1].done():
+                        entry[1].set_exception(RuntimeError(f"Worker {index} exited with code {worker.exitcode} before the job finished."))
+
+    def _read_results(self):
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            self.loop.call_soon_threadsafe(self._resolve, *message)
+
+    def _resolve(self, job_id: int, ok: bool, result):
+        entry = self.pending.pop(job_id, None)
+        if entry is None or entry[1].done():
+            return
+        future = entry[1]
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(RuntimeError(result))
+
+    def worker_for(self, key) -> int:
+        # A stable hash, so a key maps to the same worker in every run.
+        return zlib.crc32(str(key).encode()) % self.processes
+
+    async def run(self, key, job: str, /, **kwargs):
+        if not self.workers:
+            raise WorkersStopped("The worker processes are stopped.")
+        index = self.worker_for(key)
+        if not self.workers[index].is_alive():
+            raise RuntimeError(f"Worker {index} is not running (exit code {self.workers[index].exitcode}).")
+        job_id = next(self.job_ids)
+        future = self.loop.create_future()
+        self.pending[job_id] = (index, future)
+        self.requests[index].put((job_id, key, job, kwargs))
+        try:
+            # Shielded, so the future still gets the result after a timeout; _resolve forgets it.
+            return await asyncio.wait_for(asyncio.shield(future), self.job_timeout)
+        except asyncio.TimeoutError:
+            raise JobPending(job, future)
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            await asyncio.to_thread(worker.join, 10)
+            if worker.is_alive():
+                worker.terminate()
+        if self.results is not None:
+            self.results.put(None)
+        for _, future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        self.requests = []
+        self.workers = []
+        logging.info("Stopped the worker processes.")
+
+
+async def _busy_job(context, key, index: int, seconds: float):
+    # Stands in for a CPU heavy command such as a "!gacha max".
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+    return (key, index)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    async def measure_lag(run_burst) -> tuple:
+        # How late a 10ms ticker on the gateway loop fires while the burst runs.
+        lags = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - started - 0.01)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        started = time.perf_counter()
+        results = await run_burst()
+        elapsed = time.perf_counter() - started
+        done.set()
+        await task
+        return results, elapsed, max(lags) * 1000
+
+    async def main():
+        jobs = {"busy": "helpers.worker_pool:_busy_job"}
+        burst = [(user, index) for index in range(4) for user in range(4)]
+
+        async def inline():
+            job = resolve_job(jobs["busy"])
+            return [await job(None, user, index, 0.05) for user, index in burst]
+
+        results, elapsed, lag = await measure_lag(inline)
+        print(f"Inline: {len(results)} jobs in {elapsed * 1000:.0f}ms, worst gateway loop lag {lag:.0f}ms")
+
+        with tempfile.TemporaryDirectory() as directory:
+            pool = WorkerPool({"db_name": os.path.join(directory, "bench"), "logging": {"file": os.path.join(directory, "bench.log")}}, jobs, processes=4)
+            pool.start()
+            # Warm the workers up, spawning them takes a moment.
+            await asyncio.gather(*[pool.run(user, "busy", key=user, index=-1, seconds=0) for user in range(4)])
+
+            async def split():
+                return await asyncio.gather(*[pool.run(user, "busy", key=user, index=index, seconds=0.05) for user, index in burst])
+
+            results, elapsed, lag = await measure_lag(split)
+            print(f"Workers: {len(results)} jobs in {elapsed * 1000:.0f}ms, worst gateway loop lag {lag:.0f}ms")
+
+            # Jobs of one user finish in the order they were submitted, even when the earlier ones are slower.
+            finished = []
+
+            async def tracked(index):
+                finished.append(await pool.run("same user", "busy", key="same user", index=index, seconds=0.04 - index * 0.01))
+
+            await asyncio.gather(*[tracked(index) for index in range(4)])
+            assert [index for _, index in finished] == [0, 1, 2, 3], finished
+            print("Jobs of one user ran in order.")
+            await pool.stop()
+
+    asyncio.run(main())
@@ -1,20 +1,18 @@
+import time
+startup_time = time.perf_counter()
+
 import dotenv
 import sys
 import os
+import json
 import logging
-import datetime
 import asyncio
 import threading
 from bot import Melbot
+from helpers.log_helper import setup_logging
 
-# Set up logging
-current_date = datetime.datetime.now().strftime("%Y-%m-%d")
-logging.basicConfig(
-    filename = f'melbot-{current_date}.log',
-    filemode='a',
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+# Set up logging; records are written by a background thread.
+log_listener = setup_logging(json.load(open('bot.json')).get('logging', {}))
 dotenv.load_dotenv()
 
 
@@ -26,7 +24,7 @@ async def shutdown(loop):
     await loop.shutdown_asyncgens()
 
 async def main():
-    melbot = Melbot()
+    melbot = Melbot(startup_time=startup_time)
     try:
         await melbot.run()
     finally:
@@ -38,8 +36,9 @@ def log_active_threads(stage):
         logging.info(f"Thread: {thread.name}, ID: {thread.ident}")
 
 def join_remaining_threads():
+    # Daemon threads, like the log writer, do not keep the process alive.
     for thread in threading.enumerate():
-        if thread is not threading.current_thread():
+        if thread is not threading.current_thread() and not thread.daemon:
             logging.info(f"Joining thread: {thread.name}")
             thread.join(timeout=5)
 
@@ -68,11 +67,13 @@ def run_main():
         log_active_threads("after joining threads")
 
         # If there are still threads remaining, force exit
-        remaining_threads = threading.enumerate()
+        remaining_threads = [thread for thread in threading.enumerate() if not thread.daemon]
         if len(remaining_threads) > 1:  # More than just the main thread
             logging.info("Remaining threads detected, forcefully exiting.")
+            log_listener.stop()
             os._exit(1)
         else:
+            log_listener.stop()
             sys.exit(0)
 
 if __name__ == "__main__":